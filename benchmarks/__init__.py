@@ -0,0 +1 @@
+"""CPU-only benchmarks of the data pipeline and training hot paths, see run_benchmarks.py."""
@@ -0,0 +1,110 @@
+import json
+import os
+import random
+
+"""
+Offline stand-ins for the real inputs of the pipeline: a small byte-level BPE tokenizer
+trained on synthetic text, a tiny randomly initialized GPTBigCode (the StarCoder
+architecture) and tamarind-like source files for the prepare scripts.
+Everything is generated from a seed, nothing is downloaded.
+"""
+
+WORDS = (
+    "workflow step action input output metadata instructions task run check validate send "
+    "receive wait retry fail success user order payment invoice email report file upload "
+    "download parse transform filter map reduce join split merge schedule notify approve"
+).split()
+
+EOS_TOKEN = "<|endoftext|>"
+
+
+def random_text(rng, min_words=5, max_words=60):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+
+
+def random_workflow(rng):
+    return [
+        {"id": f"step_{i}", "action": rng.choice(WORDS), "params": {rng.choice(WORDS): rng.choice(WORDS)}}
+        for i in range(rng.randint(1, 8))
+    ]
+
+
+def random_pairs(n, seed=0):
+    """`n` (prompt, completion) pairs of varied lengths, shaped like the tamarind records."""
+    rng = random.Random(seed)
+    return [
+        (random_text(rng), json.dumps({"workflow": random_workflow(rng)}, separators=(",", ":")))
+        for _ in range(n)
+    ]
+
+
+def make_tokenizer(vocab_size=2048, seed=0):
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=[EOS_TOKEN],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+        show_progress=False,
+    )
+    corpus = [p + "\n\n" + c for p, c in random_pairs(2000, seed)]
+    tokenizer.train_from_iterator(corpus, trainer=trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token=EOS_TOKEN, pad_token=EOS_TOKEN)
+
+
+def make_model(tokenizer, seq_length=512, n_layer=2, n_embd=128, n_head=4, seed=0):
+    import torch
+    from transformers import AutoModelForCausalLM, GPTBigCodeConfig
+
+    torch.manual_seed(seed)
+    config = GPTBigCodeConfig(
+        vocab_size=len(tokenizer),
+        n_positions=seq_length,
+        n_embd=n_embd,
+        n_layer=n_layer,
+        n_head=n_head,
+        bos_token_id=tokenizer.eos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    return AutoModelForCausalLM.from_config(config)
+
+
+def write_sources(root, n_files=8, records_per_file=200, seed=0):
+    """
+    Source files in the layout read by the prepare scripts:
+        <root>/.data/test_data_1/data_*.json   workflows keyed by id, with prompt.md
+        <root>/.data/spec_data/spec_*.json     input/output lists, with prompt.md and validity_dataset.json
+    Returns the number of records written.
+    """
+    rng = random.Random(seed)
+    wf_dir = os.path.join(root, ".data", "test_data_1")
+    spec_dir = os.path.join(root, ".data", "spec_data")
+    os.makedirs(wf_dir, exist_ok=True)
+    os.makedirs(spec_dir, exist_ok=True)
+    for directory in (wf_dir, spec_dir):
+        with open(os.path.join(directory, "prompt.md"), "w", encoding="utf-8") as f:
+            f.write(random_text(rng, 200, 400))
+
+    def spec_records(n):
+        return [{"input": random_text(rng), "output": json.dumps(random_workflow(rng))} for _ in range(n)]
+
+    for i in range(n_files):
+        workflows = {
+            f"wf_{i}_{j}": {
+                "instructions": [random_text(rng, 3, 20) for _ in range(rng.randint(1, 4))],
+                "metadata": {"name": random_text(rng, 1, 4)},
+                "workflow": random_workflow(rng),
+            }
+            for j in range(records_per_file)
+        }
+        with open(os.path.join(wf_dir, f"data_{i}.json"), "w", encoding="utf-8") as f:
+            json.dump(workflows, f)
+        with open(os.path.join(spec_dir, f"spec_{i}.json"), "w", encoding="utf-8") as f:
+            json.dump(spec_records(records_per_file), f)
+    with open(os.path.join(spec_dir, "validity_dataset.json"), "w", encoding="utf-8") as f:
+        json.dump(spec_records(records_per_file), f)
+    return (2 * n_files + 1) * records_per_file
@@ -0,0 +1,317 @@
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import Namespace
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "data_starcoderbase"))
+
+from benchmarks.fixtures import make_model, make_tokenizer, random_pairs, write_sources
+
+"""
+CPU-only benchmarks of the data pipeline and training hot paths, runnable offline.
+
+Every benchmark reports one throughput (higher is better), the best of --repeat runs.
+Results are written as JSON; given a --baseline results file, any benchmark slower
+than the baseline by more than --threshold is reported and the exit code is 1.
+
+    python benchmarks/run_benchmarks.py --output before.json
+    python benchmarks/run_benchmarks.py --baseline before.json --threshold 0.1
+
+Timings depend on the machine, only compare results from the same one.
+"""
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--only", nargs="*", default=None, help="names of the benchmarks to run, all by default")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--samples", type=int, default=2000, help="synthetic prompt/completion pairs")
+    parser.add_argument("--seq_length", type=int, default=512)
+    parser.add_argument("--train_steps", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads, torch default if unset")
+    parser.add_argument("--output", type=str, default="benchmarks/results.json")
+    parser.add_argument("--baseline", type=str, default=None)
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed slowdown relative to the baseline")
+    return parser.parse_args()
+
+
+class Context:
+    """Fixtures shared by the benchmarks, built on first use."""
+
+    def __init__(self, args):
+        self.args = args
+        self._tokenizer = None
+        self._dataset = None
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            self._tokenizer = make_tokenizer()
+        return self._tokenizer
+
+    @property
+    def dataset(self):
+        if self._dataset is None:
+            from datasets import Dataset
+
+            prompts, completions = zip(*random_pairs(self.args.samples))
+            self._dataset = Dataset.from_dict({"prompt": list(prompts), "completion": list(completions)})
+        return self._dataset
+
+
+def bench_constant_length_dataset(ctx, background=False):
+    from finetune import ConstantLengthDataset
+
+    dataset = ConstantLengthDataset(
+        ctx.tokenizer,
+        ctx.dataset,
+        seq_length=ctx.args.seq_length,
+        num_of_sequences=64,
+        chars_per_token=None if background else 3.6,
+        background_tokenization=background,
+    )
+    start = time.perf_counter()
+    sequences = sum(1 for _ in dataset)
+    elapsed = time.perf_counter() - start
+    return sequences * ctx.args.seq_length / elapsed, "tokens/s"
+
+
+def bench_constant_length_dataset_background(ctx):
+    return bench_constant_length_dataset(ctx, background=True)
+
+
+def bench_chars_token_ratio(ctx):
+    from finetune import chars_token_ratio
+
+    nb_examples = min(400, len(ctx.dataset))
+    start = time.perf_counter()
+    with contextlib.redirect_stderr(io.StringIO()):
+        chars_token_ratio(ctx.dataset, ctx.tokenizer, nb_examples=nb_examples)
+    return nb_examples / (time.perf_counter() - start), "examples/s"
+
+
+def bench_tokenize_pairs(ctx):
+    from common.tokenization import tokenize_pairs
+
+    pairs = random_pairs(ctx.args.samples)
+    start = time.perf_counter()
+    for i in range(0, len(pairs), 1000):
+        prompts, completions = zip(*pairs[i : i + 1000])
+        tokenize_pairs(ctx.tokenizer, prompts, completions, separator=ctx.tokenizer.eos_token)
+    return len(pairs) / (time.perf_counter() - start), "examples/s"
+
+
+def bench_collate(ctx):
+    from common.batching import DynamicPaddingCollator, TokenBudgetBatchSampler
+    from common.tokenization import tokenize_pairs
+
+    prompts, completions = zip(*random_pairs(ctx.args.samples))
+    features = tokenize_pairs(ctx.tokenizer, prompts, completions, separator=ctx.tokenizer.eos_token)
+    samples = [{"input_ids": ids, "labels": labels} for ids, labels in zip(features["input_ids"], features["labels"])]
+    collator = DynamicPaddingCollator(ctx.tokenizer.pad_token_id)
+    start = time.perf_counter()
+    for batch in TokenBudgetBatchSampler(features["length"], max_tokens=4 * ctx.args.seq_length):
+        collator([samples[i] for i in batch])
+    return collator.padded_tokens / (time.perf_counter() - start), "tokens/s"
+
+
+def load_script(path, name):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_prepare(ctx, script, setup=None):
+    """Records/s of a cold run (empty source cache) of a prepare script over synthetic sources, parsing serially."""
+    workdir = tempfile.mkdtemp(prefix="bench_prepare_")
+    cwd = os.getcwd()
+    try:
+        records = write_sources(workdir)
+        os.chdir(workdir)
+        for directory in ("data", "data_codet5", "data_starcoderbase"):
+            os.makedirs(directory, exist_ok=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            module = load_script(ROOT / script, f"bench_{script.replace('/', '_')[:-3]}")
+            if setup is not None:
+                setup(module, workdir)
+            start = time.perf_counter()
+            module.main(Namespace(workers=1, split_salt="", dedup_threshold=0.8, keep_duplicates=False))
+            elapsed = time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return records / elapsed, "records/s"
+
+
+def bench_prepare_mistral(ctx):
+    def setup(module, workdir):
+        module.WF_DATA_PATH = os.path.join(workdir, ".data", "test_data_1")
+        module.SPEC_DATA_PATH = os.path.join(workdir, ".data", "spec_data")
+
+    return run_prepare(ctx, "data_mistral/prepare.py", setup)
+
+
+def bench_prepare_codet5(ctx):
+    return run_prepare(ctx, "data_codet5/prepare.py")
+
+
+def bench_prepare_starcoderbase(ctx):
+    return run_prepare(ctx, "data_starcoderbase/prepare.py")
+
+
+def bench_lora_train_steps(ctx):
+    """Optimizer steps of the LoRA model of run_training (in fp32, without 8-bit loading) on the tiny model."""
+    import torch
+    from peft import get_peft_model
+
+    from finetune import create_lora_config
+
+    model = make_model(ctx.tokenizer, seq_length=ctx.args.seq_length)
+    with contextlib.redirect_stderr(io.StringIO()):
+        model = get_peft_model(model, create_lora_config(Namespace(lora_r=16, lora_alpha=32, lora_dropout=0.05)))
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=5e-6, weight_decay=0.05)
+    generator = torch.Generator().manual_seed(0)
+    batch_size = 2
+    input_ids = torch.randint(len(ctx.tokenizer), (batch_size, ctx.args.seq_length), generator=generator)
+    model.train()
+
+    def step():
+        loss = model(input_ids=input_ids, labels=input_ids).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+
+    step()  # warm-up
+    start = time.perf_counter()
+    for _ in range(ctx.args.train_steps):
+        step()
+    return ctx.args.train_steps * batch_size * ctx.args.seq_length / (time.perf_counter() - start), "tokens/s"
+
+
+def bench_lora_sweep_steps(ctx):
+    """Adapter optimizer steps of a 4-adapter LoraSweep sharing the tiny base model, comparable to lora_train_steps."""
+    import torch
+
+    from sweep import LoraSweep
+
+    configs = [{"name": f"lora{i}", "lora_r": 16, "lora_alpha": 32, "learning_rate": 5e-6} for i in range(4)]
+    with contextlib.redirect_stderr(io.StringIO()):
+        sweep = LoraSweep(make_model(ctx.tokenizer, seq_length=ctx.args.seq_length), configs)
+    generator = torch.Generator().manual_seed(0)
+    batch_size = 2
+    input_ids = torch.randint(len(ctx.tokenizer), (batch_size, ctx.args.seq_length), generator=generator)
+    batches = [{"input_ids": input_ids, "labels": input_ids}]
+    sweep.step(batches)  # warm-up
+    start = time.perf_counter()
+    for _ in range(ctx.args.train_steps):
+        sweep.step(batches)
+    return len(configs) * ctx.args.train_steps * batch_size * ctx.args.seq_length / (time.perf_counter() - start), "tokens/s"
+
+
+BENCHMARKS = {
+    "constant_length_dataset": bench_constant_length_dataset,
+    "constant_length_dataset_background": bench_constant_length_dataset_background,
+    "chars_token_ratio": bench_chars_token_ratio,
+    "tokenize_pairs": bench_tokenize_pairs,
+    "collate": bench_collate,
+    "prepare_mistral": bench_prepare_mistral,
+    "prepare_codet5": bench_prepare_codet5,
+    "prepare_starcoderbase": bench_prepare_starcoderbase,
+    "lora_train_steps": bench_lora_train_steps,
+    "lora_sweep_steps": bench_lora_sweep_steps,
+}
+
+
+def environment():
+    import torch
+    import transformers
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "transformers": transformers.__version__,
+    }
+
+
+def run(args):
+    import torch
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    names = args.only or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        raise ValueError(f"Unknown benchmarks {unknown}, expected some of {list(BENCHMARKS)}")
+
+    ctx = Context(args)
+    results = {}
+    for name in names:
+        runs = []
+        for _ in range(args.repeat):
+            value, unit = BENCHMARKS[name](ctx)
+            runs.append(value)
+        results[name] = {"value": max(runs), "unit": unit, "runs": runs}
+        print(f"{name:<36} {max(runs):>14.1f} {unit}")
+    config = {k: getattr(args, k) for k in ("repeat", "samples", "seq_length", "train_steps")}
+    return {"environment": environment(), "config": config, "benchmarks": results}
+
+
+def compare(results, baseline, threshold):
+    """Print the change of each benchmark against the baseline and return the names of the regressions."""
+    regressions = []
+    for name, result in results["benchmarks"].items():
+        if name not in baseline["benchmarks"]:
+            continue
+        before = baseline["benchmarks"][name]["value"]
+        change = result["value"] / before - 1
+        regressed = change < -threshold
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<36} {before:>14.1f} -> {result['value']:>14.1f} {result['unit']} ({change:+.1%}){'  REGRESSION' if regressed else ''}")
+    if results["config"] != baseline.get("config"):
+        print(f"Warning: the baseline was run with a different configuration: {baseline.get('config')}")
+    return regressions
+
+
+def main(args):
+    results = run(args)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) slower than the baseline by more than {args.threshold:.0%}: {regressions}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(get_args())
@@ -0,0 +1,3 @@
+"""
+Helpers shared by the data preparation scripts, the notebooks and the training scripts.
+"""
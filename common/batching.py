@@ -0,0 +1,188 @@
+import math
+import random
+
+import torch
+from torch.utils.data import DataLoader
+from transformers import Trainer, TrainerCallback
+
+"""
+Length-bucketed batches capped by a token budget, padded only to the longest sample of each batch.
+
+Padding every sample to max_length (mistral notebook) or to the longest sample of a
+1000-example map batch (codet5 notebook) spends most of the FLOPs on pad tokens.
+Grouping samples of similar length and sizing each batch by tokens keeps the
+batches dense and the memory per step roughly constant.
+
+    collator = DynamicPaddingCollator(tokenizer.pad_token_id)
+    trainer = TokenBudgetTrainer(model=model, args=training_args, data_collator=collator, max_tokens=16384, ...)
+    trainer.add_callback(PaddingStatsCallback(collator))
+
+Use `TokenBudgetMixin` to get the same batching from another Trainer subclass such as trl's SFTTrainer:
+    class TokenBudgetSFTTrainer(TokenBudgetMixin, SFTTrainer): pass
+"""
+
+
+class TokenBudgetBatchSampler:
+    """
+    Batch sampler grouping samples of similar length, each batch holding at most `max_tokens`
+    tokens once padded (batch size * longest sample).
+        Args:
+            lengths (list): Token count of each sample of the dataset.
+            max_tokens (int): Token budget of a padded batch.
+            shuffle (bool): If True samples are shuffled before bucketing and batches are shuffled, per epoch.
+            seed (int): Seed of the shuffling, combined with the epoch set by `set_epoch`.
+            bucket_size (int): Number of samples sorted together; larger buckets waste less padding,
+                smaller ones keep more randomness in the batch composition.
+            max_batch_size (int): Optional cap on the number of samples per batch.
+    """
+
+    def __init__(self, lengths, max_tokens, shuffle=True, seed=0, bucket_size=4096, max_batch_size=None):
+        self.lengths = list(lengths)
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.bucket_size = bucket_size
+        self.max_batch_size = max_batch_size
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self._batches = None
+
+    def _make_batches(self):
+        rng = random.Random(self.seed + self.epoch)
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            rng.shuffle(indices)
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = sorted(indices[start : start + self.bucket_size], key=lambda i: self.lengths[i])
+            batch, longest = [], 0
+            for i in bucket:
+                longest_with_i = max(longest, self.lengths[i])
+                too_many = self.max_batch_size is not None and len(batch) == self.max_batch_size
+                if batch and (longest_with_i * (len(batch) + 1) > self.max_tokens or too_many):
+                    batches.append(batch)
+                    batch, longest_with_i = [], self.lengths[i]
+                batch.append(i)
+                longest = longest_with_i
+            if batch:
+                batches.append(batch)
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        if self._batches is None:
+            self._batches = self._make_batches()
+        batches, self._batches = self._batches, None
+        return iter(batches)
+
+    def __len__(self):
+        if self._batches is None:
+            self._batches = self._make_batches()
+        return len(self._batches)
+
+
+class DynamicPaddingCollator:
+    """
+    Pad `input_ids`, `attention_mask` and `labels` to the longest sample of the batch (rounded up to
+    `pad_to_multiple_of`) and keep a running count of real tokens versus padded slots.
+    Samples without `labels` get a copy of their `input_ids`.
+    """
+
+    def __init__(self, pad_token_id, label_pad_token_id=-100, pad_to_multiple_of=8, padding_side="right"):
+        self.pad_token_id = pad_token_id
+        self.label_pad_token_id = label_pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.padding_side = padding_side
+        self.real_tokens = 0
+        self.padded_tokens = 0
+
+    @property
+    def padding_ratio(self):
+        """Share of the batch slots filled with padding so far."""
+        return 1 - self.real_tokens / self.padded_tokens if self.padded_tokens else 0.0
+
+    def _pad(self, sequences, value, length):
+        out = torch.full((len(sequences), length), value, dtype=torch.long)
+        for row, seq in enumerate(sequences):
+            seq = torch.as_tensor(seq, dtype=torch.long)
+            if self.padding_side == "right":
+                out[row, : len(seq)] = seq
+            else:
+                out[row, length - len(seq) :] = seq
+        return out
+
+    def __call__(self, features):
+        input_ids = [f["input_ids"] for f in features]
+        labels = [f["labels"] if "labels" in f else f["input_ids"] for f in features]
+        lengths = [len(ids) for ids in input_ids]
+        length = max(lengths)
+        if self.pad_to_multiple_of:
+            length = math.ceil(length / self.pad_to_multiple_of) * self.pad_to_multiple_of
+        self.real_tokens += sum(lengths)
+        self.padded_tokens += length * len(features)
+        return {
+            "input_ids": self._pad(input_ids, self.pad_token_id, length),
+            "attention_mask": self._pad([[1] * n for n in lengths], 0, length),
+            "labels": self._pad(labels, self.label_pad_token_id, length),
+        }
+
+
+def sample_lengths(dataset, column="input_ids"):
+    """Token count of each sample, from a "length" column when the dataset has one."""
+    if "length" in dataset.column_names:
+        return list(dataset["length"])
+    return [len(ids) for ids in dataset[column]]
+
+
+class TokenBudgetMixin:
+    """Trainer mixin replacing the fixed-size batches of the train and eval dataloaders by token-budget batches."""
+
+    def __init__(self, *args, max_tokens=16384, bucket_size=4096, **kwargs):
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_size
+        super().__init__(*args, **kwargs)
+
+    def _token_budget_dataloader(self, dataset, shuffle, description):
+        lengths = sample_lengths(dataset)
+        dataset = self._remove_unused_columns(dataset, description=description)
+        batch_sampler = TokenBudgetBatchSampler(
+            lengths,
+            self.max_tokens,
+            shuffle=shuffle,
+            seed=self.args.seed,
+            bucket_size=self.bucket_size,
+        )
+        dataloader = DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+        return self.accelerator.prepare(dataloader)
+
+    def get_train_dataloader(self):
+        return self._token_budget_dataloader(self.train_dataset, shuffle=True, description="training")
+
+    def get_eval_dataloader(self, eval_dataset=None):
+        eval_dataset = eval_dataset if eval_dataset is not None else self.eval_dataset
+        return self._token_budget_dataloader(eval_dataset, shuffle=False, description="evaluation")
+
+
+class TokenBudgetTrainer(TokenBudgetMixin, Trainer):
+    pass
+
+
+class PaddingStatsCallback(TrainerCallback):
+    """Add the padding ratio of a DynamicPaddingCollator to the logs (collation must run in the main process)."""
+
+    def __init__(self, collator):
+        self.collator = collator
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if logs is not None and self.collator.padded_tokens:
+            logs["padding_ratio"] = round(self.collator.padding_ratio, 4)
@@ -0,0 +1,175 @@
+import copy
+import dataclasses
+import json
+import os
+import random
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from peft import PeftModel, get_peft_model_state_dict
+from safetensors.torch import save_file
+from transformers import Trainer
+from transformers.trainer import OPTIMIZER_NAME, SCALER_NAME, SCHEDULER_NAME, TRAINER_STATE_NAME
+from transformers.trainer_callback import ExportableState
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+
+"""
+Checkpoints of PEFT adapters written by a background thread instead of the training loop.
+
+At each save the adapter weights, optimizer, scheduler, scaler, RNG and trainer
+states are copied to CPU memory, which for a LoRA adapter takes milliseconds, and a
+writer thread saves them into a hidden `.tmp-checkpoint-N` directory that is renamed
+to `checkpoint-N` once complete. Anything named `checkpoint-N` is therefore a full
+checkpoint, loadable by LoadBestPeftModelCallback and resumable by the Trainer.
+At most one checkpoint is in flight: the next save waits for the previous write.
+
+Retention: after each write only the last `save_total_limit` checkpoints are kept,
+plus the best one when `load_best_model_at_end` tracks it.
+
+    trainer = AsyncCheckpointTrainer(model=peft_model, args=training_args, ...)
+
+Multi-process runs, models other than PeftModel and push_to_hub fall back to the synchronous Trainer save.
+"""
+
+TMP_PREFIX = ".tmp-"
+ADAPTER_WEIGHTS_NAME = "adapter_model.safetensors"
+
+
+def to_cpu(obj):
+    """Copy of a (nested) state dict with every tensor detached and copied to CPU memory."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+def checkpoint_step(path):
+    match = re.fullmatch(rf"{PREFIX_CHECKPOINT_DIR}-(\d+)", os.path.basename(os.path.normpath(path)))
+    return int(match.group(1)) if match else None
+
+
+def complete_checkpoints(output_dir):
+    """`checkpoint-N` directories of `output_dir` holding a trainer state, sorted by step."""
+    if not os.path.isdir(output_dir):
+        return []
+    checkpoints = []
+    for name in os.listdir(output_dir):
+        path = os.path.join(output_dir, name)
+        if checkpoint_step(name) is not None and os.path.isfile(os.path.join(path, TRAINER_STATE_NAME)):
+            checkpoints.append(path)
+    return sorted(checkpoints, key=checkpoint_step)
+
+
+def prune_checkpoints(output_dir, keep_last, keep=()):
+    """Delete all but the last `keep_last` complete checkpoints of `output_dir` and those in `keep`."""
+    if not keep_last:
+        return
+    keep = {os.path.normpath(path) for path in keep if path}
+    for path in complete_checkpoints(output_dir)[:-keep_last]:
+        if os.path.normpath(path) not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class AsyncCheckpointMixin:
+    """Trainer mixin saving the checkpoints of a PeftModel from a background thread."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint-writer")
+        self._pending = None
+        self._checkpoint_dirs = set()
+
+    def wait_for_checkpoint(self):
+        """Block until the checkpoint being written, if any, is on disk; re-raises its write error."""
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def _snapshot(self, model):
+        snapshot = {"adapter": {}, "configs": {}}
+        for adapter_name, config in model.peft_config.items():
+            snapshot["adapter"][adapter_name] = to_cpu(get_peft_model_state_dict(model, adapter_name=adapter_name))
+            snapshot["configs"][adapter_name] = copy.deepcopy(config)
+        if not self.args.save_only_model:
+            snapshot[OPTIMIZER_NAME] = to_cpu(self.optimizer.state_dict())
+            snapshot[SCHEDULER_NAME] = copy.deepcopy(self.lr_scheduler.state_dict())
+            scaler = getattr(self.accelerator, "scaler", None)
+            if scaler is not None:
+                snapshot[SCALER_NAME] = to_cpu(scaler.state_dict())
+            rng_states = {
+                "python": random.getstate(),
+                "numpy": np.random.get_state(),
+                "cpu": torch.random.get_rng_state(),
+            }
+            if torch.cuda.is_available():
+                rng_states["cuda"] = torch.cuda.random.get_rng_state()
+            snapshot["rng_state.pth"] = rng_states
+        return snapshot
+
+    def _write_checkpoint(self, snapshot, trainer_state, output_dir, keep):
+        run_dir, folder = os.path.split(output_dir)
+        tmp_dir = os.path.join(run_dir, TMP_PREFIX + folder)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for adapter_name, weights in snapshot.pop("adapter").items():
+            # same layout as PeftModel.save_pretrained: non-default adapters in a sub-directory
+            adapter_dir = tmp_dir if adapter_name == "default" else os.path.join(tmp_dir, adapter_name)
+            os.makedirs(adapter_dir, exist_ok=True)
+            save_file(weights, os.path.join(adapter_dir, ADAPTER_WEIGHTS_NAME), metadata={"format": "pt"})
+            snapshot["configs"][adapter_name].save_pretrained(adapter_dir)
+        snapshot.pop("configs")
+        for name, state in snapshot.items():
+            torch.save(state, os.path.join(tmp_dir, name))
+        with open(os.path.join(tmp_dir, TRAINER_STATE_NAME), "w", encoding="utf-8") as f:
+            f.write(trainer_state)
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        os.replace(tmp_dir, output_dir)
+        prune_checkpoints(run_dir, self.args.save_total_limit, keep)
+
+    def _save_checkpoint(self, model, trial):
+        if self.args.world_size > 1 or self.args.push_to_hub or not isinstance(self.model, PeftModel):
+            return super()._save_checkpoint(model, trial)
+
+        self.store_flos()
+        run_dir = self._get_output_dir(trial=trial)
+        output_dir = os.path.join(run_dir, f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}")
+        self._checkpoint_dirs.add(output_dir)
+        if self.state.best_global_step:
+            best_dir = os.path.join(run_dir, f"{PREFIX_CHECKPOINT_DIR}-{self.state.best_global_step}")
+            if best_dir in self._checkpoint_dirs or os.path.exists(best_dir):
+                self.state.best_model_checkpoint = best_dir
+        snapshot = self._snapshot(self.model)
+        # as in Trainer._save_checkpoint, stateful callbacks (e.g. early stopping) are saved with the trainer state
+        for cb in [cb for cb in self.callback_handler.callbacks + [self.control] if isinstance(cb, ExportableState)]:
+            cb_name = cb.__class__.__name__
+            if isinstance(self.state.stateful_callbacks[cb_name], list):
+                self.state.stateful_callbacks[cb_name].append(cb.state())
+            else:
+                self.state.stateful_callbacks[cb_name] = cb.state()
+        trainer_state = json.dumps(dataclasses.asdict(self.state), indent=2, sort_keys=True) + "\n"
+
+        self.wait_for_checkpoint()
+        self._pending = self._writer.submit(
+            self._write_checkpoint, snapshot, trainer_state, output_dir, (self.state.best_model_checkpoint,)
+        )
+
+    def _load_best_model(self):
+        self.wait_for_checkpoint()
+        return super()._load_best_model()
+
+    def train(self, *args, **kwargs):
+        try:
+            return super().train(*args, **kwargs)
+        finally:
+            self.wait_for_checkpoint()
+
+
+class AsyncCheckpointTrainer(AsyncCheckpointMixin, Trainer):
+    pass
@@ -0,0 +1,349 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+import pyarrow as pa
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.dedup import dedup_plan
+from common.manifest import SourceCache
+from common.prompts import PromptRegistry
+from common.splits import assign_split
+
+"""
+Canonical dataset store: the structured fields of every record written once, rendered to each model's format on read.
+
+One Arrow IPC file per split holds the records of both sources:
+    id, kind ("workflow" or "spec"), prompt_id,
+    instructions, metadata, workflow   compact JSON of the workflow records, null for spec ones
+    input, output                      the question and answer of spec records, null for workflow ones
+with the prompts in prompts.json (see common/prompts.py) and the counts in store.json.
+The prompt_id of a record is that of its raw prompt.md, which data_codet5 and
+data_starcoderbase prefix to the input as read. data_mistral uses a system prompt made
+of several files, stripped: store.json maps each raw prompt id to its system prompt id.
+The files are uncompressed and memory-mapped when loaded: nothing is parsed nor copied
+until rows are read, and renderers turn each batch of rows into a model's format:
+    chatml              {"id", "messages"} as data_mistral, system prompt included
+    input_output        {"input", "output"} as data_codet5, prompt prefixed to the input
+    question_response   {"id", "question", "response"} as the data_starcoderbase CSV
+
+    python common/dataset_store.py --output_dir data_store --wf_prompt_files .data/test_data_1/prompt.md WORKFLOW_SPEC.md
+
+    data = load_store("data_store", "chatml")
+    data["train"][0]["messages"]
+
+    render = store_renderer("data_store", "chatml")   # to render batches of stored rows yourself
+"""
+
+STORE_FILE = "store.json"
+SPLITS = ("train", "validation", "test")
+BATCH_SIZE = 8192
+
+SCHEMA = pa.schema(
+    [
+        ("id", pa.string()),
+        ("kind", pa.string()),
+        ("prompt_id", pa.string()),
+        ("instructions", pa.string()),
+        ("metadata", pa.string()),
+        ("workflow", pa.string()),
+        ("input", pa.string()),
+        ("output", pa.string()),
+    ]
+)
+
+# split of each record, picked from the hash of its near-duplicate cluster, as the prepare scripts do
+WF_SPLITS = [("train", 0.8), ("validation", 0.1), ("test", 0.1)]
+SPEC_SPLITS = [("train", 0.9), ("test", 0.1)]
+
+
+def compact_json(value):
+    # the separators and escaping of the data_codet5 inputs, so that they are rendered without parsing
+    return json.dumps(value, separators=(",", ":"))
+
+
+def split_path(store_dir, split):
+    return os.path.join(store_dir, f"{split}.arrow")
+
+
+def is_store(path):
+    return os.path.isfile(os.path.join(path, STORE_FILE))
+
+
+class StoreWriter:
+    """
+    One Arrow file per split, written in record batches of `batch_size` rows.
+        with StoreWriter("data_store") as out:
+            out.write("train", row)
+    """
+
+    def __init__(self, store_dir, splits=SPLITS, batch_size=BATCH_SIZE, info=None):
+        self.store_dir = store_dir
+        self.info = info or {}
+        self.splits = splits
+        self.batch_size = batch_size
+        self.files = {}
+        self.writers = {}
+        self.rows = {split: [] for split in splits}
+        self.counts = {split: 0 for split in splits}
+
+    def __enter__(self):
+        os.makedirs(self.store_dir, exist_ok=True)
+        for split in self.splits:
+            self.files[split] = pa.OSFile(split_path(self.store_dir, split), "wb")
+            self.writers[split] = pa.ipc.new_stream(self.files[split], SCHEMA)
+        return self
+
+    def write(self, split, row):
+        rows = self.rows[split]
+        rows.append(row)
+        self.counts[split] += 1
+        if len(rows) == self.batch_size:
+            self.flush(split)
+
+    def flush(self, split):
+        if self.rows[split]:
+            self.writers[split].write_batch(pa.RecordBatch.from_pylist(self.rows[split], schema=SCHEMA))
+            self.rows[split] = []
+
+    def __exit__(self, *exc):
+        for split in self.splits:
+            self.flush(split)
+            self.writers[split].close()
+            self.files[split].close()
+        with open(os.path.join(self.store_dir, STORE_FILE), "w", encoding="utf-8") as f:
+            json.dump({"splits": self.counts, **self.info}, f, indent=2)
+        return False
+
+
+def _rows(batch):
+    """The rows of a batch of columns, as dicts."""
+    columns = list(batch)
+    return [dict(zip(columns, values)) for values in zip(*batch.values())]
+
+
+class ChatMLRenderer:
+    """Rows rendered as the ChatML records of data_mistral/prepare.py, with the system prompt inlined."""
+
+    def __init__(self, prompts):
+        self.prompts = prompts
+
+    def user_content(self, row):
+        if row["kind"] == "spec":
+            return row["input"]
+        return f"""
+                ### Input:
+                {json.dumps(json.loads(row["instructions"]))}
+
+                ### Context:
+                {json.dumps(json.loads(row["metadata"]))}
+
+                ### Response:
+                """
+
+    def assistant_content(self, row):
+        return row["output"] if row["kind"] == "spec" else json.dumps(json.loads(row["workflow"]))
+
+    def __call__(self, batch):
+        rows = _rows(batch)
+        return {
+            "id": [row["id"] for row in rows],
+            "messages": [
+                [
+                    {"role": "system", "content": self.prompts.get(row["prompt_id"])},
+                    {"role": "user", "content": self.user_content(row)},
+                    {"role": "assistant", "content": self.assistant_content(row)},
+                ]
+                for row in rows
+            ],
+        }
+
+
+def input_output_pair(row):
+    """(input, output) texts of a row as data_codet5 and data_starcoderbase write them, without the prompt."""
+    if row["kind"] == "spec":
+        return row["input"], row["output"]
+    # the stored fields are already compact JSON
+    return '{"metadata":' + row["metadata"] + ',"instructions":' + row["instructions"] + "}", '{"workflow":' + row["workflow"] + "}"
+
+
+class InputOutputRenderer:
+    """Rows rendered as the input/output records of data_codet5/prepare.py, the prompt prefixed to the input."""
+
+    def __init__(self, prompts, separator="\n\n"):
+        self.prompts = prompts
+        self.separator = separator
+
+    def __call__(self, batch):
+        inputs, outputs = [], []
+        for row in _rows(batch):
+            text, output = input_output_pair(row)
+            inputs.append(self.prompts.get(row["prompt_id"]) + self.separator + text)
+            outputs.append(output)
+        return {"input": inputs, "output": outputs}
+
+
+class QuestionResponseRenderer:
+    """Rows rendered as the question/response rows of data_starcoderbase/prepare.py, without the prompt by default."""
+
+    def __init__(self, prompts, add_prompt=False, separator="\n\n"):
+        self.prompts = prompts
+        self.add_prompt = add_prompt
+        self.separator = separator
+
+    def __call__(self, batch):
+        rows = _rows(batch)
+        questions, responses = [], []
+        for row in rows:
+            text, output = input_output_pair(row)
+            questions.append(self.prompts.get(row["prompt_id"]) + self.separator + text if self.add_prompt else text)
+            responses.append(output)
+        return {"id": [row["id"] for row in rows], "question": questions, "response": responses}
+
+
+RENDERERS = {
+    "chatml": ChatMLRenderer,
+    "input_output": InputOutputRenderer,
+    "question_response": QuestionResponseRenderer,
+}
+
+
+def store_renderer(store_dir, name):
+    """The RENDERERS `name` of a store, with the prompts that format uses: the system prompts for chatml."""
+    prompts = PromptRegistry.load(store_dir)
+    if name == "chatml":
+        with open(os.path.join(store_dir, STORE_FILE), "r", encoding="utf-8") as f:
+            system_prompts = json.load(f).get("system_prompts", {})
+        prompts = PromptRegistry({pid: prompts.get(system_prompts.get(pid, pid)) for pid in prompts.prompts})
+    return RENDERERS[name](prompts)
+
+
+def load_store(store_dir, renderer=None, splits=None):
+    """
+    DatasetDict of the splits of a store, memory-mapped.
+    `renderer` is a RENDERERS name or any callable turning a batch of stored columns into a batch of another format;
+    rows are then rendered when they are read. To `map` over the rendered rows (e.g. to tokenize them), load the
+    store without renderer and call the renderer in the mapped function: the output of `map` keeps the transform.
+    """
+    from datasets import Dataset, DatasetDict
+
+    if isinstance(renderer, str):
+        renderer = store_renderer(store_dir, renderer)
+    data = DatasetDict()
+    for split in splits or SPLITS:
+        dataset = Dataset.from_file(split_path(store_dir, split))
+        data[split] = dataset.with_transform(renderer) if renderer is not None else dataset
+    return data
+
+
+def read_prompt(path):
+    # the prompt.md prefixed to the inputs as read by data_codet5 and data_starcoderbase, not stripped
+    if not os.path.exists(path):
+        return ""
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def read_system_prompt(files):
+    # the prompt files concatenated, as data_mistral/prepare.py makes its system prompts
+    text = ""
+    for file in files:
+        if os.path.exists(file):
+            with open(file, "r", encoding="utf-8") as f:
+                text += f.read() + "\n\n"
+    return text.strip()
+
+
+def load_wf_file(path):
+    with open(path, "r", encoding="utf-8") as f:
+        content = json.load(f)
+    return [
+        {
+            "id": key,
+            "instructions": compact_json(value.get("instructions", [])),
+            "metadata": compact_json(value.get("metadata", {})),
+            "workflow": compact_json(value.get("workflow", [])),
+        }
+        for key, value in content.items()
+    ]
+
+
+def load_spec_file(path):
+    with open(path, "r", encoding="utf-8") as f:
+        content = json.load(f)
+    return [
+        {
+            "id": hashlib.sha256((r["input"] + r["output"]).encode()).hexdigest(),
+            "input": r["input"],
+            "output": r["output"],
+        }
+        for r in content
+    ]
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--wf_dir", type=str, default=".data/test_data_1", help="data_*.json workflow files")
+    parser.add_argument("--spec_dir", type=str, default=".data/spec_data", help="spec_*.json files and validity_dataset.json")
+    parser.add_argument("--wf_prompt_files", nargs="+", default=None, help="concatenated into the workflow system prompt (chatml), <wf_dir>/prompt.md by default")
+    parser.add_argument("--spec_prompt_files", nargs="+", default=None, help="concatenated into the spec system prompt (chatml), <spec_dir>/prompt.md by default")
+    parser.add_argument("--output_dir", type=str, default="data_store")
+    parser.add_argument("--workers", type=int, default=None, help="processes parsing the source files, 1 to parse serially")
+    parser.add_argument("--split_salt", type=str, default="", help="change to draw a different, equally stable, split")
+    parser.add_argument("--dedup_threshold", type=float, default=0.8, help="MinHash similarity of near-duplicates, 0 to disable")
+    parser.add_argument("--keep_duplicates", action="store_true", help="keep every near-duplicate, still in its cluster's split")
+    return parser.parse_args()
+
+
+def main(args):
+    # parsed records of each source file, reused while the file content is unchanged
+    source_cache = SourceCache(os.path.join(args.output_dir, ".prep_cache"))
+    prompts = PromptRegistry()
+    wf_prompt_path = os.path.join(args.wf_dir, "prompt.md")
+    spec_prompt_path = os.path.join(args.spec_dir, "prompt.md")
+    wf_prompt_id = prompts.register(read_prompt(wf_prompt_path))
+    spec_prompt_id = prompts.register(read_prompt(spec_prompt_path))
+    system_prompts = {
+        wf_prompt_id: prompts.register(read_system_prompt(args.wf_prompt_files or [wf_prompt_path])),
+        spec_prompt_id: prompts.register(read_system_prompt(args.spec_prompt_files or [spec_prompt_path])),
+    }
+
+    wf_files = sorted(os.path.join(args.wf_dir, f) for f in os.listdir(args.wf_dir) if f.startswith("data_") and f.endswith(".json"))
+    spec_files = sorted(os.path.join(args.spec_dir, f) for f in os.listdir(args.spec_dir) if f.startswith("spec_") and f.endswith(".json"))
+    validity_file = os.path.join(args.spec_dir, "validity_dataset.json")
+
+    # (row, splits, split pinned for its near-duplicate cluster), the validity records being the validation set
+    def records():
+        for rows in source_cache.iter_many(wf_files, load_wf_file, args.workers):
+            for row in rows:
+                yield {**row, "kind": "workflow", "prompt_id": wf_prompt_id}, WF_SPLITS, None
+        for rows in source_cache.iter_many(spec_files, load_spec_file, args.workers):
+            for row in rows:
+                yield {**row, "kind": "spec", "prompt_id": spec_prompt_id}, SPEC_SPLITS, None
+        if os.path.exists(validity_file):
+            for row in source_cache.load(validity_file, load_spec_file):
+                yield {**row, "kind": "spec", "prompt_id": spec_prompt_id}, None, "validation"
+
+    def dedup_text(row):
+        # near-duplicates are found on what the model reads, not on the answer
+        return row["input"] if row["kind"] == "spec" else row["instructions"] + "\n" + row["metadata"]
+
+    plan = dedup_plan(((dedup_text(row), row["id"], pinned) for row, _, pinned in records()), args.dedup_threshold)
+    # one split per cluster, drawn from the splits of its first record: a cluster of workflow and spec
+    # records would otherwise be split with two different tables
+    cluster_splits = {}
+    with StoreWriter(args.output_dir, info={"system_prompts": system_prompts}) as out:
+        for (row, splits, _), (cluster, pinned, representative) in zip(records(), plan):
+            if representative or args.keep_duplicates:
+                split = pinned or cluster_splits.setdefault(cluster, assign_split(cluster, splits, args.split_salt))
+                out.write(split, row)
+    prompts.save(args.output_dir)
+    source_cache.save()
+    print(f"Wrote {sum(out.counts.values())} records to {args.output_dir}: {out.counts}")
+
+
+if __name__ == "__main__":
+    main(get_args())
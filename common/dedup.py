@@ -0,0 +1,152 @@
+import re
+import zlib
+
+import numpy as np
+
+"""
+Near-duplicate clustering of records with MinHash signatures and an LSH index, for the prepare scripts.
+
+Texts are normalized (lower case, digits folded to 0, punctuation dropped) and cut
+into word n-gram shingles; each record gets a MinHash signature estimating the Jaccard
+similarity of its shingle set. The signature is split into bands: records sharing a
+band land in the same bucket and become candidates, which are clustered with a
+union-find when their estimated similarity reaches the threshold. Work and memory grow
+linearly with the number of records (one signature each), not with the number of pairs.
+
+The prepare scripts read their sources twice: a first pass adds every record to the
+index, then `plan` tells for each record its cluster key, which picks the split so that
+a cluster never spans two splits, and whether it is the representative that is kept.
+Pinned records (the curated validation set) are never dropped as duplicates of others.
+
+    plan = dedup_plan(((dedup_text(r), record_id(r), None) for r in records()), threshold=0.8)
+    for record, (cluster_key, pinned_split, representative) in zip(records(), plan): ...
+"""
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+WORD = re.compile(r"[a-z]+|\d+")
+
+
+def normalize(text):
+    """Words of `text`, lower-cased with every number folded to 0 so that ids and values do not matter."""
+    return ["0" if w[0].isdigit() else w for w in WORD.findall(text.lower())]
+
+
+def shingles(text, ngram=3):
+    words = normalize(text)
+    if len(words) <= ngram:
+        return {" ".join(words)}
+    return {" ".join(words[i : i + ngram]) for i in range(len(words) - ngram + 1)}
+
+
+def lsh_bands(threshold, num_perm):
+    """(bands, rows) dividing `num_perm` whose S-curve midpoint (1/bands)^(1/rows) is the closest to `threshold`."""
+    candidates = [(b, num_perm // b) for b in range(1, num_perm + 1) if num_perm % b == 0]
+    return min(candidates, key=lambda br: abs((1 / br[0]) ** (1 / br[1]) - threshold))
+
+
+class UnionFind:
+    def __init__(self):
+        self.parent = []
+
+    def add(self):
+        self.parent.append(len(self.parent))
+
+    def find(self, i):
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def union(self, i, j):
+        """Merge the sets of i and j, the smaller root (earliest record) staying the root."""
+        ri, rj = self.find(i), self.find(j)
+        if ri != rj:
+            self.parent[max(ri, rj)] = min(ri, rj)
+
+
+class NearDuplicateIndex:
+    """
+    Cluster near-duplicate texts as they are added.
+        Args:
+            threshold (float): Estimated Jaccard similarity of the shingle sets above which two texts are duplicates.
+            num_perm (int): MinHash permutations, the signature length.
+            ngram (int): Words per shingle.
+            seed (int): Seed of the permutations, fixed so that clusters are reproducible.
+    """
+
+    def __init__(self, threshold=0.8, num_perm=128, ngram=3, seed=0):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.ngram = ngram
+        # S-curve below the threshold for recall, the candidates being confirmed on the whole signature
+        self.bands, self.rows = lsh_bands(0.9 * threshold, num_perm)
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.buckets = [{} for _ in range(self.bands)]
+        self.signatures = []
+        self.keys = []
+        self.pinned = {}
+        self.clusters = UnionFind()
+
+    def signature(self, text):
+        hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles(text, self.ngram)), dtype=np.uint64)
+        # (a * h + b) mod p, wrapping in 64 bits like datasketch, then truncated to 32 bits
+        permuted = (np.outer(self.a, hashes) + self.b[:, None]) % np.uint64(MERSENNE_PRIME) & np.uint64(MAX_HASH)
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def add(self, text, key, pinned_split=None):
+        """
+        Index the record `key` by `text`. A `pinned_split` (e.g. a fixed validation set) is given to its whole cluster.
+        Returns the index of the record.
+        """
+        i = len(self.keys)
+        signature = self.signature(text)
+        self.signatures.append(signature)
+        self.keys.append(key)
+        self.clusters.add()
+        if pinned_split is not None:
+            self.pinned[i] = pinned_split
+        for band, bucket in enumerate(self.buckets):
+            band_key = signature[band * self.rows : (band + 1) * self.rows].tobytes()
+            first = bucket.setdefault(band_key, i)
+            # LSH candidates are confirmed on the whole signature, which drops most false positives
+            if first != i and np.mean(self.signatures[first] == signature) >= self.threshold:
+                self.clusters.union(first, i)
+        return i
+
+    def plan(self):
+        """
+        (cluster key, pinned split or None, representative) for each record in the order they were added.
+        The cluster key is the key of its first record. That record is the representative, unless the cluster
+        has pinned records (a curated set): then every pinned record is kept and the others are the duplicates.
+        """
+        roots = [self.clusters.find(i) for i in range(len(self.keys))]
+        pinned = {}
+        for i, split in self.pinned.items():
+            pinned.setdefault(roots[i], split)
+        return [
+            (self.keys[root], pinned.get(root), i in self.pinned if root in pinned else root == i)
+            for i, root in enumerate(roots)
+        ]
+
+    def summary(self):
+        clusters = len({self.clusters.find(i) for i in range(len(self.keys))})
+        return f"{len(self.keys)} records in {clusters} near-duplicate clusters (threshold {self.threshold}, {self.bands} bands of {self.rows})"
+
+
+def dedup_plan(records, threshold=0.8, **kwargs):
+    """
+    `NearDuplicateIndex.plan` of `records`, an iterable of (text, key, pinned split or None).
+    A threshold of 0 or None disables the clustering: every record is its own cluster.
+    """
+    if not threshold:
+        return [(key, pinned_split, True) for _, key, pinned_split in records]
+    index = NearDuplicateIndex(threshold, **kwargs)
+    for text, key, pinned_split in records:
+        index.add(text, key, pinned_split)
+    print(index.summary())
+    return index.plan()
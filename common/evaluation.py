@@ -0,0 +1,333 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.inference import PROMPT_FORMATS, PrefixCachedGenerator, format_request
+from common.manifest import file_sha256
+from common.prompts import PROMPTS_FILE, PromptRegistry
+
+"""
+Score a fine-tuned model on a prepared test split by generating the answers and comparing the workflows.
+
+Reads ChatML records (data_mistral, the answer being the last assistant message) and
+input/output records (data_codet5, prompted as input + eos as in training). ChatML prompts
+are rendered as in training: in the [INST] format of finetune_mistral.ipynb by default, or
+with the tokenizer chat template (--prompt_format chat_template). Answers are
+generated in batches of similar prompt length, the shared system prompt being prefilled
+once (common/inference.py). The model is a merged model or an adapter directory.
+
+Reported metrics:
+    valid                 the answer parses as a workflow: a JSON list of actions, or {"workflow": [...]}
+    exact_match           same workflow as the reference, ignoring the free-text "comment" fields
+    exact_match_strict    same workflow including the comments
+    action_accuracy       share of the reference actions matched at their position (comments ignored)
+    action_name_accuracy  same, comparing only the action names
+    text_exact_match      answer text equal to the reference, for the references that are not workflows
+and the generation latency of each batch and the throughput in generated tokens/s.
+
+Generations are cached in --cache_dir keyed by (model hash, prompt and generation settings hash),
+so re-scoring after a metric change, or resuming an interrupted run, generates nothing again.
+A --draft_model_path (speculative decoding) only changes the latency of greedy answers, not the key.
+
+    python common/evaluation.py --model_path ./mistral-merged data_mistral/wf_test_data.jsonl
+    python common/evaluation.py --model_path ./codet5-lora data_codet5/test_data.jsonl --output eval.json
+"""
+
+WEIGHT_SUFFIXES = (".safetensors", ".bin", ".pt", ".json", ".model")
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="+", help="prepared test splits (JSONL)")
+    parser.add_argument("--model_path", type=str, required=True, help="merged model or adapter directory, or Hub id")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--max_new_tokens", type=int, default=1024)
+    parser.add_argument("--draft_model_path", type=str, default=None, help="small model drafting tokens (common/speculative.py)")
+    parser.add_argument("--json_output", action="store_true", help="constrained JSON decoding (common/json_decoding.py)")
+    parser.add_argument(
+        "--prompt_format", type=str, default="inst", choices=PROMPT_FORMATS,
+        help="render ChatML prompts as in training: inst (finetune_mistral.ipynb) or the tokenizer chat template",
+    )
+    parser.add_argument("--limit", type=int, default=None, help="evaluate only the first samples of each file")
+    parser.add_argument("--cache_dir", type=str, default=".eval_cache")
+    parser.add_argument("--output", type=str, default=None, help="JSON file of the metrics")
+    parser.add_argument("--predictions", type=str, default=None, help="JSONL file of the answers and their scores")
+    return parser.parse_args()
+
+
+def read_samples(path, limit=None):
+    """(prompt, reference) of every record of a prepared split; prompts are message lists or input texts."""
+    prompts_path = os.path.join(os.path.dirname(path), PROMPTS_FILE)
+    registry = PromptRegistry.load(prompts_path) if os.path.exists(prompts_path) else PromptRegistry()
+    samples = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = registry.expand(json.loads(line))
+            if "messages" in record:
+                messages = record["messages"]
+                last = max(i for i, m in enumerate(messages) if m["role"] == "assistant")
+                samples.append((messages[:last], messages[last]["content"]))
+            else:
+                samples.append((record["input"], record["output"]))
+            if limit is not None and len(samples) == limit:
+                break
+    return samples
+
+
+def parse_workflow(text):
+    """List of actions of a workflow answer, None if it is not valid JSON or not a workflow."""
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[-1].rsplit("```", 1)[0]
+    try:
+        obj = json.loads(text)
+    except json.JSONDecodeError:
+        return None
+    if isinstance(obj, dict):
+        obj = obj.get("workflow")
+    if not isinstance(obj, list) or not all(isinstance(a, dict) and isinstance(a.get("action"), str) for a in obj):
+        return None
+    return obj
+
+
+def without_comments(action):
+    return {k: v for k, v in action.items() if k != "comment"}
+
+
+def score(prediction, reference):
+    """Metrics of one answer against its reference."""
+    expected = parse_workflow(reference)
+    if expected is None:
+        return {"text_exact_match": prediction.strip() == reference.strip()}
+    actions = parse_workflow(prediction)
+    if actions is None:
+        actions = []
+        valid = False
+    else:
+        valid = True
+    matched = sum(1 for a, b in zip(actions, expected) if without_comments(a) == without_comments(b))
+    names = sum(1 for a, b in zip(actions, expected) if a["action"] == b["action"])
+    return {
+        "valid": valid,
+        "exact_match": valid and [without_comments(a) for a in actions] == [without_comments(b) for b in expected],
+        "exact_match_strict": valid and actions == expected,
+        "matched_actions": matched,
+        "matched_action_names": names,
+        "reference_actions": len(expected),
+    }
+
+
+def aggregate(scores):
+    """Metrics over a split: rates for the per-sample flags, micro-averaged action accuracies."""
+    workflows = [s for s in scores if "valid" in s]
+    texts = [s for s in scores if "text_exact_match" in s]
+    metrics = {"samples": len(scores), "workflow_samples": len(workflows), "text_samples": len(texts)}
+    if workflows:
+        total = max(sum(s["reference_actions"] for s in workflows), 1)
+        for key in ("valid", "exact_match", "exact_match_strict"):
+            metrics[key] = float(np.mean([s[key] for s in workflows]))
+        metrics["action_accuracy"] = sum(s["matched_actions"] for s in workflows) / total
+        metrics["action_name_accuracy"] = sum(s["matched_action_names"] for s in workflows) / total
+    if texts:
+        metrics["text_exact_match"] = float(np.mean([s["text_exact_match"] for s in texts]))
+    return metrics
+
+
+def model_hash(model_path, memo_path):
+    """
+    Hash of the files of a local model directory (weights, configs, tokenizer), memoized by size and
+    modification time in `memo_path`; Hub ids are hashed by name.
+    """
+    if not os.path.isdir(model_path):
+        return hashlib.sha256(model_path.encode("utf-8")).hexdigest()[:16]
+    memo = {}
+    if os.path.exists(memo_path):
+        with open(memo_path, "r", encoding="utf-8") as f:
+            memo = json.load(f)
+    h = hashlib.sha256()
+    for name in sorted(os.listdir(model_path)):
+        path = os.path.join(model_path, name)
+        if not (os.path.isfile(path) and name.endswith(WEIGHT_SUFFIXES)):
+            continue
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        entry = memo.get(key)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            entry = {"sha256": file_sha256(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+            memo[key] = entry
+        h.update(f"{name}:{entry['sha256']}\n".encode("utf-8"))
+    with open(memo_path, "w", encoding="utf-8") as f:
+        json.dump(memo, f, indent=2)
+    return h.hexdigest()[:16]
+
+
+class GenerationCache:
+    """Generated answers of one model, appended to `<cache_dir>/<model hash>.jsonl` and keyed by prompt hash."""
+
+    def __init__(self, cache_dir, model_fingerprint):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, f"{model_fingerprint}.jsonl")
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries[entry["key"]] = entry
+
+    @staticmethod
+    def key(prompt, generate_kwargs):
+        payload = json.dumps([prompt, generate_kwargs], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def add(self, entries):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for entry in entries:
+                self.entries[entry["key"]] = entry
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def is_adapter(model_path):
+    return os.path.exists(os.path.join(model_path, "adapter_config.json"))
+
+
+def load_tokenizer(model_path):
+    """Tokenizer of the model, that of the base model for an adapter saved without one."""
+    from transformers import AutoTokenizer
+
+    if is_adapter(model_path) and not os.path.exists(os.path.join(model_path, "tokenizer_config.json")):
+        from peft import PeftConfig
+
+        return AutoTokenizer.from_pretrained(PeftConfig.from_pretrained(model_path).base_model_name_or_path)
+    return AutoTokenizer.from_pretrained(model_path)
+
+
+def load_model(model_path):
+    """A merged model, or an adapter directory on top of its base model."""
+    import torch
+    from transformers import AutoModelForCausalLM
+
+    kwargs = {"torch_dtype": "auto", "device_map": "auto" if torch.cuda.is_available() else None}
+    if is_adapter(model_path):
+        from peft import AutoPeftModelForCausalLM
+
+        model = AutoPeftModelForCausalLM.from_pretrained(model_path, **kwargs)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(model_path, **kwargs)
+    return model.eval()
+
+
+def prompt_request(prompt, tokenizer, prompt_format="inst"):
+    """
+    Generator request of a sample, as prompted in training: the messages rendered in `prompt_format`,
+    or the input followed by eos.
+    """
+    return format_request(prompt, prompt_format) if isinstance(prompt, list) else prompt + tokenizer.eos_token
+
+
+def generate_answers(get_generator, cache, requests, batch_size, generate_kwargs):
+    """
+    Answer of each request, from the cache or generated in batches of similar length by `get_generator()`.
+    Returns the cache entries in the order of the requests and the time and tokens of the generated batches.
+    """
+    keys = [GenerationCache.key(r, generate_kwargs) for r in requests]
+    # one generation per distinct prompt, shortest first
+    missing = {k: i for i, k in enumerate(keys) if cache.get(k) is None}
+    missing = sorted(missing.values(), key=lambda i: len(json.dumps(requests[i])))
+    latencies = []
+    for start in range(0, len(missing), batch_size):
+        generator = get_generator()
+        batch = missing[start : start + batch_size]
+        tokens_before = generator.generated_tokens
+        t0 = time.perf_counter()
+        texts = generator.generate([requests[i] for i in batch], **generate_kwargs)
+        seconds = time.perf_counter() - t0
+        latencies.append({"seconds": seconds, "tokens": generator.generated_tokens - tokens_before, "size": len(batch)})
+        cache.add({"key": keys[i], "text": text, "batch_seconds": seconds} for i, text in zip(batch, texts))
+        print(f"  batch {start // batch_size + 1}/{-(-len(missing) // batch_size)}: {len(batch)} answers in {seconds:.1f}s")
+    return [cache.get(k) for k in keys], latencies
+
+
+def timing_metrics(latencies):
+    if not latencies:
+        return {"generated_batches": 0}
+    seconds = np.array([b["seconds"] for b in latencies])
+    tokens = sum(b["tokens"] for b in latencies)
+    return {
+        "generated_batches": len(latencies),
+        "generated_answers": sum(b["size"] for b in latencies),
+        "batch_latency_mean_s": float(seconds.mean()),
+        "batch_latency_p50_s": float(np.percentile(seconds, 50)),
+        "batch_latency_p95_s": float(np.percentile(seconds, 95)),
+        "generated_tokens": tokens,
+        "tokens_per_second": tokens / max(float(seconds.sum()), 1e-9),
+    }
+
+
+def main(args):
+    os.makedirs(args.cache_dir, exist_ok=True)
+    fingerprint = model_hash(args.model_path, os.path.join(args.cache_dir, "model_hashes.json"))
+    cache = GenerationCache(args.cache_dir, fingerprint)
+    generate_kwargs = {"max_new_tokens": args.max_new_tokens, "do_sample": False, "json_output": args.json_output}
+    tokenizer = load_tokenizer(args.model_path)
+    generator = None
+
+    def get_generator():
+        # the model is only loaded once something has to be generated
+        nonlocal generator
+        if generator is None and args.draft_model_path:
+            from common.speculative import SpeculativeGenerator
+
+            draft = load_model(args.draft_model_path), load_tokenizer(args.draft_model_path)
+            generator = SpeculativeGenerator(load_model(args.model_path), tokenizer, *draft)
+        elif generator is None:
+            generator = PrefixCachedGenerator(load_model(args.model_path), tokenizer, batch_size=args.batch_size)
+        return generator
+
+    results = {
+        "model_path": args.model_path,
+        "model_hash": fingerprint,
+        "prompt_format": args.prompt_format,
+        "generation": generate_kwargs,
+        "splits": {},
+    }
+    predictions = []
+    for path in args.files:
+        samples = read_samples(path, args.limit)
+        print(f"{path}: {len(samples)} samples")
+        requests = [prompt_request(prompt, tokenizer, args.prompt_format) for prompt, _ in samples]
+        entries, latencies = generate_answers(get_generator, cache, requests, args.batch_size, generate_kwargs)
+        scores = [score(entry["text"], reference) for entry, (_, reference) in zip(entries, samples)]
+        metrics = {**aggregate(scores), **timing_metrics(latencies)}
+        results["splits"][path] = metrics
+        for key, value in metrics.items():
+            print(f"  {key:<24} {value:.4f}" if isinstance(value, float) else f"  {key:<24} {value}")
+        for entry, (_, reference), s in zip(entries, samples, scores):
+            predictions.append({"file": path, "prediction": entry["text"], "reference": reference, **s})
+
+    if generator is not None:
+        results["generator"] = generator.stats()
+        print(f"Generation: {generator.stats()}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.predictions:
+        with open(args.predictions, "w", encoding="utf-8") as f:
+            for p in predictions:
+                f.write(json.dumps(p, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main(get_args())
@@ -0,0 +1,335 @@
+import argparse
+import json
+import os
+import sys
+from collections import OrderedDict
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.json_decoding import json_generation_kwargs
+from common.tokenization import inst_pair
+
+"""
+Batched chat generation reusing the KV cache of shared system prompts.
+
+Workflow-generation requests all start with the same long TWL system prompt. The
+rendered prompt of each request is split at the start of its first user message:
+the KV cache of that prefix is computed once and kept in an LRU cache, so a request
+only prefills its own user content. Requests with the same prefix are generated in
+batches, the prefix cache being shared by every row of the batch and the user
+contents padded between the prefix and themselves (the attention mask hides the padding).
+
+The token ids fed to the model are those of the full rendered prompt, so outputs are
+the same as without the cache; the prefix is cut at a token boundary of the full prompt.
+
+Messages are rendered with the tokenizer chat template, or, with --prompt_format inst, in
+the [INST] format the Mistral notebook trains on (`inst_request`, common/tokenization.py).
+
+    generator = PrefixCachedGenerator(model, tokenizer)
+    texts = generator.generate([messages, ...], max_new_tokens=256, do_sample=True)
+
+    python common/inference.py --model_path ./mistral-merged sample_prompt.json
+    python common/inference.py --model_path ./mistral-merged --draft_model_path ./starcoder-merged sample_prompt.json
+    python common/inference.py --model_path ./mistral-merged --model_cache_dir .model_cache --quantization 4bit sample_prompt.json
+"""
+
+SENTINEL = "\x00PREFIX_END\x00"
+PROMPT_FORMATS = ("inst", "chat_template")
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="+", help="JSON files of one request or JSONL files of requests, each with a 'messages' list")
+    parser.add_argument("--model_path", type=str, default="./mistral-merged")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--cache_size", type=int, default=8, help="distinct prefixes kept in the KV cache")
+    parser.add_argument("--max_new_tokens", type=int, default=256)
+    parser.add_argument("--do_sample", action="store_true")
+    parser.add_argument("--draft_model_path", type=str, default=None, help="small model drafting tokens (speculative decoding)")
+    parser.add_argument("--num_draft_tokens", type=int, default=None, help="tokens drafted per step, adaptive if unset")
+    parser.add_argument("--json_output", action="store_true", help="constrain the answers to JSON and stop them once closed")
+    parser.add_argument(
+        "--prompt_format", type=str, default="inst", choices=PROMPT_FORMATS,
+        help="render the messages as in training: inst (finetune_mistral.ipynb) or the tokenizer chat template",
+    )
+    parser.add_argument("--output", type=str, default=None, help="JSONL file of the generations, printed if unset")
+    parser.add_argument("--model_cache_dir", type=str, default=None, help="load the models from this cache (common/model_cache.py), built on the first run")
+    parser.add_argument("--quantization", type=str, default=None, choices=["8bit", "4bit"], help="with --model_cache_dir, serve the model quantized")
+    return parser.parse_args()
+
+
+def prompt_messages(messages):
+    """Messages to prompt the model with: the conversation without its final assistant answer, if any."""
+    if messages and messages[-1]["role"] == "assistant":
+        return messages[:-1]
+    return messages
+
+
+def split_prefix(tokenizer, messages):
+    """
+    Rendered prompt of `messages` with the generation prompt, and the text preceding the content of its first
+    user message (the shared system prompt), "" if the template does not render it as a prefix.
+    """
+    text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    first_user = next((i for i, m in enumerate(messages) if m["role"] == "user"), None)
+    if first_user is None:
+        return text, ""
+    marked = [dict(m) for m in messages]
+    marked[first_user]["content"] = SENTINEL + marked[first_user]["content"]
+    rendered = tokenizer.apply_chat_template(marked, tokenize=False, add_generation_prompt=True)
+    prefix = rendered.split(SENTINEL, 1)[0]
+    return text, prefix if SENTINEL in rendered and text.startswith(prefix) else ""
+
+
+def inst_request(messages):
+    """
+    Request of `messages` rendered in the [INST] format of training (`inst_pair`): the prompt text, and the text
+    preceding the content of its first user message (the shared system prompt) as its prefix.
+    """
+    messages = prompt_messages(messages)
+    text, _ = inst_pair(messages)
+    first_user = next((i for i, m in enumerate(messages) if m["role"] == "user"), None)
+    if first_user is None:
+        return {"prompt": text, "prefix": ""}
+    marked = [dict(m) for m in messages]
+    marked[first_user]["content"] = SENTINEL + marked[first_user]["content"].strip()
+    prefix = inst_pair(marked)[0].split(SENTINEL, 1)[0]
+    return {"prompt": text, "prefix": prefix if text.startswith(prefix) else ""}
+
+
+def format_request(request, prompt_format="chat_template"):
+    """`request` with its messages rendered in `prompt_format`; chat_template requests are rendered by the generators."""
+    messages = request.get("messages") if isinstance(request, dict) else request
+    if prompt_format == "inst" and isinstance(messages, list):
+        return inst_request(messages)
+    return request
+
+
+def encode_text(tokenizer, text):
+    """Ids of a plain prompt; a prompt already starting with the BOS token (a rendered one) gets no special tokens."""
+    bos = tokenizer.bos_token
+    return tokenizer(text, add_special_tokens=not (bos and text.startswith(bos)))["input_ids"]
+
+
+def expand_past(past, batch_size):
+    """Past key values of one sequence broadcast to `batch_size` rows, whatever their (nested tuple) layout."""
+    if isinstance(past, torch.Tensor):
+        return past.expand(batch_size, *past.shape[1:])
+    return tuple(expand_past(p, batch_size) for p in past)
+
+
+def generated_length(ids, eos_token_id):
+    """Tokens generated in a row of a batch, up to its first end of sequence included; the rest is padding."""
+    eos = set(eos_token_id) if isinstance(eos_token_id, (list, tuple)) else {eos_token_id}
+    for i, token in enumerate(ids):
+        if token in eos:
+            return i + 1
+    return len(ids)
+
+
+def common_length(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class PrefixCache:
+    """
+    LRU cache of the KV cache of prompt prefixes, keyed by their token ids.
+    Entries are kept in the legacy tuple format, with whether the model returned a Cache object.
+    """
+
+    def __init__(self, model, max_entries=8):
+        self.model = model
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+
+    @torch.no_grad()
+    def get(self, prefix_ids):
+        key = tuple(prefix_ids)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.saved_tokens += len(key)
+            return self.entries[key]
+        self.misses += 1
+        input_ids = torch.tensor([prefix_ids], device=self.model.device)
+        outputs = self.model(input_ids=input_ids, use_cache=True)
+        past = outputs.past_key_values
+        is_cache = hasattr(past, "to_legacy_cache")
+        entry = (past.to_legacy_cache() if is_cache else past, is_cache)
+        self.entries[key] = entry
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry
+
+
+class PrefixCachedGenerator:
+    """
+    Generate chat completions with a decoder-only model, prefilling each distinct system prompt once.
+        Args:
+            model: Causal LM supporting `past_key_values` in `generate` (Mistral, Llama, GPTBigCode...).
+            tokenizer: Its tokenizer, with a chat template.
+            batch_size (int): Requests generated together.
+            cache_size (int): Distinct prefixes kept in the LRU cache.
+            min_prefix_tokens (int): Shorter prefixes are not worth caching and are prefilled with the request.
+    """
+
+    def __init__(self, model, tokenizer, batch_size=8, cache_size=8, min_prefix_tokens=32):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.min_prefix_tokens = min_prefix_tokens
+        self.cache = PrefixCache(model, max_entries=cache_size)
+        self.generated_tokens = 0
+        pad_token_id = tokenizer.pad_token_id
+        self.pad_token_id = pad_token_id if pad_token_id is not None else tokenizer.eos_token_id
+
+    def encode(self, request):
+        """
+        (prefix ids, full prompt ids) of a request; the prefix ids are a prefix of the full ones, maybe empty.
+        A request is a list of chat messages or a dict with "messages", rendered with the chat template,
+        a rendered prompt {"prompt": text, "prefix": its shared start} (see `inst_request`),
+        or a plain prompt string tokenized as is, without prefix.
+        """
+        if isinstance(request, str):
+            return [], encode_text(self.tokenizer, request)
+        if isinstance(request, dict) and "prompt" in request:
+            text, prefix = request["prompt"], request.get("prefix", "")
+            ids = encode_text(self.tokenizer, text)
+        else:
+            messages = request["messages"] if isinstance(request, dict) else request
+            text, prefix = split_prefix(self.tokenizer, prompt_messages(messages))
+            # the chat template renders the special tokens
+            ids = self.tokenizer(text, add_special_tokens=False)["input_ids"]
+        prefix_ids = self.tokenizer(prefix, add_special_tokens=False)["input_ids"] if prefix else []
+        # a token may straddle the end of the prefix text, and at least one token must be left to prefill
+        n = min(common_length(prefix_ids, ids), len(ids) - 1)
+        if n < self.min_prefix_tokens:
+            n = 0
+        return ids[:n], ids
+
+    @torch.no_grad()
+    def _generate_batch(self, prefix_ids, batch_ids, json_output=False, **generate_kwargs):
+        P = len(prefix_ids)
+        suffixes = [ids[P:] for ids in batch_ids]
+        width = max(len(s) for s in suffixes)
+        rows, mask = [], []
+        for suffix in suffixes:
+            pad = width - len(suffix)
+            rows.append(prefix_ids + [self.pad_token_id] * pad + suffix)
+            mask.append([1] * P + [0] * pad + [1] * len(suffix))
+        device = self.model.device
+        inputs = {
+            "input_ids": torch.tensor(rows, device=device),
+            "attention_mask": torch.tensor(mask, device=device),
+        }
+        if P:
+            from transformers import DynamicCache
+
+            past, is_cache = self.cache.get(prefix_ids)
+            # generate concatenates into new tensors, the cached ones are only read
+            past = expand_past(past, len(rows))
+            inputs["past_key_values"] = DynamicCache.from_legacy_cache(past) if is_cache else past
+        generate_kwargs.setdefault("pad_token_id", self.pad_token_id)
+        if json_output:
+            generate_kwargs.update(json_generation_kwargs(self.tokenizer))
+        outputs = self.model.generate(**inputs, **generate_kwargs)
+        generated = outputs[:, P + width :].tolist()
+        eos = generate_kwargs.get("eos_token_id", self.model.generation_config.eos_token_id)
+        self.generated_tokens += sum(generated_length(ids, eos) for ids in generated)
+        return generated
+
+    def generate(self, requests, skip_special_tokens=True, **generate_kwargs):
+        """
+        Completion text of each request, in order.
+        A request is a list of chat messages, a dict with "messages", a rendered {"prompt", "prefix"} or a plain prompt string.
+        `generate_kwargs` are passed to `model.generate` (max_new_tokens, do_sample, temperature...), and
+        `json_output=True` constrains each answer to one JSON object or array, stopped as soon as it closes.
+        """
+        encoded = [self.encode(r) for r in requests]
+        # same prefix together, then by length so that little padding is needed
+        order = sorted(range(len(encoded)), key=lambda i: (encoded[i][0], len(encoded[i][1])))
+        results = [None] * len(encoded)
+        start = 0
+        while start < len(order):
+            prefix_ids = encoded[order[start]][0]
+            end = start + 1
+            while end < len(order) and end - start < self.batch_size and encoded[order[end]][0] == prefix_ids:
+                end += 1
+            batch = order[start:end]
+            generated = self._generate_batch(prefix_ids, [encoded[i][1] for i in batch], **generate_kwargs)
+            for i, ids in zip(batch, generated):
+                results[i] = self.tokenizer.decode(ids, skip_special_tokens=skip_special_tokens)
+            start = end
+        return results
+
+    def stats(self):
+        return {
+            "hits": self.cache.hits,
+            "misses": self.cache.misses,
+            "saved_prefill_tokens": self.cache.saved_tokens,
+            "generated_tokens": self.generated_tokens,
+        }
+
+
+def read_requests(files):
+    requests = []
+    for path in files:
+        with open(path, "r", encoding="utf-8") as f:
+            if path.endswith(".jsonl"):
+                requests.extend(json.loads(line) for line in f if line.strip())
+            else:
+                requests.append(json.load(f))
+    return requests
+
+
+def main(args):
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    def load_model(path, quantization=None):
+        if args.model_cache_dir:
+            from common.model_cache import load_cached_model
+
+            return load_cached_model(path, args.model_cache_dir, quantization=quantization, device_map="auto")
+        return AutoModelForCausalLM.from_pretrained(path, torch_dtype="auto", device_map="auto")
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path)
+    model = load_model(args.model_path, args.quantization)
+    model.eval()
+    if args.draft_model_path:
+        from common.speculative import SpeculativeGenerator
+
+        draft_tokenizer = AutoTokenizer.from_pretrained(args.draft_model_path)
+        draft_model = load_model(args.draft_model_path)
+        generator = SpeculativeGenerator(
+            model, tokenizer, draft_model.eval(), draft_tokenizer, num_draft_tokens=args.num_draft_tokens
+        )
+    else:
+        generator = PrefixCachedGenerator(model, tokenizer, batch_size=args.batch_size, cache_size=args.cache_size)
+    requests = read_requests(args.files)
+    texts = generator.generate(
+        [format_request(r, args.prompt_format) for r in requests],
+        max_new_tokens=args.max_new_tokens,
+        do_sample=args.do_sample,
+        json_output=args.json_output,
+    )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            for request, text in zip(requests, texts):
+                f.write(json.dumps({"id": request.get("id"), "generated_text": text}, ensure_ascii=False) + "\n")
+    else:
+        for text in texts:
+            print(text)
+    print(f"Generation: {generator.stats()}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main(get_args())
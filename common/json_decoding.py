@@ -0,0 +1,238 @@
+import re
+from functools import lru_cache
+
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+
+"""
+JSON-constrained generation: only tokens that keep the answer a valid JSON prefix are sampled,
+and each sequence stops as soon as its top-level object or array closes.
+
+A character-level pushdown automaton tracks the brackets, strings, numbers and literals
+of each sequence, one generated token at a time. At each step the highest scoring
+candidates are checked in order and all but the first `top_k` valid ones are masked, so
+greedy decoding checks a handful of tokens instead of the whole vocabulary. If none of
+the `max_candidates` best tokens fits, the sequence is left unconstrained from then on.
+
+    processor = JsonLogitsProcessor(tokenizer)
+    model.generate(**inputs, logits_processor=[processor], stopping_criteria=[JsonStoppingCriteria(processor)])
+
+The top-level value must be an object or an array, which is what the workflow answers are.
+"""
+
+WHITESPACE = " \t\n\r"
+HEX_DIGITS = set("0123456789abcdefABCDEF")
+NUMBER_CHARS = set("-+.eE0123456789")
+NUMBER_PREFIX = re.compile(r"-|-?(0|[1-9]\d*)(\.|\.\d+|\.\d+[eE][+-]?\d*|[eE][+-]?\d*)?")
+NUMBER = re.compile(r"-?(0|[1-9]\d*)(\.\d+)?([eE][+-]?\d+)?")
+LITERALS = {"t": "rue", "f": "alse", "n": "ull"}
+ESCAPES = set('"\\/bfnrtu')
+
+# modes of the automaton, a state being an immutable (mode, stack, aux) tuple
+START, VALUE, ARRAY_FIRST, OBJECT_FIRST, KEY, COLON, AFTER, STRING, ESCAPE, UNICODE, NUMBER_MODE, LITERAL, DONE = range(13)
+INITIAL_STATE = (START, (), None)
+
+
+def _after_value(stack):
+    return (AFTER, stack, None) if stack else (DONE, stack, None)
+
+
+def _start_value(ch, stack):
+    if ch == "{":
+        return (OBJECT_FIRST, stack + ("{",), None)
+    if ch == "[":
+        return (ARRAY_FIRST, stack + ("[",), None)
+    if ch == '"':
+        return (STRING, stack, False)
+    if ch == "-" or ch.isdigit():
+        return (NUMBER_MODE, stack, ch)
+    if ch in LITERALS:
+        return (LITERAL, stack, LITERALS[ch])
+    return None
+
+
+def step(state, ch):
+    """State after reading `ch`, None if `ch` cannot continue a valid JSON value."""
+    mode, stack, aux = state
+    if mode == STRING:
+        if ch == '"':
+            return (COLON, stack, None) if aux else _after_value(stack)
+        if ch == "\\":
+            return (ESCAPE, stack, aux)
+        return None if ord(ch) < 0x20 else state
+    if mode == ESCAPE:
+        if ch not in ESCAPES:
+            return None
+        return (UNICODE, stack, (aux, 4)) if ch == "u" else (STRING, stack, aux)
+    if mode == UNICODE:
+        if ch not in HEX_DIGITS:
+            return None
+        is_key, remaining = aux
+        return (STRING, stack, is_key) if remaining == 1 else (UNICODE, stack, (is_key, remaining - 1))
+    if mode == NUMBER_MODE:
+        if ch in NUMBER_CHARS and NUMBER_PREFIX.fullmatch(aux + ch):
+            return (NUMBER_MODE, stack, aux + ch)
+        if not NUMBER.fullmatch(aux):
+            return None
+        return step(_after_value(stack), ch)
+    if mode == LITERAL:
+        if ch != aux[0]:
+            return None
+        return (LITERAL, stack, aux[1:]) if len(aux) > 1 else _after_value(stack)
+
+    if ch in WHITESPACE:
+        return state
+    if mode == START:
+        return _start_value(ch, stack) if ch in "{[" else None
+    if mode == VALUE:
+        return _start_value(ch, stack)
+    if mode == ARRAY_FIRST:
+        return _after_value(stack[:-1]) if ch == "]" else _start_value(ch, stack)
+    if mode == OBJECT_FIRST:
+        if ch == "}":
+            return _after_value(stack[:-1])
+        return (STRING, stack, True) if ch == '"' else None
+    if mode == KEY:
+        return (STRING, stack, True) if ch == '"' else None
+    if mode == COLON:
+        return (VALUE, stack, None) if ch == ":" else None
+    if mode == AFTER:
+        if ch == ",":
+            return (KEY, stack, None) if stack[-1] == "{" else (VALUE, stack, None)
+        if (ch == "}" and stack[-1] == "{") or (ch == "]" and stack[-1] == "["):
+            return _after_value(stack[:-1])
+        return None
+    # DONE: only trailing whitespace
+    return None
+
+
+def advance(state, text):
+    """State after reading `text`, None if it cannot continue a valid JSON value."""
+    for ch in text:
+        state = step(state, ch)
+        if state is None:
+            return None
+    return state
+
+
+def is_complete(state):
+    return state is not None and state[0] == DONE
+
+
+@lru_cache(maxsize=4)
+def token_texts(tokenizer):
+    """
+    Text each token adds when decoded after others (sentencepiece drops the leading space of a lone token),
+    None for special tokens and tokens decoding to nothing.
+    """
+    anchor = tokenizer.encode("a", add_special_tokens=False)
+    base = tokenizer.decode(anchor)
+    special = set(tokenizer.all_special_ids)
+    size = len(tokenizer)
+    decoded = tokenizer.batch_decode([anchor + [i] for i in range(size)], clean_up_tokenization_spaces=False)
+    texts = []
+    for i, text in enumerate(decoded):
+        text = text[len(base) :] if text.startswith(base) else None
+        texts.append(None if i in special or not text else text)
+    return texts
+
+
+class JsonLogitsProcessor(LogitsProcessor):
+    """
+    Mask the tokens that cannot continue the JSON value of each generated sequence.
+        Args:
+            tokenizer: Tokenizer of the model.
+            top_k (int): Valid candidates kept at each step, enough for greedy decoding and top-k/top-p sampling.
+            max_candidates (int): Best scoring tokens checked before giving up on constraining a sequence.
+    Once a value is complete only the end of sequence token is allowed.
+    Use a new processor for each `generate` call: the prompt length is taken from its first call.
+    """
+
+    def __init__(self, tokenizer, top_k=16, max_candidates=1024):
+        self.texts = token_texts(tokenizer)
+        self.eos_token_id = tokenizer.eos_token_id
+        self.top_k = top_k
+        self.max_candidates = max_candidates
+        self.prompt_length = None
+        # generated tokens and the automaton state after each of them, per sequence
+        self.tokens = None
+        self.history = None
+
+    def update(self, input_ids):
+        """Feed the tokens generated since the last call to the automaton of each sequence."""
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[1]
+            self.tokens = [[] for _ in range(input_ids.shape[0])]
+            self.history = [[INITIAL_STATE] for _ in range(input_ids.shape[0])]
+        for row, generated in enumerate(input_ids[:, self.prompt_length :].tolist()):
+            known, history = self.tokens[row], self.history[row]
+            n = len(known)
+            if generated[:n] != known:
+                # assisted generation rewinds the draft tokens rejected by the model
+                n = next((i for i, (a, b) in enumerate(zip(known, generated)) if a != b), len(generated))
+                del known[n:], history[n + 1 :]
+            state = history[-1]
+            for token in generated[n:]:
+                if state is not None and not is_complete(state):
+                    text = self.texts[token] if token < len(self.texts) else None
+                    state = advance(state, text) if text is not None else None
+                known.append(token)
+                history.append(state)
+
+    @property
+    def states(self):
+        return [history[-1] for history in self.history]
+
+    def done(self):
+        """Whether the top-level value of each sequence is complete."""
+        return [is_complete(state) for state in self.states]
+
+    def __call__(self, input_ids, scores):
+        self.update(input_ids)
+        masked = torch.full_like(scores, float("-inf"))
+        best = torch.topk(scores, min(self.max_candidates, scores.shape[-1]), dim=-1)
+        candidates, finite = best.indices.tolist(), torch.isfinite(best.values).tolist()
+        for row, state in enumerate(self.states):
+            if state is None:
+                # unconstrained once off track
+                masked[row] = scores[row]
+                continue
+            if is_complete(state):
+                masked[row, self.eos_token_id] = scores[row, self.eos_token_id]
+                continue
+            allowed = []
+            for token, is_finite in zip(candidates[row], finite[row]):
+                # tokens already removed by top-k/top-p sampling are not brought back
+                if not is_finite:
+                    break
+                text = self.texts[token] if token < len(self.texts) else None
+                if text is not None and advance(state, text) is not None:
+                    allowed.append(token)
+                    if len(allowed) == self.top_k:
+                        break
+            if not allowed:
+                self.history[row][-1] = None
+                masked[row] = scores[row]
+                continue
+            masked[row, allowed] = scores[row, allowed]
+        return masked
+
+
+class JsonStoppingCriteria(StoppingCriteria):
+    """Stop each sequence as soon as its top-level JSON value is closed."""
+
+    def __init__(self, processor):
+        self.processor = processor
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.processor.update(input_ids)
+        return torch.tensor(self.processor.done(), dtype=torch.bool, device=input_ids.device)
+
+
+def json_generation_kwargs(tokenizer, **kwargs):
+    """`generate` arguments constraining the output to one JSON object or array, fresh for each call."""
+    processor = JsonLogitsProcessor(tokenizer, **kwargs)
+    return {
+        "logits_processor": LogitsProcessorList([processor]),
+        "stopping_criteria": StoppingCriteriaList([JsonStoppingCriteria(processor)]),
+    }
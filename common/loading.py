@@ -0,0 +1,38 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+"""
+Process-pool helpers for the prepare scripts.
+
+Results always come back in the order of the inputs, whatever the number of
+workers, so the prepared files only depend on the inputs and the random seed.
+Functions passed to the pool must be defined at module level, and scripts using
+it must keep their top-level code under `if __name__ == "__main__":` so that
+worker processes started with "spawn" (Windows, macOS) do not re-run it.
+"""
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+def parallel_map(fn, items, workers=None):
+    """`[fn(item) for item in items]` computed by up to `workers` processes; 0 or 1 worker runs serially."""
+    items = list(items)
+    workers = min(default_workers() if workers is None else workers, len(items))
+    if workers <= 1:
+        return [fn(item) for item in items]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(fn, items))
+
+
+def parallel_imap(fn, items, workers=None):
+    """Lazy `parallel_map`: yields `fn(item)` in the order of `items` as the results become available."""
+    items = list(items)
+    workers = min(default_workers() if workers is None else workers, len(items))
+    if workers <= 1:
+        for item in items:
+            yield fn(item)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(fn, items)
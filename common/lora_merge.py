@@ -0,0 +1,230 @@
+import json
+import math
+import os
+import re
+import shutil
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+"""
+Merge a LoRA adapter into a base model one tensor at a time, without ever loading the model.
+
+The base checkpoint's safetensors shards are read tensor by tensor (memory-mapped).
+Each weight targeted by the adapter gets `B @ A * scaling` added (alpha / r, or
+alpha / sqrt(r) with rsLoRA, per-module rank and alpha patterns honoured). Merged
+tensors are written to new shards as soon as a shard is full, so peak memory is
+about one output shard plus one tensor, instead of the whole model.
+
+Tensors saved in full by the adapter (modules_to_save, trained biases) replace the base ones.
+DoRA adapters are not supported.
+
+    merge_lora_streaming("mistralai/Mistral-7B-Instruct-v0.3", "./mistral-lora-adapter", "./mistral-merged")
+"""
+
+PEFT_PREFIX = "base_model.model."
+LORA_SUFFIXES = {
+    ".lora_A.weight": "A",
+    ".lora_B.weight": "B",
+    ".lora_embedding_A": "embedding_A",
+    ".lora_embedding_B": "embedding_B",
+}
+SAFE_INDEX_NAME = "model.safetensors.index.json"
+IGNORE_PATTERNS = ("consolidated*",)
+
+
+def parse_size(size):
+    """Bytes of a size given as an int or a string such as "2GB" or "500MB"."""
+    if isinstance(size, int):
+        return size
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMG]?B)\s*", size.upper())
+    if match is None:
+        raise ValueError(f"Invalid size {size!r}, expected e.g. 5GB or 500MB")
+    return int(float(match.group(1)) * {"B": 1, "KB": 1 << 10, "MB": 1 << 20, "GB": 1 << 30}[match.group(2)])
+
+
+def resolve_model_dir(name_or_path, allow_patterns=("*.json", "*.safetensors"), ignore_patterns=IGNORE_PATTERNS):
+    """
+    Local directory of a model, downloading only its safetensors and JSON files from the Hub if needed.
+    `ignore_patterns` skips the second copy of the weights some repositories ship for other runtimes,
+    e.g. the consolidated.safetensors of Mistral, which `from_pretrained` and `base_shards` never read.
+    """
+    if os.path.isdir(name_or_path):
+        return name_or_path
+    from huggingface_hub import snapshot_download
+
+    return snapshot_download(name_or_path, allow_patterns=list(allow_patterns), ignore_patterns=list(ignore_patterns))
+
+
+def base_shards(model_dir):
+    """Safetensors files of a base checkpoint, from its index when sharded."""
+    index_path = os.path.join(model_dir, SAFE_INDEX_NAME)
+    if os.path.exists(index_path):
+        with open(index_path, "r", encoding="utf-8") as f:
+            weight_map = json.load(f)["weight_map"]
+        return [os.path.join(model_dir, name) for name in sorted(set(weight_map.values()))]
+    path = os.path.join(model_dir, "model.safetensors")
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No model.safetensors or {SAFE_INDEX_NAME} in {model_dir}")
+    return [path]
+
+
+def _pattern_value(patterns, module, default):
+    # same matching as peft: the pattern must match the end of the module name
+    for pattern, value in patterns.items():
+        if re.match(rf"(.*\.)?{pattern}$", module):
+            return value
+    return default
+
+
+def load_adapter(adapter_dir):
+    """
+    Read an adapter saved by PeftModel.save_pretrained.
+    Returns the LoRA pairs by base module name, each with its scaling,
+    and the tensors saved in full by base tensor name.
+    """
+    with open(os.path.join(adapter_dir, "adapter_config.json"), "r", encoding="utf-8") as f:
+        config = json.load(f)
+    if config.get("peft_type", "LORA") != "LORA":
+        raise ValueError(f"Only LoRA adapters can be merged, got {config['peft_type']}")
+    if config.get("use_dora"):
+        raise ValueError("DoRA adapters are not supported by the streaming merge")
+
+    weights_path = os.path.join(adapter_dir, "adapter_model.safetensors")
+    if os.path.exists(weights_path):
+        with safe_open(weights_path, framework="pt") as f:
+            weights = {k: f.get_tensor(k) for k in f.keys()}
+    else:
+        weights = torch.load(os.path.join(adapter_dir, "adapter_model.bin"), map_location="cpu")
+
+    lora, full = {}, {}
+    for key, tensor in weights.items():
+        name = key[len(PEFT_PREFIX) :] if key.startswith(PEFT_PREFIX) else key
+        for suffix, part in LORA_SUFFIXES.items():
+            if name.endswith(suffix):
+                lora.setdefault(name[: -len(suffix)], {})[part] = tensor
+                break
+        else:
+            full[name] = tensor
+
+    for module, parts in lora.items():
+        r = _pattern_value(config.get("rank_pattern") or {}, module, config["r"])
+        alpha = _pattern_value(config.get("alpha_pattern") or {}, module, config["lora_alpha"])
+        parts["scaling"] = alpha / math.sqrt(r) if config.get("use_rslora") else alpha / r
+        parts["fan_in_fan_out"] = config.get("fan_in_fan_out", False)
+    return lora, full
+
+
+def lora_delta(parts):
+    """Weight update of one LoRA module, in float32."""
+    if "embedding_A" in parts:
+        delta = (parts["embedding_B"].float() @ parts["embedding_A"].float()).T
+    else:
+        delta = parts["B"].float() @ parts["A"].float()
+        if parts["fan_in_fan_out"]:
+            delta = delta.T
+    return delta * parts["scaling"]
+
+
+class ShardWriter:
+    """Write tensors to safetensors shards of at most `max_shard_size` bytes, then index them like save_pretrained."""
+
+    def __init__(self, output_dir, max_shard_size):
+        self.output_dir = output_dir
+        self.max_shard_size = max_shard_size
+        self.current, self.current_size = {}, 0
+        self.shards = []
+        self.weight_map = {}
+        self.total_size = 0
+
+    def add(self, name, tensor):
+        size = tensor.numel() * tensor.element_size()
+        if self.current and self.current_size + size > self.max_shard_size:
+            self.flush()
+        self.current[name] = tensor.contiguous()
+        self.current_size += size
+        self.total_size += size
+
+    def flush(self):
+        if not self.current:
+            return
+        path = os.path.join(self.output_dir, f".shard-{len(self.shards):05d}.safetensors")
+        save_file(self.current, path, metadata={"format": "pt"})
+        self.shards.append((path, list(self.current)))
+        self.current, self.current_size = {}, 0
+
+    def close(self):
+        self.flush()
+        if len(self.shards) == 1:
+            os.replace(self.shards[0][0], os.path.join(self.output_dir, "model.safetensors"))
+            return
+        for i, (path, names) in enumerate(self.shards):
+            shard_name = f"model-{i + 1:05d}-of-{len(self.shards):05d}.safetensors"
+            os.replace(path, os.path.join(self.output_dir, shard_name))
+            self.weight_map.update(dict.fromkeys(names, shard_name))
+        with open(os.path.join(self.output_dir, SAFE_INDEX_NAME), "w", encoding="utf-8") as f:
+            json.dump({"metadata": {"total_size": self.total_size}, "weight_map": self.weight_map}, f, indent=2)
+
+
+def merge_lora_streaming(base_model, adapter_dir, output_dir, dtype=None, max_shard_size="2GB"):
+    """
+    Write the base model with the adapter merged into `output_dir`, reading and writing one tensor at a time.
+        Args:
+            base_model (str): Local directory or Hub id of the base model, in safetensors format.
+            adapter_dir (str): Directory of the adapter saved by PeftModel.save_pretrained.
+            output_dir (str): Where the merged shards, index and config files are written.
+            dtype (torch.dtype): Floating point dtype of the merged tensors, that of the base checkpoint if None.
+            max_shard_size (int or str): Size of the output shards, which bounds the peak memory.
+    Returns the number of LoRA modules merged.
+    """
+    model_dir = resolve_model_dir(base_model)
+    lora, full = load_adapter(adapter_dir)
+    if os.path.realpath(model_dir) == os.path.realpath(output_dir):
+        raise ValueError("The merged model cannot be written over the base checkpoint it is read from")
+    os.makedirs(output_dir, exist_ok=True)
+    # shards of a previous merge would be mixed with the new ones
+    for name in os.listdir(output_dir):
+        if re.fullmatch(r"model(-\d{5}-of-\d{5})?\.safetensors|" + re.escape(SAFE_INDEX_NAME), name):
+            os.remove(os.path.join(output_dir, name))
+    writer = ShardWriter(output_dir, parse_size(max_shard_size))
+    merged = set()
+    replaced = set()
+    out_dtype = None
+
+    for shard in base_shards(model_dir):
+        with safe_open(shard, framework="pt") as f:
+            for name in f.keys():
+                tensor = f.get_tensor(name)
+                module = name[: -len(".weight")] if name.endswith(".weight") else None
+                if name in full:
+                    tensor = full[name].to(tensor.dtype)
+                    replaced.add(name)
+                elif module in lora:
+                    tensor = (tensor.float() + lora_delta(lora[module])).to(tensor.dtype)
+                    merged.add(module)
+                if dtype is not None and tensor.is_floating_point():
+                    tensor = tensor.to(dtype)
+                if tensor.is_floating_point():
+                    out_dtype = tensor.dtype
+                writer.add(name, tensor)
+    writer.close()
+
+    missing = set(lora) - merged
+    if missing:
+        raise ValueError(f"{len(missing)} LoRA modules have no weight in the base checkpoint, e.g. {sorted(missing)[:3]}")
+    unused = set(full) - replaced
+    if unused:
+        print(f"Warning: {len(unused)} adapter tensors match no base tensor and were not merged: {sorted(unused)[:3]}")
+
+    for name in ("config.json", "generation_config.json"):
+        if os.path.exists(os.path.join(model_dir, name)):
+            shutil.copyfile(os.path.join(model_dir, name), os.path.join(output_dir, name))
+    if out_dtype is not None:
+        config_path = os.path.join(output_dir, "config.json")
+        with open(config_path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        config["torch_dtype"] = str(out_dtype).replace("torch.", "")
+        with open(config_path, "w", encoding="utf-8") as f:
+            json.dump(config, f, indent=2)
+    return len(merged)
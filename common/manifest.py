@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+
+from common.loading import parallel_imap
+
+"""
+Content-hash manifest of the source files read by the prepare scripts.
+
+Each source file is parsed once into a list of records that is cached under the
+sha256 of the file content. On later runs files whose size and modification time
+are unchanged are not even re-hashed, changed files are re-hashed and only
+re-parsed if their content really differs, so a rerun after editing one file
+costs one parse plus the split assembly.
+"""
+
+MANIFEST_FILE = "manifest.json"
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class SourceCache:
+    """
+    Cache of parsed records per source file, stored in `cache_dir` alongside manifest.json.
+    `load` returns the cached records of a file when its content hash matches the manifest,
+    otherwise calls `parse(path)` and caches what it returns (which must be JSON serializable).
+    Call `save` once all the sources have been loaded.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.manifest_path = os.path.join(cache_dir, MANIFEST_FILE)
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                self.manifest = json.load(f)
+        self.seen = set()
+        self.reparsed = []
+
+    def _records_path(self, digest, parser_name):
+        return os.path.join(self.cache_dir, f"{digest}.{parser_name}.json")
+
+    def entry(self, path):
+        """Manifest entry for `path`, with its content hash refreshed if the file changed on disk."""
+        key = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self.manifest.get(key)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            entry = {"sha256": file_sha256(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+            self.manifest[key] = entry
+        self.seen.add(key)
+        return entry
+
+    def load(self, path, parse):
+        entry = self.entry(path)
+        records_path = self._records_path(entry["sha256"], parse.__name__)
+        if os.path.exists(records_path):
+            with open(records_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        records = parse(path)
+        with open(records_path, "w", encoding="utf-8") as f:
+            json.dump(records, f, separators=(",", ":"))
+        self.reparsed.append(path)
+        return records
+
+    def load_many(self, paths, parse, workers=None):
+        """
+        `load` for each of `paths`, the cache misses being parsed in parallel by `workers` processes.
+        Returns one list of records per path, in the order of `paths`.
+        """
+        return list(self.iter_many(paths, parse, workers))
+
+    def iter_many(self, paths, parse, workers=None):
+        """
+        Streaming `load_many`: yields the records of each of `paths` in order, one file at a time,
+        so that only the files being parsed or consumed are held in memory.
+        """
+        paths = list(paths)
+        cached = []
+        for path in paths:
+            records_path = self._records_path(self.entry(path)["sha256"], parse.__name__)
+            cached.append(records_path if os.path.exists(records_path) else None)
+        parsed = parallel_imap(parse, [p for p, c in zip(paths, cached) if c is None], workers)
+        for path, records_path in zip(paths, cached):
+            if records_path is not None:
+                with open(records_path, "r", encoding="utf-8") as f:
+                    yield json.load(f)
+                continue
+            records = next(parsed)
+            with open(self._records_path(self.entry(path)["sha256"], parse.__name__), "w", encoding="utf-8") as f:
+                json.dump(records, f, separators=(",", ":"))
+            self.reparsed.append(path)
+            yield records
+
+    def save(self):
+        """Write the manifest, forgetting the sources not loaded in this run and deleting their cached records."""
+        self.manifest = {k: v for k, v in self.manifest.items() if k in self.seen}
+        live = {entry["sha256"] for entry in self.manifest.values()}
+        for name in os.listdir(self.cache_dir):
+            if name != MANIFEST_FILE and name.split(".", 1)[0] not in live:
+                os.remove(os.path.join(self.cache_dir, name))
+        with open(self.manifest_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, indent=2)
+        print(f"Source cache: {len(self.reparsed)} of {len(self.seen)} source files reparsed")
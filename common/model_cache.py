@@ -0,0 +1,234 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+import torch
+from safetensors import safe_open
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.lora_merge import IGNORE_PATTERNS, SAFE_INDEX_NAME, ShardWriter, base_shards, parse_size, resolve_model_dir
+
+"""
+Local cache of base models already converted to the dtype or quantization they are trained and served in.
+
+Every launch of the training, merging and inference scripts used to download or read
+the base checkpoint, cast it and, for 8-bit and 4-bit runs, quantize it again with
+bitsandbytes. `prepare_model` does that once and saves the result as safetensors in
+<cache_dir>/<model>-<dtype or quantization>-<key>, the key hashing the source files
+(name, size, modification time), the dtype and the quantization. Later launches load
+the entry with `from_pretrained`, which memory-maps the shards and copies each tensor
+to its device as it is read; a quantized entry is loaded as saved, without quantizing.
+
+Unquantized entries are written tensor by tensor from the source shards, so building
+one takes about one output shard of memory; quantized entries are built by one
+bitsandbytes load on the GPU, the device of the calling process unless a device_map is
+given. Entries are built in a temporary directory and renamed, so concurrent launches
+never read a partial one. Processes of one distributed run should not all build the same
+entry: build it in the main process first, e.g. within `Accelerator().main_process_first()`.
+
+    python common/model_cache.py --model_path bigcode/starcoderbase-1b --quantization 8bit
+    python common/model_cache.py --model_path mistralai/Mistral-7B-Instruct-v0.3 --quantization 4bit --dtype float16
+
+    model = load_cached_model("bigcode/starcoderbase-1b", quantization="8bit", device_map={"": 0})
+"""
+
+MODEL_CACHE_DIR = ".model_cache"
+CACHE_FILE = "model_cache.json"
+QUANTIZATIONS = ("8bit", "4bit")
+SOURCE_PATTERNS = ("*.json", "*.safetensors", "*.model", "*.txt")
+WEIGHT_SUFFIXES = (".safetensors", ".bin", ".pt", ".pth", ".h5", ".msgpack", ".ckpt")
+
+
+def dtype_name(dtype):
+    """Name of a torch dtype or of its name, e.g. "float16", None for None."""
+    if dtype is None:
+        return None
+    return str(dtype).replace("torch.", "")
+
+
+def quantization_config(quantization, dtype=None):
+    """BitsAndBytesConfig of "8bit", or of "4bit" NF4 with double quantization and `dtype` (float16) compute."""
+    from transformers import BitsAndBytesConfig
+
+    if quantization == "8bit":
+        return BitsAndBytesConfig(load_in_8bit=True)
+    if quantization == "4bit":
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=getattr(torch, dtype_name(dtype) or "float16"),
+        )
+    raise ValueError(f"Unknown quantization {quantization!r}, expected one of {QUANTIZATIONS}")
+
+
+def source_files(model_dir):
+    return sorted(f for f in os.listdir(model_dir) if os.path.isfile(os.path.join(model_dir, f)))
+
+
+def cache_key(model_dir, dtype=None, quantization=None):
+    """Hash of the files of `model_dir` (name, size, modification time), `dtype` and `quantization`."""
+    h = hashlib.sha256()
+    h.update(os.path.abspath(model_dir).encode())
+    for name in source_files(model_dir):
+        stat = os.stat(os.path.join(model_dir, name))
+        h.update(f"{name}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    h.update(f"{dtype_name(dtype)}\0{quantization}".encode())
+    return h.hexdigest()[:16]
+
+
+def entry_name(model_path, key, dtype=None, quantization=None):
+    return f"{os.path.basename(os.path.normpath(model_path))}-{quantization or dtype_name(dtype) or 'auto'}-{key}"
+
+
+def copy_model_files(model_dir, output_dir):
+    """Copy the configuration and tokenizer files of `model_dir` that `output_dir` does not have yet."""
+    for name in source_files(model_dir):
+        target = os.path.join(output_dir, name)
+        if name.endswith(WEIGHT_SUFFIXES) or name == SAFE_INDEX_NAME or os.path.exists(target):
+            continue
+        shutil.copyfile(os.path.join(model_dir, name), target)
+
+
+def convert_shards(model_dir, output_dir, dtype=None, max_shard_size="2GB"):
+    """Write the safetensors shards of `model_dir` to `output_dir` one tensor at a time, floats cast to `dtype`."""
+    target = getattr(torch, dtype_name(dtype)) if dtype is not None else None
+    writer = ShardWriter(output_dir, parse_size(max_shard_size))
+    for path in base_shards(model_dir):
+        with safe_open(path, framework="pt") as f:
+            for name in f.keys():
+                tensor = f.get_tensor(name)
+                if target is not None and tensor.is_floating_point():
+                    tensor = tensor.to(target)
+                writer.add(name, tensor)
+    writer.close()
+    copy_model_files(model_dir, output_dir)
+    config_path = os.path.join(output_dir, "config.json")
+    if target is not None and os.path.exists(config_path):
+        with open(config_path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        config["torch_dtype"] = dtype_name(dtype)
+        with open(config_path, "w", encoding="utf-8") as f:
+            json.dump(config, f, indent=2)
+
+
+def save_loaded(model_path, model_dir, output_dir, dtype=None, quantization=None, max_shard_size="2GB", model_class=None, **kwargs):
+    """Load the model with `from_pretrained`, quantized if asked, and save it to `output_dir` as safetensors."""
+    if model_class is None:
+        from transformers import AutoModelForCausalLM as model_class
+
+    device_map = kwargs.pop("device_map", None)
+    if quantization is not None:
+        kwargs["quantization_config"] = quantization_config(quantization, dtype)
+        if device_map is None and torch.cuda.is_available():
+            # the GPU of this process, not cuda:0 for every rank
+            device_map = {"": torch.cuda.current_device()}
+        kwargs["device_map"] = device_map
+    model = model_class.from_pretrained(
+        model_path,
+        torch_dtype=getattr(torch, dtype_name(dtype)) if dtype is not None else "auto",
+        low_cpu_mem_usage=True,
+        **kwargs,
+    )
+    model.save_pretrained(output_dir, safe_serialization=True, max_shard_size=max_shard_size)
+    copy_model_files(model_dir, output_dir)
+
+
+def prepare_model(model_path, cache_dir=MODEL_CACHE_DIR, dtype=None, quantization=None, max_shard_size="2GB", model_class=None, **kwargs):
+    """
+    Local directory of `model_path` converted to `dtype` or quantized, from `cache_dir`, built on the first call.
+        Args:
+            model_path (str): Hub name or local directory of the base model.
+            cache_dir (str): Directory of the cache entries.
+            dtype: torch dtype or its name the floating point weights are cast to; the compute dtype of "4bit".
+            quantization (str): "8bit" or "4bit" to save the model quantized by bitsandbytes (needs a GPU).
+            max_shard_size: Size of the saved safetensors shards.
+            model_class: Class loading checkpoints without safetensors or to quantize, AutoModelForCausalLM by default.
+            kwargs: Passed to `from_pretrained` when the model has to be loaded, e.g. trust_remote_code, or the
+                device_map quantizing on (the current GPU by default).
+    """
+    if quantization is not None and quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization {quantization!r}, expected one of {QUANTIZATIONS}")
+    # without the consolidated.* copy of the weights of e.g. Mistral, never read here
+    model_dir = resolve_model_dir(model_path, SOURCE_PATTERNS, IGNORE_PATTERNS)
+    key = cache_key(model_dir, dtype, quantization)
+    path = os.path.join(cache_dir, entry_name(model_path, key, dtype, quantization))
+    if os.path.isfile(os.path.join(path, CACHE_FILE)):
+        return path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = f"{path}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    try:
+        try:
+            shards = base_shards(model_dir)
+        except FileNotFoundError:
+            shards = None
+        if quantization is None and shards:
+            convert_shards(model_dir, tmp, dtype, max_shard_size)
+        else:
+            save_loaded(model_path, model_dir, tmp, dtype, quantization, max_shard_size, model_class, **kwargs)
+        with open(os.path.join(tmp, CACHE_FILE), "w", encoding="utf-8") as f:
+            json.dump({"source": model_path, "dtype": dtype_name(dtype), "quantization": quantization, "key": key}, f, indent=2)
+        os.rename(tmp, path)
+    except OSError:
+        if not os.path.isfile(os.path.join(path, CACHE_FILE)):
+            raise
+        # another launch built the same entry first
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return path
+
+
+def load_cached_model(model_path, cache_dir=MODEL_CACHE_DIR, dtype=None, quantization=None, model_class=None, **kwargs):
+    """
+    `from_pretrained` of the `prepare_model` entry of `model_path`, memory-mapped and already converted or quantized.
+    `kwargs` are passed to `from_pretrained` (device_map, use_cache...); the model is loaded in the entry's dtype.
+    """
+    if model_class is None:
+        from transformers import AutoModelForCausalLM as model_class
+
+    path = prepare_model(
+        model_path,
+        cache_dir,
+        dtype,
+        quantization,
+        model_class=model_class,
+        trust_remote_code=kwargs.get("trust_remote_code", False),
+        device_map=kwargs.get("device_map"),
+    )
+    kwargs.setdefault("torch_dtype", getattr(torch, dtype_name(dtype)) if dtype is not None else "auto")
+    kwargs.setdefault("low_cpu_mem_usage", True)
+    return model_class.from_pretrained(path, **kwargs)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path", type=str, default="bigcode/large-model")
+    parser.add_argument("--cache_dir", type=str, default=MODEL_CACHE_DIR)
+    parser.add_argument("--dtype", type=str, default=None, help="float16, bfloat16 or float32; compute dtype of 4bit")
+    parser.add_argument("--quantization", type=str, default=None, choices=QUANTIZATIONS, help="saved quantized by bitsandbytes, on GPU")
+    parser.add_argument("--max_shard_size", type=str, default="2GB")
+    parser.add_argument("--trust_remote_code", action="store_true")
+    return parser.parse_args()
+
+
+def main(args):
+    path = prepare_model(
+        args.model_path,
+        args.cache_dir,
+        dtype=args.dtype,
+        quantization=args.quantization,
+        max_shard_size=args.max_shard_size,
+        trust_remote_code=args.trust_remote_code,
+    )
+    print(path)
+
+
+if __name__ == "__main__":
+    main(get_args())
@@ -0,0 +1,143 @@
+import argparse
+import csv
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.manifest import file_sha256
+from common.prompts import PROMPTS_FILE, PromptRegistry
+from common.tokenization import tokenizer_fingerprint
+
+"""
+Token length profile of prepared splits, to pick --seq_length / max_length from data instead of guesswork.
+
+Reads any of the prepared formats:
+    ChatML JSONL (data_mistral)         input = system + user messages, output = assistant messages
+    input/output JSONL (data_codet5)    input = prompt + input, output = output
+    question/response CSV (starcoderbase)
+and tokenizes them with batched fast-tokenizer calls. Lengths are cached per
+(tokenizer, file content) in --cache_dir so re-profiling is instant.
+
+    python common/profile_lengths.py --model_path bigcode/starcoderbase-1b --max_length 1700 data_codet5/*.jsonl
+"""
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--model_path", type=str, default="bigcode/starcoderbase-1b")
+    parser.add_argument("--max_length", type=int, default=None, help="report the share of samples longer than this")
+    parser.add_argument("--batch_size", type=int, default=1000)
+    parser.add_argument("--bins", type=int, default=20)
+    parser.add_argument("--cache_dir", type=str, default=".length_cache")
+    return parser.parse_args()
+
+
+def iter_pairs(path):
+    """(input, output) text of every sample of a prepared file, whatever its format."""
+    if path.endswith(".csv"):
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                yield row["question"], row["response"]
+        return
+
+    prompts_path = os.path.join(os.path.dirname(path), PROMPTS_FILE)
+    registry = PromptRegistry.load(prompts_path) if os.path.exists(prompts_path) else PromptRegistry()
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            record = registry.expand(json.loads(line))
+            if "messages" in record:
+                messages = record["messages"]
+                yield (
+                    "\n\n".join(m["content"] for m in messages if m["role"] in ("system", "user")),
+                    "\n\n".join(m["content"] for m in messages if m["role"] == "assistant"),
+                )
+            else:
+                yield record["input"], record["output"]
+
+
+def token_lengths(tokenizer, path, batch_size=1000):
+    """Array of shape (samples, 2) with the input and output token counts of every sample of `path`."""
+    lengths = []
+    batch = []
+
+    def flush():
+        inputs, outputs = zip(*batch)
+        encoded = tokenizer(list(inputs) + list(outputs), add_special_tokens=False, truncation=False)["input_ids"]
+        n = len(batch)
+        lengths.extend(zip(map(len, encoded[:n]), map(len, encoded[n:])))
+        batch.clear()
+
+    for pair in iter_pairs(path):
+        batch.append(pair)
+        if len(batch) == batch_size:
+            flush()
+    if batch:
+        flush()
+    return np.asarray(lengths, dtype=np.int64).reshape(-1, 2)
+
+
+def cached_token_lengths(tokenizer, path, cache_dir, batch_size=1000):
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = os.path.join(cache_dir, f"{tokenizer_fingerprint(tokenizer)}-{file_sha256(path)}.npy")
+    if os.path.exists(cache_path):
+        return np.load(cache_path)
+    lengths = token_lengths(tokenizer, path, batch_size)
+    np.save(cache_path, lengths)
+    return lengths
+
+
+def histogram(values, bins=20, width=50):
+    counts, edges = np.histogram(values, bins=bins)
+    top = max(counts.max(), 1)
+    lines = []
+    for count, lo, hi in zip(counts, edges[:-1], edges[1:]):
+        lines.append(f"  {int(lo):>7} - {int(hi):>7} | {'#' * int(round(width * count / top)):<{width}} {count}")
+    return "\n".join(lines)
+
+
+def describe(name, values):
+    p = np.percentile(values, PERCENTILES)
+    percentiles = ", ".join(f"p{q}={int(v)}" for q, v in zip(PERCENTILES, p))
+    return f"  {name:<7} mean={values.mean():.0f}, {percentiles}, max={values.max()}"
+
+
+def report(path, lengths, max_length=None, bins=20):
+    print(f"{path}: {len(lengths)} samples")
+    if len(lengths) == 0:
+        return
+    total = lengths.sum(axis=1)
+    print(describe("input", lengths[:, 0]))
+    print(describe("output", lengths[:, 1]))
+    print(describe("total", total))
+    if max_length is not None:
+        over = total > max_length
+        print(
+            f"  {over.mean():.1%} of samples ({over.sum()}) are longer than {max_length} tokens, "
+            f"{np.maximum(total - max_length, 0).sum()} tokens would be truncated"
+        )
+        print(f"  padding to {max_length} would waste {1 - np.minimum(total, max_length).sum() / (len(total) * max_length):.1%} of the slots")
+    print(histogram(total, bins=bins))
+
+
+def main(args):
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path, use_fast=True)
+    all_lengths = []
+    for path in args.files:
+        lengths = cached_token_lengths(tokenizer, path, args.cache_dir, args.batch_size)
+        report(path, lengths, args.max_length, args.bins)
+        all_lengths.append(lengths)
+    if len(args.files) > 1:
+        report("all files", np.concatenate(all_lengths), args.max_length, args.bins)
+
+
+if __name__ == "__main__":
+    main(get_args())
@@ -0,0 +1,67 @@
+import hashlib
+import json
+import os
+
+"""
+Prompt templates stored once, next to the prepared files, and referenced by id from each record.
+
+Prepared records carry a "prompt_id" instead of the full prompt text:
+    ChatML:        {"id": ..., "prompt_id": ..., "messages": [user, assistant]}
+    input/output:  {"prompt_id": ..., "input": ..., "output": ...}
+`PromptRegistry.expand` puts the text back when the data is loaded or collated.
+"""
+
+PROMPTS_FILE = "prompts.json"
+
+
+def prompt_id(text):
+    """Stable id of a prompt: the first 16 hex digits of the sha256 of its text."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+class PromptRegistry:
+    """Prompt texts keyed by `prompt_id`."""
+
+    def __init__(self, prompts=None):
+        self.prompts = dict(prompts or {})
+
+    def register(self, text):
+        """Store `text` if it is not known yet and return its id."""
+        pid = prompt_id(text)
+        self.prompts.setdefault(pid, text)
+        return pid
+
+    def get(self, pid):
+        return self.prompts[pid]
+
+    def save(self, path):
+        """Write the registry to `path`, or to `path/prompts.json` if `path` is a directory."""
+        if os.path.isdir(path):
+            path = os.path.join(path, PROMPTS_FILE)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.prompts, f, indent=2, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path):
+        """Read a registry written by `save`; `path` may be the file or the directory holding it."""
+        if os.path.isdir(path):
+            path = os.path.join(path, PROMPTS_FILE)
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def expand(self, record, separator="\n\n"):
+        """
+        Return `record` with its prompt inlined, in the layout it would have had without the registry:
+        a leading system message for ChatML records, a prefix of "input" for input/output records.
+        Records without a "prompt_id" are returned unchanged, so files written inline keep working.
+        """
+        pid = record.get("prompt_id")
+        if pid is None:
+            return record
+        record = dict(record)
+        text = self.get(record.pop("prompt_id"))
+        if "messages" in record:
+            record["messages"] = [{"role": "system", "content": text}] + list(record["messages"])
+        else:
+            record["input"] = text + separator + record["input"]
+        return record
@@ -0,0 +1,155 @@
+import time
+from contextlib import contextmanager
+
+import torch
+
+from common.inference import encode_text, prompt_messages
+from common.json_decoding import json_generation_kwargs
+
+"""
+Speculative decoding: a small fine-tuned model drafts tokens that the large one verifies in one forward pass.
+
+Built on the assisted generation of `generate`. With greedy decoding the output is the
+large model's own; with sampling it follows the large model's distribution. When the two
+models do not share a vocabulary (StarCoderBase-1b drafting for Mistral-7B) the draft is
+re-tokenized through text, which `generate` does given both tokenizers.
+
+Every verification step is counted: tokens drafted, tokens accepted, and so the acceptance
+rate and the tokens produced per forward pass of the large model, which is the speed-up
+bound. Assisted generation handles one sequence at a time.
+
+    generator = SpeculativeGenerator(model, tokenizer, draft_model, draft_tokenizer)
+    texts = generator.generate([messages, ...], max_new_tokens=1024)
+    generator.stats()
+"""
+
+
+def same_vocabulary(tokenizer, other):
+    return other is None or tokenizer is other or tokenizer.get_vocab() == other.get_vocab()
+
+
+class AcceptanceStats:
+    """Draft tokens proposed and accepted over the verification steps of assisted generation."""
+
+    def __init__(self):
+        self.steps = 0
+        self.drafted = 0
+        self.accepted = 0
+        self.generated = 0
+        self.seconds = 0.0
+
+    def as_dict(self):
+        return {
+            "verification_steps": self.steps,
+            "drafted_tokens": self.drafted,
+            "accepted_tokens": self.accepted,
+            "acceptance_rate": self.accepted / max(self.drafted, 1),
+            "generated_tokens": self.generated,
+            "tokens_per_verification": self.generated / max(self.steps, 1),
+            "tokens_per_second": self.generated / max(self.seconds, 1e-9),
+        }
+
+
+@contextmanager
+def track_acceptance(model, stats):
+    """Count the drafted and accepted tokens of the assisted `generate` calls of `model` into `stats`."""
+    # a PeftModel generates through its base model
+    model = model.get_base_model() if hasattr(model, "get_base_model") else model
+    get_candidate_generator = model._get_candidate_generator
+
+    def counting_candidate_generator(*args, **kwargs):
+        candidate_generator = get_candidate_generator(*args, **kwargs)
+        get_candidates = candidate_generator.get_candidates
+        update_candidate_strategy = candidate_generator.update_candidate_strategy
+
+        def counted_get_candidates(input_ids):
+            candidate_ids, candidate_logits = get_candidates(input_ids)
+            stats.drafted += candidate_ids.shape[1] - input_ids.shape[1]
+            return candidate_ids, candidate_logits
+
+        def counted_update(input_ids, scores, num_matches):
+            stats.steps += 1
+            stats.accepted += int(num_matches)
+            return update_candidate_strategy(input_ids, scores, num_matches)
+
+        candidate_generator.get_candidates = counted_get_candidates
+        candidate_generator.update_candidate_strategy = counted_update
+        return candidate_generator
+
+    model._get_candidate_generator = counting_candidate_generator
+    try:
+        yield stats
+    finally:
+        del model._get_candidate_generator
+
+
+class SpeculativeGenerator:
+    """
+    Generate chat completions with `model`, drafted by `draft_model`.
+        Args:
+            model: The large causal LM, whose output it is.
+            tokenizer: Its tokenizer, with a chat template for message requests.
+            draft_model: The small causal LM proposing the tokens.
+            draft_tokenizer: Its tokenizer, only needed when the vocabularies differ.
+            num_draft_tokens (int): Tokens drafted per step; by default `generate` adapts it to the acceptance.
+            confidence_threshold (float): The draft stops early when its next token probability is lower,
+                `generate` default (0.4) if None.
+    """
+
+    def __init__(self, model, tokenizer, draft_model, draft_tokenizer=None, num_draft_tokens=None, confidence_threshold=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.draft_model = draft_model
+        self.bridged = not same_vocabulary(tokenizer, draft_tokenizer)
+        self.draft_tokenizer = draft_tokenizer
+        if num_draft_tokens is not None:
+            draft_model.generation_config.num_assistant_tokens = num_draft_tokens
+            draft_model.generation_config.num_assistant_tokens_schedule = "constant"
+        if confidence_threshold is not None:
+            draft_model.generation_config.assistant_confidence_threshold = confidence_threshold
+        self.acceptance = AcceptanceStats()
+        pad_token_id = tokenizer.pad_token_id
+        self.pad_token_id = pad_token_id if pad_token_id is not None else tokenizer.eos_token_id
+
+    def encode(self, request):
+        """Prompt ids of a request of PrefixCachedGenerator: chat messages, a rendered {"prompt"} or a plain string."""
+        if isinstance(request, str):
+            return encode_text(self.tokenizer, request)
+        if isinstance(request, dict) and "prompt" in request:
+            return encode_text(self.tokenizer, request["prompt"])
+        messages = request["messages"] if isinstance(request, dict) else request
+        text = self.tokenizer.apply_chat_template(prompt_messages(messages), tokenize=False, add_generation_prompt=True)
+        return self.tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    @torch.no_grad()
+    def generate(self, requests, skip_special_tokens=True, json_output=False, **generate_kwargs):
+        """
+        Completion text of each request, in order; see PrefixCachedGenerator.generate.
+        `json_output` needs both models to share a vocabulary, the draft being constrained too.
+        """
+        if json_output and self.bridged:
+            raise ValueError("json_output needs the draft and target models to share a vocabulary")
+        generate_kwargs.setdefault("pad_token_id", self.pad_token_id)
+        generate_kwargs["assistant_model"] = self.draft_model
+        if self.bridged:
+            generate_kwargs.update(tokenizer=self.tokenizer, assistant_tokenizer=self.draft_tokenizer)
+        results = []
+        with track_acceptance(self.model, self.acceptance):
+            for request in requests:
+                ids = self.encode(request)
+                input_ids = torch.tensor([ids], device=self.model.device)
+                kwargs = {**generate_kwargs, **json_generation_kwargs(self.tokenizer)} if json_output else generate_kwargs
+                start = time.perf_counter()
+                output = self.model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), **kwargs)
+                self.acceptance.seconds += time.perf_counter() - start
+                generated = output[0, len(ids) :].tolist()
+                self.acceptance.generated += len(generated)
+                results.append(self.tokenizer.decode(generated, skip_special_tokens=skip_special_tokens))
+        return results
+
+    @property
+    def generated_tokens(self):
+        return self.acceptance.generated
+
+    def stats(self):
+        return self.acceptance.as_dict()
@@ -0,0 +1,69 @@
+import hashlib
+import json
+import shutil
+
+"""
+Streaming train/validation/test assignment and JSONL writing for the prepare scripts.
+
+A record's split is a function of its id only, so splits do not move when records
+are added or removed and nothing has to be held in memory to shuffle and slice.
+"""
+
+WRITE_BUFFER_SIZE = 1 << 20
+
+
+def record_id(*parts):
+    """sha256 of the concatenated parts, as data_mistral/prepare.py ids the spec records."""
+    return hashlib.sha256("".join(parts).encode()).hexdigest()
+
+
+def assign_split(rid, fractions, salt=""):
+    """
+    Pick a split for the record id `rid` from `fractions`, a list of (split, fraction) pairs summing to 1.
+    The id is hashed to a uniform number in [0, 1) that falls into one of the cumulative fractions.
+    """
+    digest = hashlib.sha256(f"{salt}{rid}".encode()).digest()
+    u = int.from_bytes(digest[:8], "big") / 2**64
+    total = 0.0
+    for split, fraction in fractions:
+        total += fraction
+        if u < total:
+            return split
+    return fractions[-1][0]
+
+
+class SplitWriter:
+    """
+    One buffered JSONL file per split, written record by record.
+        with SplitWriter({"train": "train.jsonl", "test": "test.jsonl"}) as out:
+            out.write("train", record)
+    """
+
+    def __init__(self, paths, buffer_size=WRITE_BUFFER_SIZE):
+        self.paths = paths
+        self.buffer_size = buffer_size
+        self.files = {}
+        self.counts = {split: 0 for split in paths}
+
+    def __enter__(self):
+        self.files = {
+            split: open(path, "w", encoding="utf-8", buffering=self.buffer_size) for split, path in self.paths.items()
+        }
+        return self
+
+    def write(self, split, record):
+        self.files[split].write(json.dumps(record, separators=(",", ":")) + "\n")
+        self.counts[split] += 1
+
+    def __exit__(self, *exc):
+        for f in self.files.values():
+            f.close()
+        return False
+
+
+def concat_files(dest, sources):
+    """Stream `sources` one after the other into `dest` without reading them whole."""
+    with open(dest, "wb") as out:
+        for source in sources:
+            with open(source, "rb") as f:
+                shutil.copyfileobj(f, out, WRITE_BUFFER_SIZE)
@@ -0,0 +1,183 @@
+import json
+import os
+import time
+
+import torch
+from transformers import TrainerCallback
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+"""
+Per-step training telemetry: throughput, where the time of each step goes and peak memory.
+
+Each optimizer step is split with the Trainer callback events into
+    data_wait         end of the previous step (or its log/eval/save) -> on_step_begin, i.e. fetching the batches
+    forward_backward  on_step_begin -> on_pre_optimizer_step, every micro-batch and the gradient clipping
+    optimizer         on_pre_optimizer_step -> on_optimizer_step
+    evaluation        -> on_evaluate
+    checkpoint        -> on_save
+    other             scheduler, zero_grad, logging
+and tokens are counted by a forward pre-hook on the model (non-pad tokens from the attention mask,
+summed on the device and read once per record so that the hook never waits for the GPU).
+One record per logging interval is appended to a JSONL file, or written as a Prometheus
+text file (node_exporter textfile collector format) when the path ends with ".prom".
+
+    trainer.add_callback(TelemetryCallback("output/telemetry.jsonl"))
+"""
+
+TIMERS = ("data_wait", "forward_backward", "optimizer", "evaluation", "checkpoint", "other")
+
+
+def host_peak_memory_mb():
+    """Peak resident memory of this process, None where the resource module is missing."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1 << 20) if os.uname().sysname == "Darwin" else peak / (1 << 10)
+
+
+class TelemetryCallback(TrainerCallback):
+    """
+    Write throughput, step time breakdown and peak memory of each logging interval to `path`.
+        Args:
+            path (str): JSONL file the records are appended to, or Prometheus text file if it ends with ".prom".
+            synchronize (bool): Wait for the device at each boundary so that asynchronous CUDA work is
+                timed in the phase that queued it rather than in the next blocking one. Off by default:
+                it stalls every step, use it to profile a run rather than to monitor it.
+    Only the main process writes, with its own counts.
+    """
+
+    def __init__(self, path, synchronize=False):
+        self.path = path
+        self.prometheus = path.endswith(".prom")
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.hook = None
+        self._reset()
+        self.cursor = None
+        self.train_start = None
+        self.start_step = 0
+
+    def _reset(self):
+        self.timers = dict.fromkeys(TIMERS, 0.0)
+        self.steps = 0
+        self.tokens = 0
+        self.non_pad_tokens = 0
+        self.interval_start = time.perf_counter()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+    def _now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _advance(self, timer):
+        now = self._now()
+        self.timers[timer] += now - self.cursor
+        self.cursor = now
+
+    def _count_tokens(self, module, args, kwargs):
+        if not module.training:
+            return
+        input_ids = kwargs.get("input_ids", args[0] if args else None)
+        if input_ids is None:
+            return
+        self.tokens += input_ids.numel()
+        attention_mask = kwargs.get("attention_mask")
+        # a device tensor, only converted in record: int() here would sync every forward
+        self.non_pad_tokens += attention_mask.sum() if attention_mask is not None else input_ids.numel()
+
+    def on_train_begin(self, args, state, control, model=None, **kwargs):
+        if model is not None:
+            self.hook = model.register_forward_pre_hook(self._count_tokens, with_kwargs=True)
+        if state.is_world_process_zero and not self.prometheus:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._reset()
+        self.train_start = self.cursor = self._now()
+        # the state of a resumed run starts at its checkpoint step
+        self.start_step = state.global_step
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self._advance("data_wait")
+
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        self._advance("forward_backward")
+
+    def on_optimizer_step(self, args, state, control, **kwargs):
+        self._advance("optimizer")
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self._advance("other")
+        self.steps += 1
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        self._advance("evaluation")
+
+    def on_save(self, args, state, control, **kwargs):
+        self._advance("checkpoint")
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        # evaluation logs come in the middle of the evaluation, its time is taken on_evaluate
+        if logs is None or "loss" not in logs:
+            return
+        self._advance("other")
+        self._emit(state)
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self.steps:
+            self._advance("other")
+            self._emit(state)
+        if self.hook is not None:
+            self.hook.remove()
+            self.hook = None
+
+    def record(self, state):
+        elapsed = max(time.perf_counter() - self.interval_start, 1e-9)
+        non_pad_tokens = int(self.non_pad_tokens)
+        step_time = (time.perf_counter() - self.train_start) / max(state.global_step - self.start_step, 1)
+        record = {
+            "step": state.global_step,
+            "epoch": state.epoch,
+            "time": time.time(),
+            "interval_seconds": elapsed,
+            "steps": self.steps,
+            "tokens": self.tokens,
+            "non_pad_tokens": non_pad_tokens,
+            "tokens_per_second": self.tokens / elapsed,
+            "non_pad_tokens_per_second": non_pad_tokens / elapsed,
+            "eta_seconds": max(state.max_steps - state.global_step, 0) * step_time,
+        }
+        for timer, seconds in self.timers.items():
+            record[f"{timer}_seconds"] = seconds
+        record["data_wait_fraction"] = self.timers["data_wait"] / elapsed
+        record["host_peak_memory_mb"] = host_peak_memory_mb()
+        if torch.cuda.is_available():
+            record["device_peak_memory_mb"] = torch.cuda.max_memory_allocated() / (1 << 20)
+            record["device_peak_reserved_mb"] = torch.cuda.max_memory_reserved() / (1 << 20)
+        return record
+
+    def _emit(self, state):
+        record = self.record(state)
+        self._reset()
+        if not state.is_world_process_zero:
+            return
+        if self.prometheus:
+            self._write_prometheus(record)
+        else:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+
+    def _write_prometheus(self, record):
+        lines = []
+        for key, value in record.items():
+            if isinstance(value, (int, float)):
+                lines.append(f"# TYPE train_{key} gauge")
+                lines.append(f"train_{key} {value}")
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,240 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from common.loading import default_workers
+
+"""
+Single-pass tokenization of prompt/completion pairs with the prompt masked out of the labels.
+
+Each pair is tokenized once, as the full text prompt + separator + completion + suffix,
+in one batched call, so the ids are exactly those of the text the model is later
+prompted with: tokenizing the parts apart would not be (SentencePiece tokenizers such
+as Mistral's prepend "▁" to every text, BPE merges may cross the boundary). The
+prompt length is the number of tokens starting before the completion, read from the
+offset mapping. Labels of the whole batch are masked at once on the flattened ids.
+
+Pairs for the formats of the repo:
+    codet5 / input-output JSONL    (input, output) with separator=tokenizer.eos_token
+    ChatML (data_mistral)          inst_pair(messages), the [INST] format Mistral is trained on,
+                                   or chat_pairs(tokenizer, conversations) for the tokenizer chat template
+    starcoderbase CSV              question/response, see prepare_sample_pair in data_starcoderbase/finetune.py
+
+`cached_map` saves the output of a tokenizing `map` in a cache shared by the notebooks and
+scripts, keyed by the content of the dataset, the tokenizer, a template and max_length:
+repeated runs and sweeps over the same data load it memory-mapped instead of tokenizing again.
+"""
+
+IGNORE_INDEX = -100
+TOKEN_CACHE_DIR = ".token_cache"
+# part of every cache key: bump it when the tokenization functions of this module change their output
+CACHE_VERSION = 2
+
+
+def _ids(tokenizer, texts):
+    if not texts:
+        return []
+    return tokenizer(list(texts), add_special_tokens=False, truncation=False)["input_ids"]
+
+
+def mask_prompts(input_ids, prompt_lengths, ignore_index=IGNORE_INDEX):
+    """Labels for each of `input_ids`: a copy of the ids with the first `prompt_lengths[i]` positions set to `ignore_index`."""
+    lengths = np.fromiter((len(ids) for ids in input_ids), dtype=np.int64, count=len(input_ids))
+    if lengths.sum() == 0:
+        return [[] for _ in input_ids]
+    flat = np.concatenate([np.asarray(ids, dtype=np.int64) for ids in input_ids])
+    starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    positions = np.arange(len(flat)) - starts
+    flat[positions < np.repeat(np.asarray(prompt_lengths, dtype=np.int64), lengths)] = ignore_index
+    return [labels.tolist() for labels in np.split(flat, np.cumsum(lengths)[:-1])]
+
+
+def tokenize_pairs(tokenizer, prompts, completions, separator="", suffix="", max_length=None, add_bos=None):
+    """
+    Tokenize prompt/completion pairs into `input_ids` and `labels` trained on the completion only.
+        Args:
+            tokenizer: Hugging Face tokenizer.
+            prompts (list): Prompt texts.
+            completions (list): Completion texts.
+            separator (str): Text between prompt and completion, masked with the prompt (e.g. the EOS token).
+            suffix (str): Text after the completion, trained with it (e.g. the EOS token).
+            max_length (int): If set, sequences are truncated to this many tokens, completion end first.
+            add_bos (bool): Prepend the BOS token; defaults to what the tokenizer does on its own.
+        Returns a dict of lists with `input_ids`, `labels`, `prompt_length` (masked tokens) and `length`,
+        ready to be returned from a batched `datasets.map`.
+    The ids are those of the concatenated text; a token straddling the end of the prompt is masked with it.
+    Slow tokenizers have no offset mapping: their prompts and completions are tokenized apart and concatenated.
+    """
+    if add_bos is None:
+        add_bos = bool(getattr(tokenizer, "add_bos_token", False))
+    prefix = [tokenizer.bos_token_id] if add_bos and tokenizer.bos_token_id is not None else []
+
+    if tokenizer.is_fast:
+        heads = [prompt + separator for prompt in prompts]
+        texts = [head + completion + suffix for head, completion in zip(heads, completions)]
+        encoded = tokenizer(texts, add_special_tokens=False, truncation=False, return_offsets_mapping=True)
+        pairs = []
+        for head, ids, offsets in zip(heads, encoded["input_ids"], encoded["offset_mapping"]):
+            boundary = len(head)
+            pairs.append((ids, sum(1 for start, _ in offsets if start < boundary)))
+    else:
+        separator_ids = _ids(tokenizer, [separator])[0] if separator else []
+        suffix_ids = _ids(tokenizer, [suffix])[0] if suffix else []
+        pairs = [
+            (prompt_ids + separator_ids + completion_ids + suffix_ids, len(prompt_ids) + len(separator_ids))
+            for prompt_ids, completion_ids in zip(_ids(tokenizer, prompts), _ids(tokenizer, completions))
+        ]
+
+    input_ids, prompt_lengths = [], []
+    for ids, prompt_length in pairs:
+        ids = prefix + ids
+        if max_length is not None:
+            ids = ids[:max_length]
+        input_ids.append(ids)
+        prompt_lengths.append(min(len(prefix) + prompt_length, len(ids)))
+
+    return {
+        "input_ids": input_ids,
+        "labels": mask_prompts(input_ids, prompt_lengths),
+        "prompt_length": prompt_lengths,
+        "length": [len(ids) for ids in input_ids],
+    }
+
+
+def chat_pairs(tokenizer, conversations):
+    """
+    Split each ChatML conversation rendered with the tokenizer chat template into (prompt, completion) texts:
+    everything up to the generation prompt of the last assistant message, and that message with the closing tokens.
+    Tokenize them with add_bos=False, the template already renders the special tokens.
+    """
+    prompts, completions = [], []
+    for messages in conversations:
+        full = tokenizer.apply_chat_template(messages, tokenize=False)
+        prompt = tokenizer.apply_chat_template(messages[:-1], tokenize=False, add_generation_prompt=True)
+        if not full.startswith(prompt):
+            raise ValueError("the chat template does not render the prompt as a prefix of the conversation")
+        prompts.append(prompt)
+        completions.append(full[len(prompt) :])
+    return prompts, completions
+
+
+def inst_pair(messages):
+    """
+    (prompt, completion) texts of a ChatML conversation in the Mistral [INST] format of finetune_mistral.ipynb:
+    "<s>[INST] {system}\n\n{user} [/INST]", earlier assistant turns as " {answer} </s>" in the prompt, and the
+    final assistant message as the completion " {answer} </s>", "" if the conversation ends with the user.
+    Contents are stripped. Tokenize with add_bos=False, the prompt starts with <s>.
+    """
+    prompt = ""
+    completion = ""
+    system_prompt = ""
+    for i, msg in enumerate(messages):
+        role = msg["role"]
+        content = msg["content"].strip()
+
+        if role == "system":
+            system_prompt = content
+        elif role == "user":
+            if i == 1 and messages[0]["role"] == "system":
+                # system + first user message inside one [INST] block
+                prompt += f"<s>[INST] {system_prompt}\n\n{content} [/INST]"
+            else:
+                prompt += f"<s>[INST] {content} [/INST]"
+        elif role == "assistant" and i == len(messages) - 1:
+            completion = f" {content} </s>"
+        elif role == "assistant":
+            prompt += f" {content} </s>"
+    return prompt, completion
+
+
+def tokenizer_fingerprint(tokenizer):
+    """Hash of the tokenizer definition, so that two names for the same tokenizer share their cache."""
+    if tokenizer.is_fast:
+        definition = tokenizer.backend_tokenizer.to_str()
+    else:
+        definition = json.dumps(tokenizer.get_vocab(), sort_keys=True)
+    return hashlib.sha256(definition.encode("utf-8")).hexdigest()[:16]
+
+
+def dataset_fingerprint(dataset, batch_size=10000):
+    """
+    Hash of the rows of a `datasets.Dataset` in their order, whatever file they were read from,
+    and of the transform rendering them, if any (see common/dataset_store.py).
+    """
+    import pyarrow as pa
+    from datasets.fingerprint import Hasher
+
+    h = hashlib.sha256()
+    if dataset.format["type"] == "custom":
+        h.update(Hasher.hash(dataset.format["format_kwargs"]["transform"]).encode("utf-8"))
+    arrow = dataset.with_format("arrow")
+    for start in range(0, len(dataset), batch_size):
+        sink = pa.BufferOutputStream()
+        table = arrow[start : start + batch_size]
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        h.update(sink.getvalue())
+    return h.hexdigest()[:16]
+
+
+def token_cache_key(dataset, tokenizer, template="", max_length=None):
+    """Cache key of the tokenization of `dataset`, `template` naming whatever else shapes the tokens."""
+    parts = [
+        CACHE_VERSION,
+        dataset_fingerprint(dataset),
+        tokenizer_fingerprint(tokenizer),
+        getattr(tokenizer, "chat_template", None),
+        template,
+        max_length,
+    ]
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def save_entry(dataset, path):
+    """Save `dataset` to the cache entry `path` atomically, so that concurrent runs never read a partial entry."""
+    tmp = f"{path}.tmp-{os.getpid()}"
+    dataset.save_to_disk(tmp)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # another run saved the same entry first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def cached_map(dataset, function, tokenizer, cache_dir=TOKEN_CACHE_DIR, template="", max_length=None, num_proc=None, batch_size=1000, remove_columns=None):
+    """
+    `dataset.map(function, batched=True)` computed once by `num_proc` processes and saved in `cache_dir`; later calls
+    with the same rows, tokenizer, `template` and `max_length` load the saved result, memory-mapped.
+        Args:
+            dataset: A `datasets.Dataset`, or a `DatasetDict` mapped split by split.
+            function: Batched tokenizing function, e.g. calling `tokenize_pairs`.
+            tokenizer: The tokenizer `function` uses; its definition and chat template are part of the key.
+            cache_dir (str): Directory of the cache entries, one `save_to_disk` directory each.
+            template (str): Names the prompt format and the options of `function`, which is not hashed itself:
+                change it whenever the function would tokenize the same rows differently.
+            max_length (int): Truncation length used by `function`, part of the key.
+            num_proc (int): Processes tokenizing, all the CPUs by default.
+            remove_columns (list): Columns of `dataset` dropped from the output.
+    """
+    from datasets import DatasetDict, load_from_disk
+
+    if isinstance(dataset, DatasetDict):
+        return DatasetDict(
+            {
+                split: cached_map(d, function, tokenizer, cache_dir, template, max_length, num_proc, batch_size, remove_columns)
+                for split, d in dataset.items()
+            }
+        )
+    path = os.path.join(cache_dir, token_cache_key(dataset, tokenizer, template, max_length))
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        num_proc = min(default_workers() if num_proc is None else num_proc, -(-len(dataset) // batch_size))
+        mapped = dataset.map(
+            function, batched=True, batch_size=batch_size, num_proc=num_proc if num_proc > 1 else None, remove_columns=remove_columns
+        )
+        # the rows were rendered by the transform of `dataset`, if any, the output is plain
+        save_entry(mapped.with_format(None), path)
+    return load_from_disk(path)
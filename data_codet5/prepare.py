@@ -1,157 +1,198 @@
+import argparse
 import json
-import random
+import sys
 from pathlib import Path
 import pandas as pd
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from common.dedup import dedup_plan
+from common.manifest import SourceCache
+from common.prompts import PromptRegistry
+from common.splits import SplitWriter, assign_split, record_id
+
 # === CONFIGURATION ===
 tune_input_dir = Path(".data/test_data_1").absolute()
 spec_input_dir = Path(".data/spec_data").absolute()
 
 
+# Prompts are stored once in data_codet5/prompts.json; records only carry the prompt id
+prompt_registry = PromptRegistry()
+
 def add_prompt(prompt, record):
     return {
-        "input": prompt + "\n\n" + record["input"],
+        "prompt_id": prompt_registry.register(prompt),
+        "input": record["input"],
         "output": record["output"]
     }
 
 # === Load and process wf_*.json files ===
-def load_tune_data(input_dir):
-    jsonl_pairs = []
+def load_tune_file(file):
+    pairs = []
+    with open(file, "r") as f:
+        data = json.load(f)
+
+    for k in data.keys():
+        content = data[k]
+
+        instructions = content.get("instructions", [])
+        workflow = content.get("workflow", [])
+        metadata = content.get("metadata", {})
+
+        user_input = json.dumps({
+            "metadata": metadata,
+            "instructions": instructions
+        }, separators=(',', ':'))
+
+        model_output = json.dumps({
+            "workflow": workflow
+        }, separators=(',', ':'))
+
+        pairs.append({
+            "input": user_input,
+            "output": model_output
+        })
+    return pairs
+
+def load_records_file(file):
+    with open(file, "r") as f:
+        return json.load(f)
+
+def load_tune_data(input_dir, source_cache, workers=None):
     prompt = ""
     with open(input_dir / "prompt.md", "r") as f:
         prompt = f.read()
         
-    for file in input_dir.glob("*.json"):
-        if file.name == "prompt.md":
-            continue
-        with open(file, "r") as f:
-            data = json.load(f)
-
-        for k in data.keys():
-            content = data[k]
-
-            instructions = content.get("instructions", [])
-            workflow = content.get("workflow", [])
-            metadata = content.get("metadata", {})
-
-            user_input = json.dumps({
-                "metadata": metadata,
-                "instructions": instructions
-            }, separators=(',', ':'))
-
-            model_output = json.dumps({
-                "workflow": workflow
-            }, separators=(',', ':'))
-
-            jsonl_pairs.append(add_prompt(prompt, {
-                "input": user_input,
-                "output": model_output
-            }))
-    return jsonl_pairs
+    files = [file for file in sorted(input_dir.glob("*.json")) if file.name != "prompt.md"]
+    for records in source_cache.iter_many(files, load_tune_file, workers):
+        for r in records:
+            yield add_prompt(prompt, r)
 
 # === Load and process spec*.json + validity_dataset.py ===
-def load_spec_data(spec_dir):
-    spec_pairs = []
-
+def load_spec_data(spec_dir, source_cache, workers=None):
     prompt = ""
     with open(spec_dir / "prompt.md", "r") as f:
         prompt = f.read()
 
-
     # Load spec*.json files
-    for file in spec_dir.glob("spec*.json"):
-        with open(file, "r") as f:
-            records = json.load(f)
-            for r in records:
-                spec_pairs.append(add_prompt(prompt, r))
+    for records in source_cache.iter_many(sorted(spec_dir.glob("spec*.json")), load_records_file, workers):
+        for r in records:
+            yield add_prompt(prompt, r)
+
+def load_spec_validity_data(spec_dir, source_cache):
+    prompt = ""
+    with open(spec_dir / "prompt.md", "r") as f:
+        prompt = f.read()
 
     # Load validation_data from validity_dataset.py
-    spec_val = []
     val_path = spec_dir / "validity_dataset.json"
     if val_path.exists():
-        with open(val_path, "r") as f:
-            loaded = json.load(f)
-            for r in loaded:
-                spec_val.append(add_prompt(prompt, r))
-
-    return spec_pairs, spec_val
-
-# === Load datasets ===
-tune_data = load_tune_data(tune_input_dir)
-spec_data, spec_val_data = load_spec_data(spec_input_dir)
-
-# === Reserve 10% of spec_data for test, then merge the rest ===
-random.shuffle(spec_data)
-n_spec = len(spec_data)
-spec_test_end = int(n_spec * 0.1)
-spec_test_data = spec_data[:spec_test_end]
-spec_train_data = spec_data[spec_test_end:]
-
-n_tune = len(tune_data)
-tune_train_end = int(n_tune * 0.8)
-tune_test_end = int(n_tune * 0.9)
-
-tune_train_data = tune_data[:tune_train_end]
-tune_test_data = tune_data[tune_train_end:tune_test_end]
-tune_val_data = tune_data[tune_test_end:]
-
-
-# Combine tune + spec train data
-combined_train = tune_train_data + spec_train_data
-combined_test = tune_test_data + spec_test_data
-combined_val = tune_val_data + spec_val_data
-
-# Shuffle everything
-random.shuffle(combined_train)
-random.shuffle(combined_test)
-random.shuffle(combined_val)
-
-# Compute max lengths
-max_input_len = max([len(d["input"]) for d in combined_train + combined_test + combined_val], default=0)
-max_output_len = max([len(d["output"]) for d in combined_train + combined_test + combined_val], default=0)
-
-min_input_len = min([len(d["input"]) for d in combined_train + combined_test + combined_val], default=0)
-min_output_len = min([len(d["output"]) for d in combined_train + combined_test + combined_val], default=0)
-
-for d in combined_train + combined_test + combined_val:
-    if len(d["input"]) == min_input_len:
-        print(d)
-
-for d in combined_train + combined_test + combined_val:
-    if len(d["output"]) == min_output_len:
-        print(d)
-
-output_train_path = Path("data_codet5/training_data.jsonl")
-output_test_path = Path("data_codet5/test_data.jsonl")
-output_val_path = Path("data_codet5/validation_data.jsonl")
-
-def write_jsonl_file(path, data):
-    with open(path, "w") as f:
-        for item in data:
-            f.write(json.dumps(item, separators=(',', ':')) + "\n")
-
-write_jsonl_file(output_train_path, combined_train)
-write_jsonl_file(output_test_path, combined_test)
-write_jsonl_file(output_val_path, combined_val)
-
-# Display summary
-df = pd.DataFrame({
-    "Set": [
-        "WF_Data","SP_Data",
-        "WF_Training", "WF_Test", "WF_Validation",
-        "SP_Training", "SP_Test", "SP_Validation",
-        "Training", "Test", "Validation", 
-        "Max Input Length", "Max Output Length",
-        "Min Input Length", "Min Output Length"
-        ],
-    "Count": [
-        len(tune_data), len(spec_data), 
-        len(tune_train_data), len(tune_test_data), len(tune_val_data), 
-        len(spec_train_data), len(spec_test_data), len(spec_val_data), 
-        len(combined_train), len(combined_test), len(combined_val), 
-        max_input_len, max_output_len,
-        min_input_len, min_output_len
-        ]
-})
-
-print(df)
+        for r in source_cache.load(val_path, load_records_file):
+            yield add_prompt(prompt, r)
+
+output_paths = {
+    "train": Path("data_codet5/training_data.jsonl"),
+    "test": Path("data_codet5/test_data.jsonl"),
+    "validation": Path("data_codet5/validation_data.jsonl"),
+}
+
+# split of each record, picked from the hash of its input and output
+TUNE_SPLITS = [("train", 0.8), ("test", 0.1), ("validation", 0.1)]
+SPEC_SPLITS = [("train", 0.9), ("test", 0.1)]
+
+
+class LengthStats:
+    """Running min/max of the input (prompt included) and output lengths, with the shortest records."""
+
+    def __init__(self):
+        self.count = 0
+        self.max_input_len = self.max_output_len = 0
+        self.min_input_len = self.min_output_len = None
+        self.min_input_record = self.min_output_record = None
+
+    def add(self, d):
+        input_len = len(prompt_registry.expand(d)["input"])
+        output_len = len(d["output"])
+        self.count += 1
+        self.max_input_len = max(self.max_input_len, input_len)
+        self.max_output_len = max(self.max_output_len, output_len)
+        if self.min_input_len is None or input_len < self.min_input_len:
+            self.min_input_len, self.min_input_record = input_len, d
+        if self.min_output_len is None or output_len < self.min_output_len:
+            self.min_output_len, self.min_output_record = output_len, d
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=None, help="processes parsing the source files, 1 to parse serially")
+    parser.add_argument("--split_salt", type=str, default="", help="change to draw a different, equally stable, split")
+    parser.add_argument("--dedup_threshold", type=float, default=0.8, help="MinHash similarity of near-duplicates, 0 to disable")
+    parser.add_argument("--keep_duplicates", action="store_true", help="keep every near-duplicate, still in its cluster's split")
+    return parser.parse_args()
+
+
+def main(args):
+    # parsed records of each source file, reused while the file content is unchanged
+    source_cache = SourceCache("data_codet5/.prep_cache")
+    stats = LengthStats()
+
+    # (record, its splits, split pinned for its near-duplicate cluster) of every source, the validity
+    # records being the validation set
+    def records():
+        for d in load_tune_data(tune_input_dir, source_cache, args.workers):
+            yield d, TUNE_SPLITS, None
+        for d in load_spec_data(spec_input_dir, source_cache, args.workers):
+            yield d, SPEC_SPLITS, None
+        for d in load_spec_validity_data(spec_input_dir, source_cache):
+            yield d, None, "validation"
+
+    # === Cluster near-duplicate inputs, then stream every record to the split chosen from its cluster ===
+    plan = dedup_plan(
+        ((d["input"], record_id(d["input"], d["output"]), pinned) for d, _, pinned in records()), args.dedup_threshold
+    )
+    tune_counts = {split: 0 for split in output_paths}
+    # one split per cluster, drawn from the splits of its first record: a cluster of tune and spec
+    # records would otherwise be split with two different tables
+    cluster_splits = {}
+    with SplitWriter(output_paths) as out:
+        for (d, splits, _), (cluster, pinned, representative) in zip(records(), plan):
+            if not (representative or args.keep_duplicates):
+                continue
+            split = pinned or cluster_splits.setdefault(cluster, assign_split(cluster, splits, args.split_salt))
+            out.write(split, d)
+            if splits is TUNE_SPLITS:
+                tune_counts[split] += 1
+            stats.add(d)
+    source_cache.save()
+    prompt_registry.save("data_codet5")
+
+    print(stats.min_input_record)
+    print(stats.min_output_record)
+
+    # Display summary
+    combined, tune = out.counts, tune_counts
+    spec = {split: combined[split] - tune[split] for split in combined}
+    df = pd.DataFrame({
+        "Set": [
+            "WF_Data","SP_Data",
+            "WF_Training", "WF_Test", "WF_Validation",
+            "SP_Training", "SP_Test", "SP_Validation",
+            "Training", "Test", "Validation", 
+            "Max Input Length", "Max Output Length",
+            "Min Input Length", "Min Output Length"
+            ],
+        "Count": [
+            sum(tune.values()), spec["train"] + spec["test"],
+            tune["train"], tune["test"], tune["validation"],
+            spec["train"], spec["test"], spec["validation"],
+            combined["train"], combined["test"], combined["validation"],
+            stats.max_input_len, stats.max_output_len,
+            stats.min_input_len or 0, stats.min_output_len or 0
+            ]
+    })
+
+    print(df)
+
+
+if __name__ == "__main__":
+    main(get_args())
@@ -1,7 +1,15 @@
+import argparse
 import json
 import os
-import random
 import hashlib
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.dedup import dedup_plan
+from common.manifest import SourceCache
+from common.prompts import PromptRegistry
+from common.splits import SplitWriter, assign_split, concat_files
 
 TAMARIND_PATH = "C:/Users/fab_c/work/github/smartrics/tamarind"
 TRAINING_PATH = f"{TAMARIND_PATH}/apps/training"
@@ -14,6 +22,10 @@ SPEC_PROMPT_FILES = [f"{SPEC_DATA_PATH}/prompt.md" ]
 
 LOCAL_DATA_PATH = "./data"
 
+# split of each record, picked from the hash of its id
+WF_SPLITS = [("training", 0.8), ("validation", 0.1), ("test", 0.1)]
+SPEC_SPLITS = [("training", 0.9), ("test", 0.1)]
+
 
 def make_system_prompt(p_list):
     # Load and concatenate system prompt from files
@@ -30,54 +42,13 @@ def system_message(p_list) :
     "content": make_system_prompt(p_list).strip(),  # Ensures the prompt is cleanly formatted
 }
 
-def spec_load_data():
-    data_array = []
-    for filename in os.listdir(SPEC_DATA_PATH):
-        if filename.startswith("spec_") and filename.endswith(".json"):
-            file_path = os.path.join(SPEC_DATA_PATH, filename)
-            with open(file_path, "r", encoding="utf-8") as file:
-                content = json.load(file)
-                for elem in content:
-                    _in = elem.get("input")
-                    _out = elem.get("output")
-                    tot = _in + _out
-                    val = {
-                        "id": str(hashlib.sha256(tot.encode()).hexdigest()),
-                        "input": _in,
-                        "output": _out,
-                    }
-                    data_array.append(val)
-                print(f"Loaded {filename} - list size: {len(content)} - total size: {len(data_array)}")
-
-    random.shuffle(data_array)
-    return data_array
-
-
-def wf_load_data():
-    # Load JSON files into data_dict
-    data_array = []
-
-    for filename in os.listdir(WF_DATA_PATH):
-        if filename.startswith("data_") and filename.endswith(".json"):
-            file_path = os.path.join(WF_DATA_PATH, filename)
-            with open(file_path, "r", encoding="utf-8") as file:
-                content: dict = json.load(file)
-                for key in content:
-                    val = {
-                        "instructions": content[key]["instructions"],
-                        "metadata": content[key]["metadata"],
-                        "workflow": content[key]["workflow"],
-                        "id": key
-                    }
-                    data_array.append(val)
-                print(f"Loaded {filename} - dict size: {len(content)} - total size: {len(data_array)}")
-
-    random.shuffle(data_array)
-    return data_array
+# Each system prompt is read once and stored in prompts.json; records only carry its id
+prompt_registry = PromptRegistry()
+WF_PROMPT_ID = prompt_registry.register(system_message(WF_PROMPT_FILES)["content"])
+SPEC_PROMPT_ID = prompt_registry.register(system_message(SPEC_PROMPT_FILES)["content"])
 
-def spec_load_validity_data():
+def spec_load_file(file_path):
     data_array = []
-    file_path = os.path.join(SPEC_DATA_PATH, "validity_dataset.json")
     with open(file_path, "r", encoding="utf-8") as file:
         content: list = json.load(file)
         for elem in content:
@@ -90,45 +61,87 @@ def spec_load_validity_data():
                 "output": _out,
             }
             data_array.append(val)
-        print(f"Loaded {file_path} - list size: {len(content)} - total size: {len(data_array)}")
+    return data_array
+
+
+def wf_load_file(file_path):
+    data_array = []
+    with open(file_path, "r", encoding="utf-8") as file:
+        content: dict = json.load(file)
+        for key in content:
+            val = {
+                "instructions": content[key]["instructions"],
+                "metadata": content[key]["metadata"],
+                "workflow": content[key]["workflow"],
+                "id": key
+            }
+            data_array.append(val)
+    return data_array
+
+
+def spec_load_data(source_cache, workers=None):
+    # Stream the records of the spec_*.json files, parsing them in parallel
+    total = 0
+    filenames = [f for f in sorted(os.listdir(SPEC_DATA_PATH)) if f.startswith("spec_") and f.endswith(".json")]
+    paths = [os.path.join(SPEC_DATA_PATH, f) for f in filenames]
+    for filename, records in zip(filenames, source_cache.iter_many(paths, spec_load_file, workers)):
+        total += len(records)
+        print(f"Loaded {filename} - list size: {len(records)} - total size: {total}")
+        yield from records
+
+
+def wf_load_data(source_cache, workers=None):
+    # Stream the records of the data_*.json files, parsing them in parallel
+    total = 0
+    filenames = [f for f in sorted(os.listdir(WF_DATA_PATH)) if f.startswith("data_") and f.endswith(".json")]
+    paths = [os.path.join(WF_DATA_PATH, f) for f in filenames]
+    for filename, records in zip(filenames, source_cache.iter_many(paths, wf_load_file, workers)):
+        total += len(records)
+        print(f"Loaded {filename} - dict size: {len(records)} - total size: {total}")
+        yield from records
+
+def spec_load_validity_data(source_cache):
+    file_path = os.path.join(SPEC_DATA_PATH, "validity_dataset.json")
+    data_array = source_cache.load(file_path, spec_load_file)
+    print(f"Loaded {file_path} - list size: {len(data_array)} - total size: {len(data_array)}")
 
     return data_array
 
 def spec_process(arr: list):
-    df_formatted = []
-    for pt in arr:
-        obj = {}
-        obj["id"] = pt["id"]
-        obj["messages"] = []
-        obj["messages"].append(system_message(SPEC_PROMPT_FILES))
-        obj["messages"].append(
-            {
-                "role": "user",
-                "content": pt["input"],
-            }
-        )
-        obj["messages"].append(
-            {
-                "role": "assistant",
-                "content": pt["output"],
-            }
-        )
-        df_formatted.append(obj)
-    return df_formatted
+    return [spec_format(pt) for pt in arr]
+
+def spec_format(pt):
+    obj = {}
+    obj["id"] = pt["id"]
+    obj["prompt_id"] = SPEC_PROMPT_ID
+    obj["messages"] = []
+    obj["messages"].append(
+        {
+            "role": "user",
+            "content": pt["input"],
+        }
+    )
+    obj["messages"].append(
+        {
+            "role": "assistant",
+            "content": pt["output"],
+        }
+    )
+    return obj
 
 # Convert data_dict to the required format
 def wf_process(arr: list):
-    df_formatted = []
-
-    for pt in arr:
-        obj = {}
-        obj["id"] = pt["id"]
-        obj["messages"] = []
-        obj["messages"].append(system_message(WF_PROMPT_FILES))
-        obj["messages"].append(
-            {
-                "role": "user",
-                "content": f"""
+    return [wf_format(pt) for pt in arr]
+
+def wf_format(pt):
+    obj = {}
+    obj["id"] = pt["id"]
+    obj["prompt_id"] = WF_PROMPT_ID
+    obj["messages"] = []
+    obj["messages"].append(
+        {
+            "role": "user",
+            "content": f"""
                 ### Input:
                 {json.dumps(pt["instructions"])}
 
@@ -137,57 +150,70 @@ def wf_process(arr: list):
 
                 ### Response:
                 """,
-            }
-        )
-        obj["messages"].append(
-            {
-                "role": "assistant",
-                "content": json.dumps(pt["workflow"]),
-            }
-        )
-        df_formatted.append(obj)
-    return df_formatted
-
-
-data_array = wf_load_data()
-total_count = len(data_array)
-train_count = int(0.8 * total_count)
-val_count = int(0.1 * total_count)
-
-data_array = wf_process(data_array)
-
-training_data = data_array[:train_count]
-validation_data = data_array[train_count:train_count + val_count]
-test_data = data_array[train_count + val_count:]
-
-def to_jsonl(json_array, filename):
-    with open(filename, "w") as f:
-        for item in json_array:
-            f.write(json.dumps(item, separators=(",", ":")) + "\n")
-
-to_jsonl(training_data, f"{LOCAL_DATA_PATH}/wf_training_data.jsonl")
-to_jsonl(validation_data, f"{LOCAL_DATA_PATH}/wf_validation_data.jsonl")
-to_jsonl(test_data, f"{LOCAL_DATA_PATH}/wf_test_data.jsonl")
-
-print(f"wf data. training_len={len(training_data)}, test_len={len(test_data)}, valdation_len={len(validation_data)} ")
-
-data_array = spec_load_data()
-total_count = len(data_array)
-train_count = int(0.9 * total_count)
-data_array = spec_process(data_array)
-training_data = data_array[:train_count]
-test_data = data_array[train_count:]
-validation_data = spec_process(spec_load_validity_data())
-
-to_jsonl(training_data, f"{LOCAL_DATA_PATH}/spec_training_data.jsonl")
-to_jsonl(validation_data, f"{LOCAL_DATA_PATH}/spec_validation_data.jsonl")
-to_jsonl(test_data, f"{LOCAL_DATA_PATH}/spec_test_data.jsonl")
-
-print(f"spec data. training_len={len(training_data)}, test_len={len(test_data)}, valdation_len={len(validation_data)} ")
-
-for f in ["test_data.jsonl", "training_data.jsonl", "validation_data.jsonl"]:
-    with open(f"{LOCAL_DATA_PATH}/{f}", "w") as dest:
-        wf = open(f"{LOCAL_DATA_PATH}/wf_{f}", "r").read()
-        spec = open(f"{LOCAL_DATA_PATH}/spec_{f}", "r").read()
-        dest.write(wf)
-        dest.write(spec)
+        }
+    )
+    obj["messages"].append(
+        {
+            "role": "assistant",
+            "content": json.dumps(pt["workflow"]),
+        }
+    )
+    return obj
+
+
+def wf_dedup_text(pt):
+    # near-duplicates are found on what the model reads, not on the answer
+    return json.dumps(pt["instructions"]) + "\n" + json.dumps(pt["metadata"])
+
+
+def split_paths(prefix):
+    return {split: f"{LOCAL_DATA_PATH}/{prefix}_{split}_data.jsonl" for split in ("training", "validation", "test")}
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=None, help="processes parsing the source files, 1 to parse serially")
+    parser.add_argument("--split_salt", type=str, default="", help="change to draw a different, equally stable, split")
+    parser.add_argument("--dedup_threshold", type=float, default=0.8, help="MinHash similarity of near-duplicates, 0 to disable")
+    parser.add_argument("--keep_duplicates", action="store_true", help="keep every near-duplicate, still in its cluster's split")
+    return parser.parse_args()
+
+
+def main(args):
+    # parsed records of each source file, reused while the file content is unchanged
+    source_cache = SourceCache(f"{LOCAL_DATA_PATH}/.prep_cache")
+
+    # a first pass clusters near-duplicates, whose split is then chosen from the id of their cluster
+    # so that no cluster spans two splits; records are streamed to their split, only signatures are kept
+    wf_plan = dedup_plan(
+        ((wf_dedup_text(pt), pt["id"], None) for pt in wf_load_data(source_cache, args.workers)), args.dedup_threshold
+    )
+    with SplitWriter(split_paths("wf")) as out:
+        for pt, (cluster, _, representative) in zip(wf_load_data(source_cache, args.workers), wf_plan):
+            if representative or args.keep_duplicates:
+                out.write(assign_split(cluster, WF_SPLITS, args.split_salt), wf_format(pt))
+    counts = out.counts
+    print(f"wf data. training_len={counts['training']}, test_len={counts['test']}, valdation_len={counts['validation']} ")
+
+    # the validity records are the validation set, their near-duplicates join them
+    def spec_records():
+        yield from ((pt, None) for pt in spec_load_data(source_cache, args.workers))
+        yield from ((pt, "validation") for pt in spec_load_validity_data(source_cache))
+
+    spec_plan = dedup_plan(((pt["input"], pt["id"], pinned) for pt, pinned in spec_records()), args.dedup_threshold)
+    with SplitWriter(split_paths("spec")) as out:
+        for (pt, _), (cluster, pinned, representative) in zip(spec_records(), spec_plan):
+            if representative or args.keep_duplicates:
+                out.write(pinned or assign_split(cluster, SPEC_SPLITS, args.split_salt), spec_format(pt))
+    counts = out.counts
+    print(f"spec data. training_len={counts['training']}, test_len={counts['test']}, valdation_len={counts['validation']} ")
+
+    prompt_registry.save(LOCAL_DATA_PATH)
+    source_cache.save()
+
+    for f in ["test_data.jsonl", "training_data.jsonl", "validation_data.jsonl"]:
+        concat_files(f"{LOCAL_DATA_PATH}/{f}", [f"{LOCAL_DATA_PATH}/wf_{f}", f"{LOCAL_DATA_PATH}/spec_{f}"])
+
+
+if __name__ == "__main__":
+    main(get_args())
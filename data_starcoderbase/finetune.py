@@ -1,5 +1,9 @@
 import argparse
 import os
+import sys
+import threading
+from collections import deque
+from pathlib import Path
 
 import torch
 from accelerate import Accelerator
@@ -9,8 +13,29 @@ from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training, se
 from torch.utils.data import IterableDataset
 from tqdm import tqdm
 from transformers import TrainerCallback, TrainerState, TrainerControl, TrainingArguments
+from transformers.trainer_callback import ExportableState
 from transformers import AutoModelForCausalLM, AutoTokenizer, Trainer, logging, set_seed
-from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from common.checkpointing import AsyncCheckpointTrainer, complete_checkpoints
+from common.model_cache import load_cached_model
+from common.tokenization import cached_map, tokenize_pairs
+from common.telemetry import TelemetryCallback
+from pack_tokens import PackedTokenDataset, cached_pack, load_splits
+from packing import (
+    BinPackedDataset,
+    documents_from_packed,
+    mask_documents,
+    print_packing_stats,
+    tokenize_documents,
+    tokenize_pair_documents,
+)
+from prefetch import TokenBudgetQueue
+from sharding import iter_from, shard_dataset, shard_info
+
+# seconds the background tokenizer is given to finish its current batch once the iteration stops
+PRODUCER_JOIN_TIMEOUT = 30
 
 
 def patched_load_rng_state(self, checkpoint_folder):
@@ -34,22 +59,24 @@ Fine-Tune StarCoder on Code Alpaca/SE
 class ETACallback(TrainerCallback):
     def __init__(self):
         self.start_time = None
+        self.start_step = 0
 
     def on_step_begin(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
         if self.start_time is None:
             self.start_time = time.time()
+            self.start_step = state.global_step
 
     def on_log(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, logs=None, **kwargs):
-        if self.start_time is None or state.global_step == 0:
+        # state.max_steps is set by the Trainer for epoch based runs too, unlike args.max_steps (-1)
+        if self.start_time is None or state.global_step <= self.start_step or state.max_steps <= 0:
             return
 
         elapsed = time.time() - self.start_time
-        steps_completed = state.global_step
-        total_steps = args.max_steps
+        steps_completed = state.global_step - self.start_step
+        total_steps = state.max_steps - self.start_step
 
-        percent_done = steps_completed / total_steps
-        estimated_total_time = elapsed / percent_done
-        eta = estimated_total_time - elapsed
+        percent_done = state.global_step / state.max_steps
+        eta = elapsed / steps_completed * (total_steps - steps_completed)
 
         def hms(seconds):
             h = int(seconds // 3600)
@@ -60,21 +87,48 @@ class ETACallback(TrainerCallback):
         print(f"[ETA] {percent_done:.1%} complete — Elapsed: {hms(elapsed)}, Remaining: {hms(eta)}")
 
 
-class SavePeftModelCallback(TrainerCallback):
-    def on_save(
-        self,
-        args: TrainingArguments,
-        state: TrainerState,
-        control: TrainerControl,
-        **kwargs,
-    ):
-        checkpoint_folder = os.path.join(args.output_dir, f"{PREFIX_CHECKPOINT_DIR}-{state.global_step}")
+class DatasetStateCallback(TrainerCallback, ExportableState):
+    """
+    Save the iteration state of the training ConstantLengthDataset in the trainer_state.json of each checkpoint,
+    taken right after the last sequence consumed by an optimizer step.
+    """
 
-        kwargs["model"].save_pretrained(checkpoint_folder)
+    def __init__(self, dataset, dataset_state=None):
+        self.dataset = dataset
+        self.dataset_state = dataset_state
+
+    def on_step_end(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
+        samples = state.global_step * args.gradient_accumulation_steps * args.train_batch_size * args.world_size
+        self.dataset_state = self.dataset.state_dict(samples)
+
+    def state(self):
+        return {"args": {}, "attributes": {"dataset_state": self.dataset_state}}
+
+    @staticmethod
+    def from_checkpoint(checkpoint_dir):
+        """Dataset state saved in `checkpoint_dir`, None if there is none."""
+        state = TrainerState.load_from_json(os.path.join(checkpoint_dir, "trainer_state.json"))
+        saved = state.stateful_callbacks.get(DatasetStateCallback.__name__) or {}
+        return saved.get("attributes", {}).get("dataset_state")
+
+
+class PrefetchMetricsCallback(TrainerCallback):
+    """Print the producer queue metrics of a ConstantLengthDataset running with background_tokenization."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def on_log(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, logs=None, **kwargs):
+        metrics = self.dataset.prefetch_metrics()
+        if not metrics:
+            # nothing to report from the main process when the dataset is iterated in DataLoader workers
+            return
+        print(
+            f"[data] queue {metrics['queue_tokens']} tokens (avg fill {metrics['queue_fill']:.0%}, "
+            f"max {metrics['queue_tokens_max']}) — stalls: {metrics['data_stalls']}, "
+            f"{metrics['data_stall_time']:.2f}s waiting on tokenization"
+        )
 
-        pytorch_model_path = os.path.join(checkpoint_folder, "pytorch_model.bin")
-        torch.save({}, pytorch_model_path)
-        return control
 
 try:
     from safetensors.torch import load_file as safe_load
@@ -134,11 +188,24 @@ def get_args():
     parser.add_argument("--dataset_name", type=str, default="HuggingFaceH4/CodeAlpaca_20K")
     parser.add_argument("--dataset_path", type=str, default="./dataset.csv")
     parser.add_argument("--dataset_type", type=str, default="csv")
+    parser.add_argument("--packed_dataset_path", type=str, default=None)
+    parser.add_argument("--packing", type=str, default="concat", choices=["concat", "bfd"])
+    parser.add_argument("--mask_prompt", action="store_true", help="with --packing bfd, compute the loss on the answers only")
     parser.add_argument("--subset", type=str)
     parser.add_argument("--split", type=str)
     parser.add_argument("--size_valid_set", type=int, default=10000)
     parser.add_argument("--streaming", action="store_true")
     parser.add_argument("--shuffle_buffer", type=int, default=5000)
+    parser.add_argument("--background_tokenization", action="store_true")
+    parser.add_argument("--tokenize_batch_size", type=int, default=64)
+    parser.add_argument(
+        "--token_cache_dir", type=str, default=None,
+        help="tokenize --dataset_path once, with --num_workers processes, into this cache shared by later runs",
+    )
+    parser.add_argument(
+        "--model_cache_dir", type=str, default=None,
+        help="quantize the base model to 8 bits once into this cache (common/model_cache.py) and load it from there",
+    )
 
     parser.add_argument("--input_column_name", type=str, default="prompt")
     parser.add_argument("--output_column_name", type=str, default="completion")
@@ -164,10 +231,17 @@ def get_args():
     parser.add_argument("--no_gradient_checkpointing", action="store_false", default=False)
     parser.add_argument("--seed", type=int, default=0)
     parser.add_argument("--num_workers", type=int, default=None)
+    parser.add_argument("--dataloader_num_workers", type=int, default=0)
     parser.add_argument("--output_dir", type=str, default="./checkpoints")
     parser.add_argument("--log_freq", default=100, type=int)
     parser.add_argument("--eval_freq", default=100, type=int)
     parser.add_argument("--save_freq", default=1000, type=int)
+    parser.add_argument("--save_total_limit", type=int, default=None, help="keep the last N checkpoints, plus the best one")
+    parser.add_argument("--async_checkpoint", action="store_true", help="write checkpoints from a background thread")
+    parser.add_argument(
+        "--telemetry_path", type=str, default=None,
+        help="write per-interval throughput, step time breakdown and memory to this .jsonl or .prom file, off by default",
+    )
 
     return parser.parse_args()
 
@@ -209,6 +283,11 @@ def prepare_sample_text(example, input_column_name="prompt", output_column_name=
     return text
 
 
+def prepare_sample_pair(example, input_column_name="prompt", output_column_name="completion"):
+    """prepare_sample_text split into the prompt and the completion the loss is computed on."""
+    return f"Question: {example[input_column_name]}\n\nAnswer:", f" {example[output_column_name]}"
+
+
 class ConstantLengthDataset(IterableDataset):
     """
     Iterable dataset that returns constant length chunks of tokens from stream of text files.
@@ -219,6 +298,21 @@ class ConstantLengthDataset(IterableDataset):
             seq_length (int): Length of token sequences to return.
             num_of_sequences (int): Number of token sequences to keep in buffer.
             chars_per_token (int): Number of characters per token used to estimate number of tokens in text buffer.
+            rank (int): Index of this process when the dataset is split between DDP ranks.
+            world_size (int): Number of DDP ranks the dataset is split between.
+            background_tokenization (bool): If True a producer thread tokenizes ahead of the consumer into a
+                queue holding at most `seq_length * num_of_sequences` tokens, and `chars_per_token` is unused.
+            tokenize_batch_size (int): Number of examples tokenized per call by the producer thread.
+            state_history (int): Number of most recent sequences whose iteration state is kept for `state_dict`.
+        Each DataLoader worker of each rank packs a disjoint shard of the dataset.
+
+    Sequences are cut from blocks of examples tokenized together (the character-sized buffer, or one
+    tokenize batch in the background). The iteration state after each sequence is the pass over the
+    shard (`epoch`), the position of the first example of the block, the tokens carried over from the
+    previous block and the number of sequences already cut from the block. `load_state_dict` makes the
+    next iteration seek to that block, tokenize it again and continue with the following sequence.
+    The iteration has no random state of its own. States are only tracked when iterating in the
+    main process (dataloader_num_workers=0).
     """
 
     def __init__(
@@ -230,7 +324,12 @@ class ConstantLengthDataset(IterableDataset):
         num_of_sequences=1024,
         chars_per_token=3.6,
         input_column_name="prompt",
-        output_column_name="completion"
+        output_column_name="completion",
+        rank=0,
+        world_size=1,
+        background_tokenization=False,
+        tokenize_batch_size=64,
+        state_history=4096,
     ):
         self.tokenizer = tokenizer
         self.concat_token_id = tokenizer.eos_token_id if tokenizer.eos_token_id is not None else args.eos_token_id
@@ -238,14 +337,126 @@ class ConstantLengthDataset(IterableDataset):
         self.seq_length = seq_length
         self.infinite = infinite
         self.current_size = 0
-        self.max_buffer_size = seq_length * chars_per_token * num_of_sequences
+        self.max_buffer_size = seq_length * (chars_per_token or 0) * num_of_sequences
         self.input_column_name = input_column_name
         self.output_column_name = output_column_name
+        self.rank = rank
+        self.world_size = world_size
+        self.background_tokenization = background_tokenization
+        self.tokenize_batch_size = tokenize_batch_size
+        self.max_buffer_tokens = seq_length * num_of_sequences
+        self.queue = None
+        # (sequences yielded, epoch, block start, carried tokens, sequences cut from the block)
+        self.history = deque(maxlen=state_history)
+        self.resume_state = None
+
+    def prefetch_metrics(self):
+        """Queue depth and consumer stall metrics of the current background iteration, if any."""
+        return self.queue.metrics() if self.queue is not None else {}
+
+    def state_dict(self, samples=None):
+        """
+        Iteration state right after the `samples`-th sequence (the latest one by default),
+        None if it is no longer, or not, in the history.
+        """
+        for size, epoch, block_start, carry, emitted in reversed(self.history):
+            if samples is None or size == samples:
+                return {"samples": size, "epoch": epoch, "block_start": block_start, "carry": list(carry), "emitted": emitted}
+        return None
+
+    def load_state_dict(self, state):
+        """Make the next iteration continue right after the sequence `state` was taken at."""
+        self.resume_state = state
+        self.current_size = state["samples"]
+        self.history.clear()
+
+    def _record(self, epoch, block_start, carry, emitted):
+        self.current_size += 1
+        self.history.append((self.current_size, epoch, block_start, carry, emitted))
+
+    def _tokenize(self, texts):
+        all_token_ids = []
+        for tokenized_input in self.tokenizer(texts, truncation=False)["input_ids"]:
+            all_token_ids.extend(tokenized_input + [self.concat_token_id])
+        return all_token_ids
+
+    def _produce(self, dataset, queue, epoch=0, position=0):
+        try:
+            iterator = iter_from(dataset, position)
+            while True:
+                buffer, block_start = [], position
+                for example in iterator:
+                    # the consumer stopped iterating: do not start another tokenize call
+                    if queue.closed:
+                        return
+                    buffer.append(prepare_sample_text(example, self.input_column_name, self.output_column_name))
+                    position += 1
+                    if len(buffer) == self.tokenize_batch_size:
+                        token_ids = self._tokenize(buffer)
+                        if not queue.put((epoch, block_start, token_ids), len(token_ids)):
+                            return
+                        buffer, block_start = [], position
+                if buffer:
+                    token_ids = self._tokenize(buffer)
+                    if not queue.put((epoch, block_start, token_ids), len(token_ids)):
+                        return
+                if not (self.infinite and position > 0):
+                    break
+                epoch, position = epoch + 1, 0
+                iterator = iter(dataset)
+            queue.put(None)
+        except Exception as e:
+            queue.put(e)
+
+    def _iter_background(self, dataset, resume):
+        queue = self.queue = TokenBudgetQueue(self.max_buffer_tokens)
+        start = (resume["epoch"], resume["block_start"]) if resume else (0, 0)
+        producer = threading.Thread(target=self._produce, args=(dataset, queue, *start), daemon=True)
+        producer.start()
+        try:
+            all_token_ids = list(resume["carry"]) if resume else []
+            skip = resume["emitted"] if resume else 0
+            while True:
+                item = queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                epoch, block_start, token_ids = item
+                carry = tuple(all_token_ids)
+                all_token_ids.extend(token_ids)
+                start, emitted = 0, 0
+                while len(all_token_ids) - start >= self.seq_length:
+                    input_ids = all_token_ids[start : start + self.seq_length]
+                    start += self.seq_length
+                    emitted += 1
+                    if emitted <= skip:
+                        continue
+                    self._record(epoch, block_start, carry, emitted)
+                    yield {
+                        "input_ids": torch.LongTensor(input_ids),
+                        "labels": torch.LongTensor(input_ids),
+                    }
+                skip = 0
+                del all_token_ids[:start]
+        finally:
+            # stop the producer and wait for its tokenize call in flight, so that it never outlives the iteration
+            queue.close()
+            producer.join(PRODUCER_JOIN_TIMEOUT)
 
     def __iter__(self):
-        iterator = iter(self.dataset)
+        dataset = shard_dataset(self.dataset, *shard_info(self.rank, self.world_size))
+        resume, self.resume_state = self.resume_state, None
+        if self.background_tokenization:
+            yield from self._iter_background(dataset, resume)
+            return
+        epoch = resume["epoch"] if resume else 0
+        examples_in_pass = resume["block_start"] if resume else 0
+        skip = resume["emitted"] if resume else 0
+        iterator = iter_from(dataset, examples_in_pass)
         more_examples = True
         while more_examples:
+            block_epoch, block_start = epoch, examples_in_pass
             buffer, buffer_len = [], 0
             while True:
                 if buffer_len >= self.max_buffer_size:
@@ -253,9 +464,13 @@ class ConstantLengthDataset(IterableDataset):
                 try:
                     buffer.append(prepare_sample_text(next(iterator), self.input_column_name, self.output_column_name))
                     buffer_len += len(buffer[-1])
+                    examples_in_pass += 1
                 except StopIteration:
-                    if self.infinite:
-                        iterator = iter(self.dataset)
+                    # an empty shard would otherwise spin forever in infinite mode
+                    if self.infinite and examples_in_pass > 0:
+                        iterator = iter(dataset)
+                        examples_in_pass = 0
+                        epoch += 1
                     else:
                         more_examples = False
                         break
@@ -263,22 +478,23 @@ class ConstantLengthDataset(IterableDataset):
             all_token_ids = []
             for tokenized_input in tokenized_inputs:
                 all_token_ids.extend(tokenized_input + [self.concat_token_id])
+            emitted = 0
             for i in range(0, len(all_token_ids), self.seq_length):
                 input_ids = all_token_ids[i : i + self.seq_length]
                 if len(input_ids) == self.seq_length:
-                    self.current_size += 1
+                    emitted += 1
+                    if emitted <= skip:
+                        continue
+                    self._record(block_epoch, block_start, (), emitted)
                     yield {
                         "input_ids": torch.LongTensor(input_ids),
                         "labels": torch.LongTensor(input_ids),
                     }
+            skip = 0
 
 def create_datasets(tokenizer, args):
     if args.dataset_path:
-        ext = args.dataset_type
-        if not ext:
-            ext = os.path.splitext(args.dataset_path)[1][1:]
-        dataset = load_dataset(ext, data_files=args.dataset_path, split=args.split)
-        dataset = dataset.train_test_split(test_size=0.1, seed=args.seed)
+        train_data, valid_data = load_splits(args.dataset_path, args.dataset_type, args.split, 0.1, args.seed)
     else:
         dataset = load_dataset(
             args.dataset_name,
@@ -296,12 +512,17 @@ def create_datasets(tokenizer, args):
         train_data = dataset.skip(args.size_valid_set)
         train_data = train_data.shuffle(buffer_size=args.shuffle_buffer, seed=args.seed)
     else:
-        train_data = dataset["train"]
-        valid_data = dataset["test"]
+        if not args.dataset_path:
+            train_data = dataset["train"]
+            valid_data = dataset["test"]
         print(f"Size of the train set: {len(train_data)}. Size of the validation set: {len(valid_data)}")
 
-    chars_per_token = chars_token_ratio(train_data, tokenizer, args.input_column_name, args.output_column_name)
-    print(f"The character to token ratio of the dataset is: {chars_per_token:.2f}")
+    if args.background_tokenization:
+        # the producer thread sizes its buffer in real tokens, no estimate needed
+        chars_per_token = None
+    else:
+        chars_per_token = chars_token_ratio(train_data, tokenizer, args.input_column_name, args.output_column_name)
+        print(f"The character to token ratio of the dataset is: {chars_per_token:.2f}")
 
     train_dataset = ConstantLengthDataset(
         tokenizer,
@@ -310,7 +531,9 @@ def create_datasets(tokenizer, args):
         seq_length=args.seq_length,
         chars_per_token=chars_per_token,
         input_column_name=args.input_column_name,
-        output_column_name=args.output_column_name
+        output_column_name=args.output_column_name,
+        background_tokenization=args.background_tokenization,
+        tokenize_batch_size=args.tokenize_batch_size,
     )
     valid_dataset = ConstantLengthDataset(
         tokenizer,
@@ -319,24 +542,88 @@ def create_datasets(tokenizer, args):
         seq_length=args.seq_length,
         chars_per_token=chars_per_token,
         input_column_name=args.input_column_name,
-        output_column_name=args.output_column_name
+        output_column_name=args.output_column_name,
+        background_tokenization=args.background_tokenization,
+        tokenize_batch_size=args.tokenize_batch_size,
     )
     return train_dataset, valid_dataset
 
 
-def run_training(args, train_data, val_data):
-    print("Loading the model")
-    # disable caching mechanism when using gradient checkpointing
-    model = AutoModelForCausalLM.from_pretrained(
-        args.model_path,
-        use_auth_token=True,
-        use_cache=not args.no_gradient_checkpointing,
-        load_in_8bit=True,
-        device_map={"": Accelerator().process_index},
+def create_packed_datasets(args):
+    train_dataset = PackedTokenDataset(
+        args.packed_dataset_path, split="train", infinite=True, seq_length=args.seq_length
     )
-    model = prepare_model_for_kbit_training(model)
+    valid_dataset = PackedTokenDataset(
+        args.packed_dataset_path, split="valid", infinite=False, seq_length=args.seq_length
+    )
+    print(f"Size of the train set: {len(train_dataset)} sequences. Size of the validation set: {len(valid_dataset)} sequences")
+    return train_dataset, valid_dataset
+
+
+def create_bin_packed_datasets(tokenizer, args):
+    """
+    Pack whole prompt/completion pairs into seq_length sequences with best-fit-decreasing,
+    reading the pack_tokens.py output when --packed_dataset_path is set.
+    """
+    train_prompt_lengths = valid_prompt_lengths = None
+    if args.packed_dataset_path:
+        train_documents = documents_from_packed(args.packed_dataset_path, "train")
+        valid_documents = documents_from_packed(args.packed_dataset_path, "valid")
+    else:
+        splits = load_splits(args.dataset_path, args.dataset_type, args.split, 0.1, args.seed)
+        eos_token_id = tokenizer.eos_token_id if tokenizer.eos_token_id is not None else args.eos_token_id
+        if args.mask_prompt and args.token_cache_dir:
+            eos_token = tokenizer.convert_ids_to_tokens(eos_token_id)
+
+            def tokenize(batch):
+                prompts, completions = zip(
+                    *(
+                        prepare_sample_pair({args.input_column_name: i, args.output_column_name: o}, args.input_column_name, args.output_column_name)
+                        for i, o in zip(batch[args.input_column_name], batch[args.output_column_name])
+                    )
+                )
+                return tokenize_pairs(tokenizer, prompts, completions, suffix=eos_token)
+
+            template = f"prepare_sample_pair {args.input_column_name}/{args.output_column_name} suffix={eos_token}"
+            tokenized = [
+                cached_map(data, tokenize, tokenizer, args.token_cache_dir, template, num_proc=args.num_workers, remove_columns=data.column_names)
+                for data in splits
+            ]
+            train_documents, valid_documents = (t["input_ids"] for t in tokenized)
+            train_prompt_lengths, valid_prompt_lengths = (t["prompt_length"] for t in tokenized)
+        elif args.mask_prompt:
+            (train_documents, train_prompt_lengths), (valid_documents, valid_prompt_lengths) = (
+                tokenize_pair_documents(
+                    tokenizer,
+                    [prepare_sample_pair(example, args.input_column_name, args.output_column_name) for example in data],
+                    tokenizer.convert_ids_to_tokens(eos_token_id),
+                )
+                for data in splits
+            )
+        else:
+            train_documents, valid_documents = (
+                tokenize_documents(
+                    tokenizer,
+                    [prepare_sample_text(example, args.input_column_name, args.output_column_name) for example in data],
+                    eos_token_id,
+                )
+                for data in splits
+            )
 
-    lora_config = LoraConfig(
+    pad_token_id = tokenizer.pad_token_id if tokenizer is not None and tokenizer.pad_token_id is not None else 0
+    train_dataset = BinPackedDataset(
+        train_documents, seq_length=args.seq_length, pad_token_id=pad_token_id, prompt_lengths=train_prompt_lengths
+    )
+    valid_dataset = BinPackedDataset(
+        valid_documents, seq_length=args.seq_length, pad_token_id=pad_token_id, prompt_lengths=valid_prompt_lengths
+    )
+    print_packing_stats("train", train_dataset)
+    print_packing_stats("valid", valid_dataset)
+    return train_dataset, valid_dataset
+
+
+def create_lora_config(args):
+    return LoraConfig(
         r=args.lora_r,
         lora_alpha=args.lora_alpha,
         lora_dropout=args.lora_dropout,
@@ -345,7 +632,35 @@ def run_training(args, train_data, val_data):
         target_modules = ["c_proj", "c_attn", "q_attn"]
     )
 
-    model = get_peft_model(model, lora_config)
+
+def run_training(args, train_data, val_data):
+    print("Loading the model")
+    # disable caching mechanism when using gradient checkpointing
+    if args.model_cache_dir:
+        accelerator = Accelerator()
+        # the main process quantizes the model into the cache once, the other ranks then load its entry
+        with accelerator.main_process_first():
+            model = load_cached_model(
+                args.model_path,
+                args.model_cache_dir,
+                quantization="8bit",
+                use_cache=not args.no_gradient_checkpointing,
+                device_map={"": accelerator.process_index},
+            )
+    else:
+        model = AutoModelForCausalLM.from_pretrained(
+            args.model_path,
+            use_auth_token=True,
+            use_cache=not args.no_gradient_checkpointing,
+            load_in_8bit=True,
+            device_map={"": Accelerator().process_index},
+        )
+    model = prepare_model_for_kbit_training(model)
+
+    model = get_peft_model(model, create_lora_config(args))
+    if args.packing == "bfd":
+        # bins hold several documents: each one only attends to itself
+        mask_documents(model)
 
     print_trainable_parameters(model)
 
@@ -356,8 +671,10 @@ def run_training(args, train_data, val_data):
     training_args = TrainingArguments(
         output_dir=args.output_dir,
         dataloader_drop_last=True,
+        dataloader_num_workers=args.dataloader_num_workers,
         eval_strategy="steps",
         save_strategy="steps",
+        save_total_limit=args.save_total_limit,
         load_best_model_at_end=True,
         max_steps=args.max_steps,
         eval_steps=args.eval_freq,
@@ -378,26 +695,36 @@ def run_training(args, train_data, val_data):
         ddp_find_unused_parameters=False,
     )
 
-    trainer = Trainer(model=model, 
+    # the Trainer saves the adapter of the PeftModel itself, in the background with --async_checkpoint
+    callbacks = [LoadBestPeftModelCallback, ETACallback]
+    if args.telemetry_path:
+        callbacks.append(TelemetryCallback(args.telemetry_path))
+    if getattr(train_data, "background_tokenization", False):
+        callbacks.append(PrefetchMetricsCallback(train_data))
+    if isinstance(train_data, ConstantLengthDataset):
+        callbacks.append(DatasetStateCallback(train_data))
+
+    trainer_class = AsyncCheckpointTrainer if args.async_checkpoint else Trainer
+    trainer = trainer_class(model=model,
                     args=training_args, 
                     train_dataset=train_data, 
                     eval_dataset=val_data, 
-                    callbacks=[
-                        SavePeftModelCallback, 
-                        LoadBestPeftModelCallback])
+                    callbacks=callbacks)
 
     print("Training...")
-    import glob
 
-    # Check for existing checkpoints
-    checkpoints = sorted(
-        glob.glob(os.path.join(args.output_dir, f"{PREFIX_CHECKPOINT_DIR}-*")),
-        key=lambda x: int(x.split("-")[-1]),
-    )
+    # Check for existing checkpoints, ignoring any left incomplete by an interrupted save
+    checkpoints = complete_checkpoints(args.output_dir)
 
     if checkpoints:
         last_checkpoint = checkpoints[-1]
         print(f"Found existing checkpoint at {last_checkpoint}. Resuming training...")
+        dataset_state = DatasetStateCallback.from_checkpoint(last_checkpoint)
+        if isinstance(train_data, ConstantLengthDataset) and dataset_state is not None:
+            # continue the dataset where the checkpoint left it instead of replaying the batches already seen
+            train_data.load_state_dict(dataset_state)
+            trainer.args.ignore_data_skip = True
+            print(f"Restored the dataset state after {dataset_state['samples']} sequences")
         trainer.train(resume_from_checkpoint=last_checkpoint)
     else:
         print("No checkpoint found. Starting training from scratch.")
@@ -408,8 +735,30 @@ def run_training(args, train_data, val_data):
 
 
 def main(args):
-    tokenizer = AutoTokenizer.from_pretrained(args.model_path, use_auth_token=True)
-    train_dataset, eval_dataset = create_datasets(tokenizer, args)
+    if args.token_cache_dir and args.dataset_path and not (args.packed_dataset_path or args.mask_prompt or args.streaming):
+        # tokenized once into a packed entry of the cache, which both packings read like pack_tokens.py output
+        tokenizer = AutoTokenizer.from_pretrained(args.model_path, use_auth_token=True)
+        eos_token_id = tokenizer.eos_token_id if tokenizer.eos_token_id is not None else args.eos_token_id
+        train_data, valid_data = load_splits(args.dataset_path, args.dataset_type, args.split, 0.1, args.seed)
+        args.packed_dataset_path = cached_pack(
+            tokenizer,
+            {"train": train_data, "valid": valid_data},
+            args.token_cache_dir,
+            eos_token_id,
+            args.input_column_name,
+            args.output_column_name,
+            num_proc=args.num_workers,
+        )
+        print(f"Using the tokens cached in {args.packed_dataset_path}")
+    if args.packing == "bfd":
+        tokenizer = None if args.packed_dataset_path else AutoTokenizer.from_pretrained(args.model_path, use_auth_token=True)
+        train_dataset, eval_dataset = create_bin_packed_datasets(tokenizer, args)
+    elif args.packed_dataset_path:
+        # pre-tokenized with pack_tokens.py: no tokenizer needed at train time
+        train_dataset, eval_dataset = create_packed_datasets(args)
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(args.model_path, use_auth_token=True)
+        train_dataset, eval_dataset = create_datasets(tokenizer, args)
     run_training(args, train_dataset, eval_dataset)
 
 
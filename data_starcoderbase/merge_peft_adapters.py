@@ -3,7 +3,14 @@ from peft import PeftModel
 import torch
 
 import os
+import sys
 import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from common.lora_merge import merge_lora_streaming
+from common.model_cache import prepare_model
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -11,14 +18,51 @@ def get_args():
     parser.add_argument("--peft_model_path", type=str, default="/")
     parser.add_argument("--merged_model_name_or_path", type=str, default="bigcode/large-model-merged")
     parser.add_argument("--push_to_hub", action="store_true", default=True)
+    parser.add_argument("--streaming", action="store_true", help="merge tensor by tensor from the safetensors shards, peak memory of about one shard")
+    parser.add_argument("--output_dir", type=str, default=None, help="local directory of the streaming merge, --merged_model_name_or_path by default")
+    parser.add_argument("--max_shard_size", type=str, default="2GB")
+    parser.add_argument("--model_cache_dir", type=str, default=None, help="read the base model converted to float16 once into this cache (common/model_cache.py)")
 
     return parser.parse_args()
 
+def base_model_path(args):
+    """The base model, or its float16 entry of --model_cache_dir."""
+    if args.model_cache_dir:
+        return prepare_model(args.base_model_name_or_path, args.model_cache_dir, dtype=torch.float16)
+    return args.base_model_name_or_path
+
+def streaming_merge(args):
+    output_dir = args.output_dir or args.merged_model_name_or_path
+    merged = merge_lora_streaming(
+        base_model_path(args),
+        args.peft_model_path,
+        output_dir,
+        dtype=torch.float16,
+        max_shard_size=args.max_shard_size,
+    )
+    print(f"Merged {merged} LoRA modules into '{output_dir}'")
+
+    tokenizer = AutoTokenizer.from_pretrained(args.base_model_name_or_path)
+    tokenizer.save_pretrained(output_dir)
+
+    if args.push_to_hub:
+        from huggingface_hub import HfApi
+
+        print(f"Saving to hub '{args.merged_model_name_or_path}' ...")
+        api = HfApi()
+        api.create_repo(repo_id=args.merged_model_name_or_path, repo_type="model", exist_ok=True)
+        api.upload_folder(folder_path=output_dir, repo_id=args.merged_model_name_or_path, repo_type="model")
+    else:
+        print(f"Model saved to '{output_dir}'")
+
 def main():
     args = get_args()
 
+    if args.streaming:
+        return streaming_merge(args)
+
     base_model = AutoModelForCausalLM.from_pretrained(
-        args.base_model_name_or_path,
+        base_model_path(args),
         return_dict=True,
         torch_dtype=torch.float16 
     )
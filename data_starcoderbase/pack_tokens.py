@@ -0,0 +1,245 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import numpy as np
+import torch
+from datasets import load_dataset
+from torch.utils.data import IterableDataset
+from tqdm import tqdm
+from transformers import AutoTokenizer
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from common.dataset_store import is_store, load_store
+from common.tokenization import token_cache_key
+from sharding import shard_info
+
+"""
+Tokenize a prompt/completion dataset once into a flat token file that
+PackedTokenDataset memory-maps at train time.
+
+Layout of the output directory, one set of files per split:
+    <split>.bin      all token ids, each document followed by the EOS token
+    <split>.idx.npy  int64 offsets into <split>.bin, one per document plus the end
+    meta.json        dtype, eos token, tokenizer and per split counts
+"""
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path", type=str, default="bigcode/large-model")
+    parser.add_argument("--dataset_path", type=str, default="./dataset.csv")
+    parser.add_argument("--dataset_type", type=str, default="csv")
+    parser.add_argument("--split", type=str, default="train")
+    parser.add_argument("--input_column_name", type=str, default="prompt")
+    parser.add_argument("--output_column_name", type=str, default="completion")
+    parser.add_argument("--eos_token_id", type=int, default=49152)
+    parser.add_argument("--test_size", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch_size", type=int, default=1000)
+    parser.add_argument("--num_proc", type=int, default=None, help="processes tokenizing each split")
+    parser.add_argument("--output_dir", type=str, default="./packed")
+
+    return parser.parse_args()
+
+
+def prepare_sample_text(example, input_column_name="prompt", output_column_name="completion"):
+    """Prepare the text from a sample of the dataset (same format as finetune.py)."""
+    text = f"Question: {example[input_column_name]}\n\nAnswer: {example[output_column_name]}"
+    return text
+
+
+def token_dtype(vocab_size):
+    """Smallest unsigned dtype able to hold every token id of the vocabulary."""
+    return np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.uint32
+
+
+def load_splits(dataset_path, dataset_type, split, test_size, seed):
+    """
+    (train, valid) datasets of `dataset_path`: the train and validation splits of a dataset store
+    (common/dataset_store.py) rendered as question/response rows, else a seeded random split of the data file.
+    """
+    if is_store(dataset_path):
+        data = load_store(dataset_path, "question_response", splits=("train", "validation"))
+        return data["train"], data["validation"]
+    ext = dataset_type or os.path.splitext(dataset_path)[1][1:]
+    dataset = load_dataset(ext, data_files=dataset_path, split=split)
+    dataset = dataset.train_test_split(test_size=test_size, seed=seed)
+    return dataset["train"], dataset["test"]
+
+
+class SampleTokenizer:
+    """Batched `map` function: the ids of each sample formatted by prepare_sample_text, followed by the EOS token."""
+
+    def __init__(self, tokenizer, eos_token_id, input_column_name, output_column_name):
+        self.tokenizer = tokenizer
+        self.eos_token_id = eos_token_id
+        self.input_column_name = input_column_name
+        self.output_column_name = output_column_name
+
+    def __call__(self, batch):
+        texts = [
+            prepare_sample_text({self.input_column_name: i, self.output_column_name: o}, self.input_column_name, self.output_column_name)
+            for i, o in zip(batch[self.input_column_name], batch[self.output_column_name])
+        ]
+        return {"input_ids": [ids + [self.eos_token_id] for ids in self.tokenizer(texts, truncation=False)["input_ids"]]}
+
+
+def pack_split(tokenizer, dataset, path, dtype, eos_token_id, input_column_name, output_column_name, batch_size=1000, num_proc=None):
+    """
+    Tokenize a dataset split in batches, by `num_proc` processes, and append the ids to `<path>.bin`,
+    writing the document offsets to `<path>.idx.npy`. Returns (documents, tokens).
+    """
+    tokenized = dataset.map(
+        SampleTokenizer(tokenizer, eos_token_id, input_column_name, output_column_name),
+        batched=True,
+        batch_size=batch_size,
+        num_proc=num_proc,
+        remove_columns=dataset.column_names,
+    ).with_format(None)
+    offsets = [0]
+    with open(f"{path}.bin", "wb") as f:
+        for start in tqdm(range(0, len(tokenized), batch_size)):
+            for ids in tokenized[start : start + batch_size]["input_ids"]:
+                np.asarray(ids, dtype=dtype).tofile(f)
+                offsets.append(offsets[-1] + len(ids))
+    np.save(f"{path}.idx.npy", np.asarray(offsets, dtype=np.int64))
+    return len(offsets) - 1, offsets[-1]
+
+
+def pack(tokenizer, splits, output_dir, eos_token_id, input_column_name, output_column_name, batch_size=1000, num_proc=None, **info):
+    """Pack each of `splits`, a dict of split name to dataset, into `output_dir` with its meta.json, `info` included."""
+    dtype = token_dtype(len(tokenizer))
+    os.makedirs(output_dir, exist_ok=True)
+    meta = {"dtype": np.dtype(dtype).name, "eos_token_id": eos_token_id, **info, "splits": {}}
+    for name, split in splits.items():
+        documents, tokens = pack_split(
+            tokenizer,
+            split,
+            os.path.join(output_dir, name),
+            dtype,
+            eos_token_id,
+            input_column_name,
+            output_column_name,
+            batch_size=batch_size,
+            num_proc=num_proc,
+        )
+        meta["splits"][name] = {"documents": documents, "tokens": tokens}
+        print(f"Packed {name}: {documents} documents, {tokens} tokens")
+
+    with open(os.path.join(output_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+
+
+def cached_pack(tokenizer, splits, cache_dir, eos_token_id, input_column_name, output_column_name, num_proc=None):
+    """
+    `pack` into an entry of `cache_dir` keyed by the content of the splits and the tokenizer, as
+    common.tokenization.cached_map keys its entries; later runs on the same data reuse it. Returns its directory.
+    """
+    template = f"pack_tokens {input_column_name}/{output_column_name} eos={eos_token_id}"
+    keys = [f"{name}:{token_cache_key(split, tokenizer, template)}" for name, split in splits.items()]
+    path = os.path.join(cache_dir, "packed-" + hashlib.sha256(" ".join(keys).encode("utf-8")).hexdigest()[:16])
+    if not os.path.exists(path):
+        tmp = f"{path}.tmp-{os.getpid()}"
+        pack(tokenizer, splits, tmp, eos_token_id, input_column_name, output_column_name, num_proc=num_proc)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # another run packed the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+    return path
+
+
+class PackedTokenDataset(IterableDataset):
+    """
+    Iterable dataset that returns constant length chunks of tokens from a file written by pack_tokens.py.
+    No tokenization happens at iteration time: windows are sliced out of a memory-mapped token array.
+        Args:
+            path (str): Directory passed as --output_dir to pack_tokens.py.
+            split (str): Split to read, "train" or "valid".
+            infinite (bool): If True the iterator is reset after dataset reaches end else stops.
+            seq_length (int): Length of token sequences to return.
+            rank (int): Index of this process when the dataset is split between DDP ranks.
+            world_size (int): Number of DDP ranks the dataset is split between.
+        Each DataLoader worker of each rank yields a disjoint subset of the windows.
+    """
+
+    def __init__(self, path, split="train", infinite=False, seq_length=1024, rank=0, world_size=1):
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.path = os.path.join(path, split)
+        self.dtype = np.dtype(self.meta["dtype"])
+        self.concat_token_id = self.meta["eos_token_id"]
+        self.seq_length = seq_length
+        self.infinite = infinite
+        self.rank = rank
+        self.world_size = world_size
+        self.current_size = 0
+        self._tokens = None
+        self._offsets = None
+
+    @property
+    def tokens(self):
+        # opened lazily so that the dataset can be pickled into DataLoader workers
+        if self._tokens is None:
+            self._tokens = np.memmap(f"{self.path}.bin", dtype=self.dtype, mode="r")
+        return self._tokens
+
+    @property
+    def offsets(self):
+        if self._offsets is None:
+            self._offsets = np.load(f"{self.path}.idx.npy", mmap_mode="r")
+        return self._offsets
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_tokens"] = None
+        state["_offsets"] = None
+        return state
+
+    def __len__(self):
+        return len(self.tokens) // self.seq_length
+
+    def __iter__(self):
+        tokens = self.tokens
+        shard_id, num_shards = shard_info(self.rank, self.world_size)
+        more_examples = len(self) > shard_id
+        while more_examples:
+            for window in range(shard_id, len(self), num_shards):
+                i = window * self.seq_length
+                input_ids = torch.from_numpy(tokens[i : i + self.seq_length].astype(np.int64))
+                self.current_size += 1
+                yield {
+                    "input_ids": input_ids,
+                    "labels": input_ids.clone(),
+                }
+            more_examples = self.infinite
+
+
+def main(args):
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path, use_auth_token=True)
+    eos_token_id = tokenizer.eos_token_id if tokenizer.eos_token_id is not None else args.eos_token_id
+
+    # same split as create_datasets in finetune.py so the packed and text pipelines see the same data
+    train_data, valid_data = load_splits(args.dataset_path, args.dataset_type, args.split, args.test_size, args.seed)
+    pack(
+        tokenizer,
+        {"train": train_data, "valid": valid_data},
+        args.output_dir,
+        eos_token_id,
+        args.input_column_name,
+        args.output_column_name,
+        batch_size=args.batch_size,
+        num_proc=args.num_proc,
+        model_path=args.model_path,
+        dataset_path=args.dataset_path,
+    )
+
+
+if __name__ == "__main__":
+    main(get_args())
@@ -0,0 +1,212 @@
+import bisect
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+from common.tokenization import tokenize_pairs
+from pack_tokens import PackedTokenDataset
+
+"""
+Best-fit-decreasing packing of whole documents into fixed size sequences.
+
+Unlike ConstantLengthDataset, documents are never split across sequences and
+nothing is dropped at the end: each sequence holds complete documents followed by
+padding. `position_ids` restart at 0 on every document, so that each one gets the
+position embeddings it would have alone, and the first label of each document is
+masked so no token is trained to predict across a boundary.
+
+The model does not keep documents apart by itself: GPTBigCode builds a causal mask
+over the whole sequence and its flash_attention_2 path ignores `position_ids`.
+`mask_documents(model)` hooks every attention layer to restrict its mask to the
+tokens of the same document, found from the restarting `position_ids`, so that
+each document is attended to as if it were alone (eager and sdpa attention).
+"""
+
+
+def best_fit_decreasing(lengths, capacity):
+    """
+    Assign items of the given lengths to as few bins of `capacity` as the best-fit-decreasing heuristic finds.
+    Items longer than `capacity` get a bin of their own. Returns a list of bins, each a list of item indices.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    bins = []
+    # (free space, bin index) of the bins that can still take an item, sorted by free space
+    free = []
+    for i in order:
+        length = min(lengths[i], capacity)
+        # tightest bin that still fits the item
+        pos = bisect.bisect_left(free, (length, -1))
+        if pos < len(free):
+            space, b = free.pop(pos)
+        else:
+            space, b = capacity, len(bins)
+            bins.append([])
+        bins[b].append(i)
+        space -= length
+        if space > 0:
+            bisect.insort(free, (space, b))
+    return bins
+
+
+def tokenize_documents(tokenizer, texts, eos_token_id, batch_size=1000):
+    """Tokenize every text once, in batches, each document ending with the EOS token."""
+    documents = []
+    for start in tqdm(range(0, len(texts), batch_size)):
+        for ids in tokenizer(texts[start : start + batch_size], truncation=False)["input_ids"]:
+            documents.append(ids + [eos_token_id])
+    return documents
+
+
+def tokenize_pair_documents(tokenizer, pairs, eos_token, batch_size=1000):
+    """
+    Tokenize (prompt, completion) pairs once, as one text each, in batches, each document ending with `eos_token`.
+    Returns the documents and the number of prompt tokens of each, to be masked from the loss.
+    """
+    documents, prompt_lengths = [], []
+    for start in tqdm(range(0, len(pairs), batch_size)):
+        prompts, completions = zip(*pairs[start : start + batch_size])
+        tokenized = tokenize_pairs(tokenizer, prompts, completions, suffix=eos_token)
+        documents.extend(tokenized["input_ids"])
+        prompt_lengths.extend(tokenized["prompt_length"])
+    return documents, prompt_lengths
+
+
+def documents_from_packed(path, split="train"):
+    """Documents of a split written by pack_tokens.py, as views on the memory-mapped token file."""
+    packed = PackedTokenDataset(path, split=split)
+    tokens, offsets = packed.tokens, packed.offsets
+    return [tokens[offsets[i] : offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+
+class BinPackedDataset(Dataset):
+    """
+    Map-style dataset of `seq_length` sequences packed with best-fit-decreasing from whole documents.
+        Args:
+            documents (list): Token ids of each document, including its trailing EOS.
+            seq_length (int): Length of the sequences to return.
+            pad_token_id (int): Token used to fill the end of each sequence.
+            prompt_lengths (list): Optional number of leading tokens of each document excluded from the loss.
+        Documents longer than `seq_length` are truncated and counted in `stats["truncated_tokens"]`.
+    """
+
+    def __init__(self, documents, seq_length=1024, pad_token_id=0, prompt_lengths=None):
+        self.documents = documents
+        self.prompt_lengths = prompt_lengths
+        self.seq_length = seq_length
+        self.pad_token_id = pad_token_id
+        lengths = [len(d) for d in documents]
+        self.bins = best_fit_decreasing(lengths, seq_length)
+
+        real_tokens = sum(min(length, seq_length) for length in lengths)
+        self.stats = {
+            "documents": len(documents),
+            "sequences": len(self.bins),
+            "real_tokens": real_tokens,
+            "slots": len(self.bins) * seq_length,
+            "truncated_tokens": sum(max(length - seq_length, 0) for length in lengths),
+            "efficiency": real_tokens / max(len(self.bins) * seq_length, 1),
+        }
+
+    def __len__(self):
+        return len(self.bins)
+
+    def __getitem__(self, idx):
+        input_ids = np.full(self.seq_length, self.pad_token_id, dtype=np.int64)
+        labels = np.full(self.seq_length, -100, dtype=np.int64)
+        position_ids = np.zeros(self.seq_length, dtype=np.int64)
+        attention_mask = np.zeros(self.seq_length, dtype=np.int64)
+        start = 0
+        for doc in self.bins[idx]:
+            ids = np.asarray(self.documents[doc][: self.seq_length], dtype=np.int64)
+            end = start + len(ids)
+            input_ids[start:end] = ids
+            labels[start + 1 : end] = ids[1:]
+            if self.prompt_lengths is not None:
+                labels[start : start + min(self.prompt_lengths[doc], len(ids))] = -100
+            position_ids[start:end] = np.arange(len(ids))
+            attention_mask[start:end] = 1
+            start = end
+        return {
+            "input_ids": torch.from_numpy(input_ids),
+            "labels": torch.from_numpy(labels),
+            "position_ids": torch.from_numpy(position_ids),
+            "attention_mask": torch.from_numpy(attention_mask),
+        }
+
+
+def print_packing_stats(name, dataset):
+    stats = dataset.stats
+    print(
+        f"{name}: packed {stats['documents']} documents into {stats['sequences']} sequences — "
+        f"efficiency {stats['efficiency']:.1%} ({stats['real_tokens']}/{stats['slots']} slots), "
+        f"{stats['truncated_tokens']} tokens truncated"
+    )
+
+
+def document_mask(position_ids, attention_mask=None):
+    """
+    (batch, query, key) boolean mask of the tokens of the same document, documents starting where `position_ids` is 0.
+    Padding queries (attention_mask 0) keep every key, so that no row is fully masked; their outputs are not trained on.
+    """
+    documents = torch.cumsum(position_ids == 0, dim=-1)
+    same = documents[:, :, None] == documents[:, None, :]
+    if attention_mask is not None:
+        same |= attention_mask[:, :, None] == 0
+    return same
+
+
+class DocumentMasking:
+    """
+    Forward hooks restricting the attention of a GPTBigCode model to the tokens of the same document.
+    The masks are computed once per forward from the `position_ids` of the batch and combined with
+    the mask every attention layer receives (boolean for eager attention, additive for sdpa).
+    """
+
+    def __init__(self, model):
+        from transformers.models.gpt_bigcode.modeling_gpt_bigcode import GPTBigCodeAttention, GPTBigCodeModel
+
+        self.mask = None
+        self.handles = []
+        for module in model.modules():
+            if isinstance(module, GPTBigCodeModel):
+                if module._use_flash_attention_2:
+                    raise ValueError("Document masking needs eager or sdpa attention, flash_attention_2 would ignore it")
+                self.handles.append(module.register_forward_pre_hook(self.set_mask, with_kwargs=True))
+            elif isinstance(module, GPTBigCodeAttention):
+                self.handles.append(module.register_forward_pre_hook(self.apply_mask, with_kwargs=True))
+        if not self.handles:
+            raise ValueError(f"Document masking supports GPTBigCode models, not {type(model).__name__}")
+
+    def set_mask(self, module, args, kwargs):
+        position_ids = kwargs.get("position_ids")
+        past = kwargs.get("past_key_values")
+        # generation with a KV cache sees one document per sequence
+        if position_ids is None or (past is not None and past[0] is not None):
+            self.mask = None
+        else:
+            self.mask = document_mask(position_ids, kwargs.get("attention_mask"))
+
+    def apply_mask(self, module, args, kwargs):
+        mask = kwargs.get("attention_mask")
+        if self.mask is None or mask is None or mask.dim() != 4:
+            return None
+        same = self.mask.to(mask.device)
+        # (batch, 1, query, key) for MHA and sdpa, (batch, query, 1, key) for MQA eager attention
+        same = same.unsqueeze(1) if mask.shape[1] == 1 else same.unsqueeze(2)
+        if mask.dtype == torch.bool:
+            mask = mask & same
+        else:
+            mask = mask.masked_fill(~same, torch.finfo(mask.dtype).min)
+        return args, {**kwargs, "attention_mask": mask}
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+
+def mask_documents(model):
+    """Keep the documents of bin-packed sequences from attending to each other; returns the `DocumentMasking`."""
+    return DocumentMasking(model)
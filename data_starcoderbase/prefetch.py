@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import deque
+
+"""
+Bounded producer/consumer queue used to tokenize ahead of the training loop.
+"""
+
+
+class TokenBudgetQueue:
+    """
+    Thread-safe FIFO whose capacity is a number of tokens rather than a number of items.
+    `put` blocks while the queued items already hold `max_tokens` tokens or more,
+    `get` blocks while the queue is empty and records how long the consumer waited.
+    """
+
+    def __init__(self, max_tokens):
+        self.max_tokens = max_tokens
+        self.items = deque()
+        self.tokens = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.stats = {
+            "gets": 0,
+            "stalls": 0,
+            "stall_time": 0.0,
+            "depth_tokens_sum": 0,
+            "depth_tokens_max": 0,
+        }
+
+    def put(self, item, num_tokens=0):
+        """Queue `item`; returns False without queueing it once the queue has been closed."""
+        with self.cond:
+            while self.tokens >= self.max_tokens and not self.closed:
+                self.cond.wait()
+            if self.closed:
+                return False
+            self.items.append((item, num_tokens))
+            self.tokens += num_tokens
+            self.stats["depth_tokens_max"] = max(self.stats["depth_tokens_max"], self.tokens)
+            self.cond.notify_all()
+            return True
+
+    def get(self):
+        with self.cond:
+            self.stats["gets"] += 1
+            self.stats["depth_tokens_sum"] += self.tokens
+            if not self.items:
+                # the consumer is about to wait on the producer: that is a data stall
+                self.stats["stalls"] += 1
+                start = time.perf_counter()
+                while not self.items:
+                    self.cond.wait()
+                self.stats["stall_time"] += time.perf_counter() - start
+            item, num_tokens = self.items.popleft()
+            self.tokens -= num_tokens
+            self.cond.notify_all()
+            return item
+
+    def close(self):
+        """Wake up and release a producer blocked in `put`, and drop the queued items."""
+        with self.cond:
+            self.closed = True
+            self.items.clear()
+            self.tokens = 0
+            self.cond.notify_all()
+
+    def metrics(self):
+        """Summary of the queue activity since it was created."""
+        with self.cond:
+            gets = max(self.stats["gets"], 1)
+            return {
+                "queue_tokens": self.tokens,
+                "queue_tokens_avg": self.stats["depth_tokens_sum"] / gets,
+                "queue_tokens_max": self.stats["depth_tokens_max"],
+                "queue_fill": self.stats["depth_tokens_sum"] / gets / self.max_tokens,
+                "data_stalls": self.stats["stalls"],
+                "data_stall_time": self.stats["stall_time"],
+            }
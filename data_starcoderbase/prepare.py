@@ -1,7 +1,15 @@
+import argparse
+import csv
+import itertools
 import json
-import random
+import sys
 from pathlib import Path
-import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from common.dedup import dedup_plan
+from common.manifest import SourceCache
+from common.splits import WRITE_BUFFER_SIZE
 
 # === CONFIGURATION ===
 tune_input_dir = Path(".data/test_data_1").absolute()
@@ -16,51 +24,83 @@ def add_prompt(prompt, record):
         return {"input": prompt + "\n\n" + record["input"], "output": record["output"]}
     return record
 
-def load_tune_data(input_dir):
-    prompt = (input_dir / "prompt.md").read_text()
+def load_tune_file(file):
     pairs = []
-    for file in input_dir.glob("*.json"):
-        if file.name == "prompt.md":
-            continue
-        data = json.loads(file.read_text())
-        for content in data.values():
-            user_input = json.dumps(
-                {
-                    "metadata": content.get("metadata", {}),
-                    "instructions": content.get("instructions", []),
-                },
-                separators=(",", ":"),
-            )
-            model_output = json.dumps(
-                {"workflow": content.get("workflow", [])}, separators=(",", ":")
-            )
-            pairs.append(
-                add_prompt(prompt, {"input": user_input, "output": model_output})
-            )
+    data = json.loads(Path(file).read_text())
+    for content in data.values():
+        user_input = json.dumps(
+            {
+                "metadata": content.get("metadata", {}),
+                "instructions": content.get("instructions", []),
+            },
+            separators=(",", ":"),
+        )
+        model_output = json.dumps(
+            {"workflow": content.get("workflow", [])}, separators=(",", ":")
+        )
+        pairs.append({"input": user_input, "output": model_output})
     return pairs
 
 
-def load_spec_data(spec_dir):
+def load_records_file(file):
+    return json.loads(Path(file).read_text())
+
+
+def load_tune_data(input_dir, source_cache, workers=None):
+    prompt = (input_dir / "prompt.md").read_text()
+    files = [file for file in sorted(input_dir.glob("*.json")) if file.name != "prompt.md"]
+    for records in source_cache.iter_many(files, load_tune_file, workers):
+        for record in records:
+            yield add_prompt(prompt, record)
+
+
+def load_spec_data(spec_dir, source_cache, workers=None):
     prompt = (spec_dir / "prompt.md").read_text()
-    spec_pairs = []
-    for file in spec_dir.glob("*.json"):
-        records = json.loads(file.read_text())
+    for records in source_cache.iter_many(sorted(spec_dir.glob("*.json")), load_records_file, workers):
         for r in records:
-            spec_pairs.append(add_prompt(prompt, r))
-    return spec_pairs
+            yield add_prompt(prompt, r)
+
+
+def write_csv_data(dataset, path):
+    """Stream the records to the CSV read by finetune.py, which does its own shuffled train/test split."""
+    with open(path, "w", encoding="utf-8", newline="", buffering=WRITE_BUFFER_SIZE) as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(["id", "question", "response"])
+        rows = 0
+        for item in dataset:
+            writer.writerow([rows, item["input"], item["output"]])
+            rows += 1
+    return rows
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=None, help="processes parsing the source files, 1 to parse serially")
+    parser.add_argument("--dedup_threshold", type=float, default=0.8, help="MinHash similarity of near-duplicates, 0 to disable")
+    return parser.parse_args()
+
 
+def main(args):
+    # === Load datasets ===
+    # parsed records of each source file, reused while the file content is unchanged
+    source_cache = SourceCache(str(output_dir / ".prep_cache"))
 
-def prepare_csv_data(dataset):
-    rows = []
-    for idx, item in enumerate(dataset):
-        rows.append({"id": idx, "question": item['input'], "response": item["output"]})
-    return pd.DataFrame(rows)
+    def records():
+        return itertools.chain(
+            load_tune_data(tune_input_dir, source_cache, args.workers),
+            load_spec_data(spec_input_dir, source_cache, args.workers),
+        )
 
+    # only one record of each near-duplicate cluster is written, so that the random
+    # train/test split of finetune.py cannot put near-copies on both sides
+    plan = dedup_plan(((r["input"], i, None) for i, r in enumerate(records())), args.dedup_threshold)
+    tamarind_data = (r for r, (_, _, representative) in zip(records(), plan) if representative)
 
-# === Load datasets ===
-tamarind_data = load_tune_data(tune_input_dir) + load_spec_data(spec_input_dir)
+    # === Write CSVs ===
+    rows = write_csv_data(tamarind_data, output_dir / "tamarind_data.csv")
+    source_cache.save()
+    print(f"Wrote {rows} rows to {output_dir / 'tamarind_data.csv'}")
 
-random.shuffle(tamarind_data)
 
-# === Write CSVs ===
-prepare_csv_data(tamarind_data).to_csv(output_dir / "tamarind_data.csv", index=False)
+if __name__ == "__main__":
+    main(get_args())
@@ -0,0 +1,50 @@
+from itertools import islice
+
+import datasets
+from torch.utils.data import get_worker_info
+
+"""
+Helpers to split an iterable dataset between DataLoader workers and DDP ranks.
+"""
+
+
+def shard_info(rank=0, world_size=1):
+    """
+    Return (shard_id, num_shards) for the calling DataLoader worker.
+    Every (rank, worker) pair gets its own shard, ranks being the outer dimension.
+    """
+    worker_info = get_worker_info()
+    worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+    return rank * num_workers + worker_id, world_size * num_workers
+
+
+class IterableShard:
+    """Re-iterable view keeping every `num_shards`-th example of `dataset`, starting at `shard_id`."""
+
+    def __init__(self, dataset, shard_id, num_shards):
+        self.dataset = dataset
+        self.shard_id = shard_id
+        self.num_shards = num_shards
+
+    def __iter__(self):
+        return islice(iter(self.dataset), self.shard_id, None, self.num_shards)
+
+
+def shard_dataset(dataset, shard_id, num_shards):
+    """Return the disjoint slice of `dataset` owned by shard `shard_id`."""
+    if num_shards == 1:
+        return dataset
+    if isinstance(dataset, datasets.Dataset):
+        # indexed datasets can jump straight to their slice instead of skipping examples
+        return dataset.shard(num_shards=num_shards, index=shard_id, contiguous=True)
+    return IterableShard(dataset, shard_id, num_shards)
+
+
+def iter_from(dataset, start=0):
+    """Iterate `dataset` from its `start`-th example, seeking directly when it is indexed."""
+    if start == 0:
+        return iter(dataset)
+    if isinstance(dataset, datasets.Dataset):
+        return iter(dataset.select(range(min(start, len(dataset)), len(dataset))))
+    # streamed datasets can only skip: examples are read again but not tokenized
+    return islice(iter(dataset), start, None)
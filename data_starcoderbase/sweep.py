@@ -0,0 +1,250 @@
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from argparse import Namespace
+from pathlib import Path
+
+import torch
+from peft import get_peft_model, prepare_model_for_kbit_training
+from torch.utils.data import DataLoader
+from transformers import AutoModelForCausalLM, AutoTokenizer, get_scheduler, set_seed
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from common.model_cache import load_cached_model
+from finetune import create_lora_config, create_packed_datasets
+from pack_tokens import cached_pack, load_splits
+
+"""
+LoRA hyperparameter sweep: several adapters trained side by side on one frozen base model.
+
+The base model is loaded once and every configuration of the --lora_r x --lora_alpha x
+--learning_rate grid becomes a named adapter of the same PeftModel, with its own optimizer
+and learning rate schedule. Each batch is tokenized once (pack_tokens.py output, or an
+entry of --token_cache_dir) and trains every adapter in turn: the adapter is activated,
+the batch goes forward and backward through the shared frozen weights and only that
+adapter's optimizer steps. Memory grows with the adapters (LoRA weights, optimizer
+states), not with copies of the model.
+
+At each evaluation every adapter is scored on the same validation batches. Every adapter
+is saved to <output_dir>/<name> and the results, best adapter first, to <output_dir>/sweep.json.
+
+    python data_starcoderbase/sweep.py --model_path bigcode/starcoderbase-1b --dataset_path data_store \
+        --input_column_name question --output_column_name response \
+        --lora_r 8 16 --lora_alpha 16 32 --learning_rate 1e-4 5e-5
+"""
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path", type=str, default="bigcode/large-model")
+    parser.add_argument("--dataset_path", type=str, default="./dataset.csv")
+    parser.add_argument("--dataset_type", type=str, default="csv")
+    parser.add_argument("--split", type=str, default="train")
+    parser.add_argument("--packed_dataset_path", type=str, default=None, help="pack_tokens.py output, else --dataset_path is packed")
+    parser.add_argument("--token_cache_dir", type=str, default=".token_cache")
+    parser.add_argument("--input_column_name", type=str, default="prompt")
+    parser.add_argument("--output_column_name", type=str, default="completion")
+    parser.add_argument("--eos_token_id", type=int, default=49152)
+
+    parser.add_argument("--lora_r", type=int, nargs="+", default=[16])
+    parser.add_argument("--lora_alpha", type=int, nargs="+", default=[32])
+    parser.add_argument("--learning_rate", type=float, nargs="+", default=[5e-6])
+    parser.add_argument("--lora_dropout", type=float, default=0.05)
+
+    parser.add_argument("--seq_length", type=int, default=2048)
+    parser.add_argument("--max_steps", type=int, default=1000)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--gradient_accumulation_steps", type=int, default=1)
+    parser.add_argument("--lr_scheduler_type", type=str, default="cosine")
+    parser.add_argument("--num_warmup_steps", type=int, default=100)
+    parser.add_argument("--weight_decay", type=float, default=0.05)
+    parser.add_argument("--eval_freq", type=int, default=100)
+    parser.add_argument("--eval_batches", type=int, default=None, help="validation batches per evaluation, all by default")
+    parser.add_argument("--log_freq", type=int, default=10)
+    parser.add_argument("--load_in_8bit", action="store_true", help="load the base model in 8 bits, on GPU")
+    parser.add_argument("--model_cache_dir", type=str, default=None, help="load the base model from this cache (common/model_cache.py), built on the first run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--num_workers", type=int, default=None, help="processes tokenizing --dataset_path")
+    parser.add_argument("--output_dir", type=str, default="./sweep")
+    return parser.parse_args()
+
+
+def sweep_configs(args):
+    """Every (lora_r, lora_alpha, learning_rate) of the grid, as dicts named lora0, lora1..."""
+    grid = itertools.product(args.lora_r, args.lora_alpha, args.learning_rate)
+    return [
+        {"name": f"lora{i}", "lora_r": r, "lora_alpha": alpha, "learning_rate": lr}
+        for i, (r, alpha, lr) in enumerate(grid)
+    ]
+
+
+class LoraSweep:
+    """
+    Train one LoRA adapter per configuration on the same frozen `model`.
+        Args:
+            model: The base causal LM, frozen.
+            configs (list): Dicts with name, lora_r, lora_alpha and learning_rate.
+            lora_dropout (float): Dropout of every adapter.
+            weight_decay (float): AdamW weight decay of every adapter.
+            lr_scheduler_type (str): Schedule of every learning rate, see transformers.get_scheduler.
+            num_warmup_steps (int): Warm-up steps of the schedules.
+            max_steps (int): Length of the schedules.
+    """
+
+    def __init__(self, model, configs, lora_dropout=0.05, weight_decay=0.05, lr_scheduler_type="cosine", num_warmup_steps=0, max_steps=1000):
+        self.configs = configs
+        self.names = [config["name"] for config in configs]
+        for i, config in enumerate(configs):
+            lora_config = create_lora_config(
+                Namespace(lora_r=config["lora_r"], lora_alpha=config["lora_alpha"], lora_dropout=lora_dropout)
+            )
+            if i == 0:
+                model = get_peft_model(model, lora_config, adapter_name=config["name"])
+            else:
+                model.add_adapter(config["name"], lora_config)
+        self.model = model
+        self.optimizers, self.schedulers = {}, {}
+        for config in configs:
+            name = config["name"]
+            # LoRA weights are named ...lora_A.<adapter>.weight
+            params = [p for n, p in model.named_parameters() if f".{name}." in n]
+            optimizer = torch.optim.AdamW(params, lr=config["learning_rate"], weight_decay=weight_decay)
+            self.optimizers[name] = optimizer
+            self.schedulers[name] = get_scheduler(
+                lr_scheduler_type, optimizer, num_warmup_steps=num_warmup_steps, num_training_steps=max_steps
+            )
+        self.train_losses = {name: [] for name in self.names}
+        self.eval_losses = {name: [] for name in self.names}
+        self.seconds = {name: 0.0 for name in self.names}
+
+    def step(self, batches):
+        """One optimizer step of every adapter over the same micro-batches (gradient accumulation)."""
+        self.model.train()
+        for name in self.names:
+            start = time.perf_counter()
+            # only the active adapter requires grad, the others and the base model are frozen
+            self.model.set_adapter(name)
+            loss = 0.0
+            for batch in batches:
+                micro_loss = self.model(**batch).loss / len(batches)
+                micro_loss.backward()
+                loss += micro_loss.item()
+            self.optimizers[name].step()
+            self.schedulers[name].step()
+            self.optimizers[name].zero_grad(set_to_none=True)
+            self.train_losses[name].append(loss)
+            self.seconds[name] += time.perf_counter() - start
+
+    @torch.no_grad()
+    def evaluate(self, batches):
+        """Mean validation loss of every adapter on the same `batches`."""
+        self.model.eval()
+        losses = {}
+        for name in self.names:
+            self.model.set_adapter(name)
+            losses[name] = sum(self.model(**batch).loss.item() for batch in batches) / max(len(batches), 1)
+            self.eval_losses[name].append(losses[name])
+        return losses
+
+    def results(self):
+        """The configurations with their losses and training time, best final validation loss first."""
+        results = []
+        for config in self.configs:
+            name = config["name"]
+            eval_losses = self.eval_losses[name]
+            results.append(
+                {
+                    **config,
+                    "eval_loss": eval_losses[-1] if eval_losses else None,
+                    "best_eval_loss": min(eval_losses) if eval_losses else None,
+                    "train_loss": self.train_losses[name][-1] if self.train_losses[name] else None,
+                    "train_seconds": self.seconds[name],
+                }
+            )
+        return sorted(results, key=lambda r: float("inf") if r["eval_loss"] is None else r["eval_loss"])
+
+    def save(self, output_dir):
+        for name in self.names:
+            # adapters other than "default" are saved to output_dir/<name>
+            self.model.save_pretrained(output_dir, selected_adapters=[name])
+
+
+def sweep_datasets(args):
+    """Train and validation datasets of packed tokens, packing --dataset_path into the token cache if needed."""
+    if not args.packed_dataset_path:
+        tokenizer = AutoTokenizer.from_pretrained(args.model_path, use_auth_token=True)
+        eos_token_id = tokenizer.eos_token_id if tokenizer.eos_token_id is not None else args.eos_token_id
+        train_data, valid_data = load_splits(args.dataset_path, args.dataset_type, args.split, 0.1, args.seed)
+        args.packed_dataset_path = cached_pack(
+            tokenizer,
+            {"train": train_data, "valid": valid_data},
+            args.token_cache_dir,
+            eos_token_id,
+            args.input_column_name,
+            args.output_column_name,
+            num_proc=args.num_workers,
+        )
+    return create_packed_datasets(args)
+
+
+def main(args):
+    set_seed(args.seed)
+    train_data, valid_data = sweep_datasets(args)
+    configs = sweep_configs(args)
+    print(f"Sweeping {len(configs)} adapters on one base model")
+
+    device_map = {"": 0} if torch.cuda.is_available() else None
+    if args.model_cache_dir:
+        quantization = "8bit" if args.load_in_8bit else None
+        model = load_cached_model(args.model_path, args.model_cache_dir, quantization=quantization, device_map=device_map)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(
+            args.model_path, use_auth_token=True, load_in_8bit=args.load_in_8bit, device_map=device_map
+        )
+    if args.load_in_8bit:
+        model = prepare_model_for_kbit_training(model)
+    sweep = LoraSweep(
+        model,
+        configs,
+        lora_dropout=args.lora_dropout,
+        weight_decay=args.weight_decay,
+        lr_scheduler_type=args.lr_scheduler_type,
+        num_warmup_steps=args.num_warmup_steps,
+        max_steps=args.max_steps,
+    )
+    device = sweep.model.device
+
+    # every batch is moved to the device once and shared by all the adapters
+    eval_batches = []
+    for batch in DataLoader(valid_data, batch_size=args.batch_size):
+        if args.eval_batches is not None and len(eval_batches) == args.eval_batches:
+            break
+        eval_batches.append({k: v.to(device) for k, v in batch.items()})
+    train_batches = iter(DataLoader(train_data, batch_size=args.batch_size, drop_last=True))
+
+    for step in range(1, args.max_steps + 1):
+        batches = [{k: v.to(device) for k, v in next(train_batches).items()} for _ in range(args.gradient_accumulation_steps)]
+        sweep.step(batches)
+        if step % args.log_freq == 0:
+            print(f"step {step}: " + ", ".join(f"{name}={sweep.train_losses[name][-1]:.4f}" for name in sweep.names))
+        if step % args.eval_freq == 0 or step == args.max_steps:
+            losses = sweep.evaluate(eval_batches)
+            print(f"step {step} eval: " + ", ".join(f"{name}={loss:.4f}" for name, loss in losses.items()))
+
+    results = sweep.results()
+    sweep.save(args.output_dir)
+    with open(os.path.join(args.output_dir, "sweep.json"), "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    best = results[0]
+    print(
+        f"Best adapter: {best['name']} (lora_r={best['lora_r']}, lora_alpha={best['lora_alpha']}, "
+        f"learning_rate={best['learning_rate']}) eval_loss={best['eval_loss']:.4f}, saved to {os.path.join(args.output_dir, best['name'])}"
+    )
+
+
+if __name__ == "__main__":
+    main(get_args())